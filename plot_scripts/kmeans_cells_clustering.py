@@ -53,10 +53,8 @@ op.print_help()
 datafile = openFile(opts.inputfile, mode = "r", title = "Data is stored here")
 
 # Extract some of the dataset from the datafile
-dataset, labels = utils.extract_datasets.extract_labeled_chunkrange(datafile, opts.size)
-
-# Remove CP index features, other non-object features
-dataset = dataset[:,5:612]
+# Read only the object features, skipping CP index features, other non-object features
+dataset, labels = utils.extract_datasets.extract_labeled_chunkrange(datafile, opts.size, features = (5,612))
 
 true_k = np.unique(labels[:,0]).shape[0]
 
@@ -44,10 +44,8 @@ np.random.seed(0)
 datafile = openFile(opts.inputfile, mode = "r", title = "Data is stored here")
 
 # Extract some of the dataset from the datafile
-X, labels = extract_labeled_chunkrange(datafile, opts.size)
-
-# Remove the first four indexing features introduced by CP
-X = X[:,5:-1]
+# Read only the object features, skipping the first four indexing features introduced by CP
+X, labels = extract_labeled_chunkrange(datafile, opts.size, features = (5,-1))
 
 true_k =  np.unique(labels[:,0]).shape[0]
 
@@ -1,3 +1,6 @@
+import os
+import tempfile
+
 import numpy as np  
 
 import theano
@@ -10,6 +13,72 @@ from logistic_sgd import LogisticRegression
 from AutoEncoder import AutoEncoder, BernoulliAutoEncoder, GaussianAutoEncoder, ReluAutoEncoder
 
 
+class LazyFunctionList(object):
+    """ A fixed length list of theano functions, each of which is built by calling build(i) 
+    the first time item i is taken from the list. """
+    
+    def __init__(self, n, build):
+        self.build = build
+        self.fns = [None] * n
+        
+    def __len__(self):
+        return len(self.fns)
+    
+    def __getitem__(self, i):
+        if self.fns[i] is None:
+            self.fns[i] = self.build(i)
+        return self.fns[i]
+    
+    def __iter__(self):
+        for i in xrange(len(self.fns)):
+            yield self[i]
+
+
+def fused_function(graph):
+    """ Compile the graph of one training step into a function that runs the step over a vector 
+    of minibatch indices with theano.scan, applying the updates after each step, and returns the 
+    vector of per-minibatch costs.  Running many minibatches per call saves the python overhead
+    of a call per minibatch.
+    
+    :type graph: dict
+    :param graph: keyword arguments to theano.function for one training step, as returned by
+                  pretraining_graph or finetune_graph.  The first input must be the minibatch index.
+    """
+    index = graph['inputs'][0]
+    # the other inputs (momentum etc.) are the same for every step; they may be wrapped in theano.Param
+    scalars = [getattr(i, 'variable', i) for i in graph['inputs'][1:]]
+    updates = OrderedDict(graph['updates'])
+    
+    # random streams (e.g for corruption) update their state by default_update, which must be 
+    # cloned along with the rest of the step to draw new noise at each step
+    for v in theano.gof.graph.inputs([graph['outputs']] + updates.values()):
+        if isinstance(v, theano.compile.SharedVariable) and getattr(v, 'default_update', None) is not None and v not in updates:
+            updates[v] = v.default_update
+    params = updates.keys()
+    
+    # express the cost and updates in terms of the minibatch index and the other inputs only
+    step_graph = theano.clone([graph['outputs']] + [updates[p] for p in params], replace=graph['givens'])
+    
+    def step(i, *inner_scalars):
+        replace = dict(zip(scalars, inner_scalars))
+        replace[index] = i
+        outputs = theano.clone(step_graph, replace=replace)
+        return outputs[0], OrderedDict(zip(params, outputs[1:]))
+    
+    indices = T.lvector('indices')
+    costs, scan_updates = theano.scan(step, sequences=[indices], non_sequences=scalars)
+    return theano.function(inputs=[indices] + graph['inputs'][1:], outputs=costs, updates=scan_updates)
+
+
+def minibatch(data, begin, end, perm=None):
+    """ Return rows begin:end of the shared variable data, or if perm is given, the rows of data at
+    positions begin:end of the shared index vector perm (e.g from batch_sampler.BatchSampler).  The rows
+    are gathered inside the compiled graph, so the data is never copied in shuffled order. """
+    if perm is None:
+        return data[begin:end]
+    return data[perm[begin:end]]
+
+
 class SdA(object):
     """Stacked denoising auto-encoder class (SdA)
 
@@ -375,7 +444,7 @@ class SdA(object):
         ''' Define and return a theano function to apply momentum updates to each 
         parameter that is part of momentum updates '''
         
-        momentum = T.fscalar('momentum')
+        momentum = T.scalar('momentum')
         delta_t_updates = OrderedDict()
         for param in self.params:
             if param in self.updates:
@@ -525,13 +594,23 @@ class SdA(object):
 ##############################  Training functions ##########################
 
 
-    def pretraining_functions(self, train_set_x, batch_size, learning_rate,method='cm'):
+    def pretraining_functions(self, train_set_x, batch_size, learning_rate,method='cm', cache_hidden=False, hidden_dir=None, fused=False, perm=None):
         ''' Generates a list of functions, each of them implementing one
         step in training the dA corresponding to the layer with same index.
         The function takes a minibatch index, and so training one dA layer
         corresponds to iterating this layer-specific training function in the
         list over all minibatch indexes.
         
+        Each function is only compiled the first time it is taken from the list, 
+        so layers that are never trained (e.g when restarting partway through) cost nothing.
+        The graphs of all layers are still built up front, so the corruption noise drawn 
+        for each layer does not depend on which layers are compiled.
+        
+        With cache_hidden, the function for layer i > 0 trains on the activations of layer i-1,
+        computed once for the whole training set when the function is taken from the list, rather 
+        than recomputing the forward pass through the layers below for every minibatch of every epoch.  
+        The layers must then be trained in order, and train_set_x must not change while a layer is trained.
+        
         N.B: learning_rate should be a theano.shared variable declared in the
         code driving the (pre)training of this SdA.
 
@@ -547,7 +626,53 @@ class SdA(object):
         
         :type method: string
         :param method: specifies the flavour of SGD used to train each dA layer.  Accepted values are 'cm', 'adagrad', 'adagrad_momentum'
+        
+        :type cache_hidden: bool
+        :param cache_hidden: train each layer above the first on the cached activations of the layer below
+        
+        :type hidden_dir: string
+        :param hidden_dir: if given, keep the cached activations in a memory mapped file in this directory rather than in memory
+        
+        :type fused: bool
+        :param fused: compile with fused_function, so each function takes a vector of minibatch indices 
+                      in place of the index, and returns the vector of their costs
+                      
+        :type perm: theano.tensor.shared
+        :param perm: if given, a vector of row indices: minibatch index is made of the rows at positions 
+                     index * batch_size to (index + 1) * batch_size of perm, rather than of train_set_x 
         '''
+        
+        # with cache_hidden, layer i > 0 trains on a buffer of layer i-1's activations, filled when its function is built
+        hidden_sets = [None for dA in self.dA_layers]
+        if cache_hidden:
+            for i in xrange(1, self.n_layers):
+                empty = np.zeros((0, self.dA_layers[i].n_visible), dtype=theano.config.floatX)
+                hidden_sets[i] = theano.shared(empty, name='hidden_' + str(i - 1), borrow=True)
+        
+        graphs = [self.pretraining_graph(i, train_set_x, batch_size, learning_rate, method, hidden_sets[i], perm) for i in xrange(self.n_layers)]
+        
+        def build(i):
+            if hidden_sets[i] is not None:
+                # the layers below are trained by now, so their output is fixed for all the epochs of this layer
+                hidden_sets[i].set_value(self.hidden_values(i - 1, train_set_x, hidden_dir=hidden_dir), borrow=True)
+                if hidden_sets[i - 1] is not None:
+                    hidden_sets[i - 1].set_value(np.zeros((0, self.dA_layers[i - 1].n_visible), dtype=theano.config.floatX), borrow=True)
+            if fused:
+                return fused_function(graphs[i])
+            return theano.function(**graphs[i])
+        return LazyFunctionList(self.n_layers, build)
+    
+    def pretraining_function(self, i, train_set_x, batch_size, learning_rate, method='cm'):
+        ''' Compile and return the function implementing one step in training 
+        the dA of layer i.  See pretraining_functions for the arguments. '''
+        return theano.function(**self.pretraining_graph(i, train_set_x, batch_size, learning_rate, method))
+    
+    def pretraining_graph(self, i, train_set_x, batch_size, learning_rate, method='cm', hidden_set=None, perm=None):
+        ''' Build the graph of one step in training the dA of layer i.  Returns the
+        dict of keyword arguments to theano.function that compiles it.  If hidden_set is 
+        given, it holds the activations of layer i-1 for train_set_x, and the minibatches
+        are taken from it instead of being fed through the layers below.  If perm is given,
+        the minibatches are taken in its order (see minibatch). '''
 
         # index to a minibatch
         index = T.lscalar('index') 
@@ -563,40 +688,75 @@ class SdA(object):
         # ending of a batch given `index`
         batch_end = batch_begin + batch_size
 
-        pretrain_fns = []
+        dA = self.dA_layers[i]
         
-        for dA in self.dA_layers:
-            # get the cost and the updates list
-            cost, updates = dA.get_cost_gparams(corruption_level,learning_rate)
-            
-            # apply the updates in accordnace with the SGD method
-            if method == 'cm':
-                mod_updates = self.sgd_cm(learning_rate, momentum, updates)
-                input_list = [index,momentum,theano.Param(corruption_level, default=0.25)]
-            elif method == 'adagrad':
-                mod_updates = self.sgd_adagrad(learning_rate, updates)
-                input_list = [index,theano.Param(corruption_level, default=0.25)]
-            else:
-                mod_updates = self.sgd_adagrad_momentum(momentum, learning_rate, updates)
-                input_list = [index,momentum,theano.Param(corruption_level, default=0.25)]
-                
-            # compile the theano function
-            fn = theano.function(inputs=input_list, 
-                                 outputs=cost,
-                                 updates=mod_updates,
-                                 givens={self.x: train_set_x[batch_begin:
-                                                             batch_end]})
-            # append `fn` to the list of functions
-            pretrain_fns.append(fn)
+        # get the cost and the updates list
+        cost, updates = dA.get_cost_gparams(corruption_level,learning_rate)
+        
+        # apply the updates in accordnace with the SGD method
+        if method == 'cm':
+            mod_updates = self.sgd_cm(learning_rate, momentum, updates)
+            input_list = [index,momentum,theano.Param(corruption_level, default=0.25)]
+        elif method == 'adagrad':
+            mod_updates = self.sgd_adagrad(learning_rate, updates)
+            input_list = [index,theano.Param(corruption_level, default=0.25)]
+        else:
+            mod_updates = self.sgd_adagrad_momentum(momentum, learning_rate, updates)
+            input_list = [index,momentum,theano.Param(corruption_level, default=0.25)]
+        
+        if hidden_set is not None:
+            givens = {dA.x: minibatch(hidden_set, batch_begin, batch_end, perm)}
+        else:
+            givens = {self.x: minibatch(train_set_x, batch_begin, batch_end, perm)}
             
-        return pretrain_fns
+        return dict(inputs=input_list, 
+                    outputs=cost,
+                    updates=mod_updates,
+                    givens=givens)
+    
+    def hidden_values(self, i, train_set_x, slab_size=10000, hidden_dir=None):
+        ''' Return the activations of the hidden units of layer i for every row of train_set_x,
+        computed slab by slab.  
+        
+        :type train_set_x: theano.tensor.TensorType
+        :param train_set_x: Shared variable that contains all the datapoints
+        
+        :type slab_size: int
+        :param slab_size: compute the activations of this many rows at a time
+        
+        :type hidden_dir: string
+        :param hidden_dir: if given, return a memory mapped array backed by a (deleted) file in this directory
+        '''
+        
+        start = T.lscalar('start')
+        end = T.lscalar('end')
+        hidden_fn = theano.function(inputs=[start,end],
+              outputs=self.dA_layers[i].output,
+              givens={self.x: train_set_x[start:end]})
+        
+        n_rows = train_set_x.get_value(borrow=True).shape[0]
+        shape = (n_rows, self.dA_layers[i].n_hidden)
+        if hidden_dir is not None:
+            handle, filename = tempfile.mkstemp(suffix='.npy', dir=hidden_dir)
+            os.close(handle)
+            hidden = np.lib.format.open_memmap(filename, mode='w+', dtype=theano.config.floatX, shape=shape)
+            # the mapping stays valid after the file is unlinked, and the space is freed with it
+            os.remove(filename)
+        else:
+            hidden = np.empty(shape, dtype=theano.config.floatX)
+        
+        for slab_start in xrange(0, n_rows, slab_size):
+            slab_end = min(slab_start + slab_size, n_rows)
+            hidden[slab_start:slab_end] = hidden_fn(slab_start, slab_end)
+        return hidden
 
     
-    def build_finetune_limited_reconstruction(self, train_set_x, batch_size, learning_rate, method='cm'):
+    def build_finetune_limited_reconstruction(self, train_set_x, batch_size, learning_rate, method='cm', perm=None):
         ''' Generates a list of theano functions, each of them implementing one
         step in hybrid pretraining.  Hybrid pretraining is traning to minimize the 
         reconstruction error of the data against the representation produced using 
-        two or more layers of the SdA.  
+        two or more layers of the SdA.  Function j of the list reconstructs using the
+        first j+2 layers, and is only compiled the first time it is taken from the list.
         
         N.B: learning_rate should be a theano.shared variable declared in the
         code driving the (pre)training of this SdA.
@@ -612,7 +772,25 @@ class SdA(object):
         :param learning_rate: the learning rate for pretraining 
         
         :type method: string
-        :param method: specifies the flavour of SGD used to train each dA layer.  Accepted values are 'cm', 'adagrad', 'adagrad_momentum' '''
+        :param method: specifies the flavour of SGD used to train each dA layer.  Accepted values are 'cm', 'adagrad', 'adagrad_momentum' 
+        
+        :type perm: theano.tensor.shared
+        :param perm: if given, take the minibatches in the order of this vector of row indices (see minibatch) '''
+        
+        # sanity check on number of layers
+        assert 2 < len(self.dA_layers)
+        
+        # Check on SGD method
+        assert method in ['cm','adagrad','adagrad_momentum','cm_wd','adagrad_momentum_wd']
+        
+        def build(j):
+            return self.finetune_limited_reconstruction_function(j + 2, train_set_x, batch_size, learning_rate, method, perm)
+        return LazyFunctionList(len(self.dA_layers) - 2, build)
+    
+    def finetune_limited_reconstruction_function(self, i, train_set_x, batch_size, learning_rate, method='cm', perm=None):
+        ''' Compile and return the function implementing one step of hybrid pretraining,
+        reconstructing the data using the first i layers of the SdA.  See 
+        build_finetune_limited_reconstruction for the arguments. '''
         
         # index to a minibatch
         index = T.lscalar('index') 
@@ -629,54 +807,45 @@ class SdA(object):
         # ending of a batch given `index`
         batch_end = batch_begin + batch_size      
         
-        # sanity check on number of layers
-        assert 2 < len(self.dA_layers)
-        
         # Check on SGD method
         assert method in ['cm','adagrad','adagrad_momentum','cm_wd','adagrad_momentum_wd']
-        
-        hybrid_train_fns = []
-        for i in xrange(2,len(self.dA_layers)):
 
-            # get the subset of model params involved in the limited reconstruction
-            limited_params = self.params[:i*3]
-                
-            # compute the gradients with respect to the partial model parameters
-            gparams = T.grad(self.reconstruction_error_limited(self.x, i), limited_params)
-            
-            # Ensure that gparams has same size as limited_params
-            assert len(gparams) == len(limited_params)
+        # get the subset of model params involved in the limited reconstruction
+        limited_params = self.params[:i*3]
             
+        # compute the gradients with respect to the partial model parameters
+        gparams = T.grad(self.reconstruction_error_limited(self.x, i), limited_params)
+        
+        # Ensure that gparams has same size as limited_params
+        assert len(gparams) == len(limited_params)
+        
+        
+        # apply the updates in accordnace with the SGD method
+        if method == 'cm':
+            mod_updates = self.sgd_cm(learning_rate, momentum, zip(limited_params,gparams))
+            input_list = [index,momentum]
+        elif method == 'adagrad':
+            mod_updates = self.sgd_adagrad(learning_rate, zip(limited_params,gparams))
+            input_list = [index]
+        elif method == 'adagrad_momentum':
+            mod_updates = self.sgd_adagrad_momentum(momentum, learning_rate, zip(limited_params,gparams))
+            input_list = [index,momentum]
+        elif method == 'cm_wd':
+            mod_updates = self.sgd_cm_wd(learning_rate, momentum, weight_decay, zip(limited_params,gparams))
+            input_list = [index,momentum,weight_decay]
+        else:
+            mod_updates = self.sgd_adagrad_momentum_wd(momentum, learning_rate, weight_decay, zip(limited_params,gparams))
+            input_list = [index,momentum,weight_decay]            
             
-            # apply the updates in accordnace with the SGD method
-            if method == 'cm':
-                mod_updates = self.sgd_cm(learning_rate, momentum, zip(limited_params,gparams))
-                input_list = [index,momentum]
-            elif method == 'adagrad':
-                mod_updates = self.sgd_adagrad(learning_rate, zip(limited_params,gparams))
-                input_list = [index]
-            elif method == 'adagrad_momentum':
-                mod_updates = self.sgd_adagrad_momentum(momentum, learning_rate, zip(limited_params,gparams))
-                input_list = [index,momentum]
-            elif method == 'cm_wd':
-                mod_updates = self.sgd_cm_wd(learning_rate, momentum, weight_decay, zip(limited_params,gparams))
-                input_list = [index,momentum,weight_decay]
-            else:
-                mod_updates = self.sgd_adagrad_momentum_wd(momentum, learning_rate, weight_decay, zip(limited_params,gparams))
-                input_list = [index,momentum,weight_decay]            
-                
-            # the hybrid pre-training function now takes into account the update algorithm and proper input
-            fn = theano.function(inputs=input_list, 
-                                 outputs=self.reconstruction_error_limited(self.x, i),
-                                 updates=mod_updates,
-                                 givens={self.x: train_set_x[batch_begin:
-                                                             batch_end]})
-            # append `fn` to the list of functions
-            hybrid_train_fns.append(fn)
-            
-        return hybrid_train_fns
+        # the hybrid pre-training function now takes into account the update algorithm and proper input
+        fn = theano.function(inputs=input_list, 
+                             outputs=self.reconstruction_error_limited(self.x, i),
+                             updates=mod_updates,
+                             givens={self.x: minibatch(train_set_x, batch_begin,
+                                                       batch_end, perm)})
+        return fn
     
-    def build_finetune_full_reconstruction(self, datasets, batch_size, learning_rate, method='cm'):
+    def build_finetune_full_reconstruction(self, datasets, batch_size, learning_rate, method='cm', fused=False, n_workers=1, perm=None):
         ''' 
         Generates a function `train` that implements one step of
         finetuning, a function `validate` that computes the reconstruction 
@@ -695,6 +864,18 @@ class SdA(object):
         
         :type method: string
         :param method: specifies the flavour of SGD used to train each dA layer.  Accepted values are 'cm', 'adagrad', 'adagrad_momentum'
+        
+        :type fused: bool
+        :param fused: compile `train` with fused_function, so it takes a vector of minibatch indices 
+                      in place of the index, and returns the vector of their costs
+                      
+        :type n_workers: int
+        :param n_workers: if more than one, `train` is a parallel_sgd.DataParallelTrainer that splits each 
+                          minibatch between this many worker processes.  Call its close() method when done.
+                          
+        :type perm: theano.tensor.shared
+        :param perm: if given, take the training minibatches in the order of this vector of row indices
+                     (see minibatch).  The validation minibatches are always taken in storage order.
         '''
         
         (train_set_x, valid_set_x) = datasets
@@ -705,9 +886,53 @@ class SdA(object):
         
         index = T.lscalar('index')  # index to a [mini]batch     
         
+        # compile the fine-tuning theano function, taking into account the update algorithm
+        if n_workers > 1:
+            if fused:
+                raise ValueError('the data parallel trainer cannot be fused')
+            from parallel_sgd import DataParallelTrainer
+            train_fn = DataParallelTrainer(self, train_set_x, batch_size, learning_rate, method, n_workers, perm)
+        elif fused:
+            train_fn = fused_function(self.finetune_graph(train_set_x, batch_size, learning_rate, method, perm))
+        else:
+            train_fn = theano.function(**self.finetune_graph(train_set_x, batch_size, learning_rate, method, perm))
+
+        valid_score_i = theano.function([index], self.errors,
+              givens={
+                 self.x: valid_set_x[index * batch_size:
+                                     (index + 1) * batch_size]})
+
+        # Create a function that scans the entire validation set
+        def valid_score():
+            return [valid_score_i(i) for i in xrange(n_valid_batches)]
+
+        return train_fn, valid_score        
+    
+    def finetune_graph(self, train_set_x, batch_size, learning_rate, method='cm', perm=None):
+        ''' Build the graph of one step of finetuning the whole SdA.  Returns the dict of 
+        keyword arguments to theano.function that compiles it.  See build_finetune_full_reconstruction 
+        for the arguments. '''
+        
+        index = T.lscalar('index')  # index to a [mini]batch     
+        
         # compute the gradients with respect to the model parameters
         gparams = T.grad(self.finetune_cost, self.params)       
         
+        # apply the updates in accordnace with the SGD method
+        mod_updates, sgd_inputs = self.finetune_updates(learning_rate, zip(self.params,gparams), method)
+        input_list = [index] + sgd_inputs
+                
+        return dict(inputs=input_list,
+                    outputs=self.finetune_cost,
+                    updates=mod_updates,
+                    givens={
+                      self.x: minibatch(train_set_x, index * batch_size,
+                                        (index + 1) * batch_size, perm)})
+    
+    def finetune_updates(self, learning_rate, gparams, method='cm'):
+        ''' Return the updates of the SGD method for the (param, gradient) pairs in gparams, and the list of 
+        scalar inputs the method takes: momentum, then weight decay, for the methods that use them. '''
+        
         # momentum rate to use
         momentum = T.scalar('momentum')   
         
@@ -716,41 +941,16 @@ class SdA(object):
         
         assert method in ['cm','adagrad','adagrad_momentum','cm_wd','adagrad_momentum_wd']
 
-        # apply the updates in accordnace with the SGD method
         if method == 'cm':
-            mod_updates = self.sgd_cm(learning_rate, momentum, zip(self.params,gparams))
-            input_list = [index,momentum]
+            return self.sgd_cm(learning_rate, momentum, gparams), [momentum]
         elif method == 'adagrad':
-            mod_updates = self.sgd_adagrad(learning_rate, zip(self.params,gparams))
-            input_list = [index]
+            return self.sgd_adagrad(learning_rate, gparams), []
         elif method == 'adagrad_momentum':
-            mod_updates = self.sgd_adagrad_momentum(momentum, learning_rate, zip(self.params,gparams))
-            input_list = [index,momentum]
+            return self.sgd_adagrad_momentum(momentum, learning_rate, gparams), [momentum]
         elif method == 'cm_wd':
-            mod_updates = self.sgd_cm_wd(learning_rate, momentum, weight_decay, zip(self.params,gparams))
-            input_list = [index,momentum,weight_decay]
+            return self.sgd_cm_wd(learning_rate, momentum, weight_decay, gparams), [momentum,weight_decay]
         else:
-            mod_updates = self.sgd_adagrad_momentum_wd(momentum, learning_rate, weight_decay, zip(self.params,gparams))
-            input_list = [index,momentum,weight_decay]
-                
-        # compile the fine-tuning theano function, taking into account the update algorithm
-        train_fn = theano.function(inputs=input_list,
-              outputs=self.finetune_cost,
-              updates=mod_updates,
-              givens={
-                self.x: train_set_x[index * batch_size:
-                                    (index + 1) * batch_size]})
-
-        valid_score_i = theano.function([index], self.errors,
-              givens={
-                 self.x: valid_set_x[index * batch_size:
-                                     (index + 1) * batch_size]})
-
-        # Create a function that scans the entire validation set
-        def valid_score():
-            return [valid_score_i(i) for i in xrange(n_valid_batches)]
-
-        return train_fn, valid_score        
+            return self.sgd_adagrad_momentum_wd(momentum, learning_rate, weight_decay, gparams), [momentum,weight_decay]
     
     def build_encoding_functions(self, dataset):
         ''' Generates a function `encode` that feeds the data forward 
@@ -870,27 +1070,39 @@ class SdA(object):
                         input=layer_input,
                         n_visible=n_visible,
                         n_hidden=n_hidden,
-                        W=shared(value=dA_W_list[i],name=w_name),
-                        bhid=shared(value=dA_bhid_list[i],name=bhid_name),
-                        bvis=shared(value=dA_bvis_list[i],name=bvis_name)) 
+                        W=shared(value=np.asarray(dA_W_list[i], dtype=theano.config.floatX),name=w_name),
+                        bhid=shared(value=np.asarray(dA_bhid_list[i], dtype=theano.config.floatX),name=bhid_name),
+                        bvis=shared(value=np.asarray(dA_bvis_list[i], dtype=theano.config.floatX),name=bvis_name)) 
                 
             self.dA_layers.append(dA_layer)
             self.params.extend(self.dA_layers[i].params)
             
-        # Reconstruct the dictionary of shared vars for parameter updates 
-        # so we can use momentum when training.
-        self.updates = {}
-        for param in self.params:
-            init = np.zeros(param.get_value(borrow=True).shape,
-                            dtype=theano.config.floatX)
-            update_name = param.name + '_update'
-            self.updates[param] = theano.shared(init, name=update_name)
-            
-        # Reconstruct the finetuning cost functions
+        # The momentum / adagrad buffers in self.updates and the cost graphs are only needed for training,
+        # so they are built on first use by __getattr__.  A model loaded only to encode data never builds them.
         if n_outs > 0:
             self.reconstruct_loglayer(n_outs)
-        else:
+
+    def __getattr__(self, name):
+        """ Build the attributes that __setstate__ leaves out, when they are first asked for:
+        self.updates (the shared vars for parameter updates, so we can use momentum when training),
+        self.loss, self.output (the encoding of self.x) and the finetuning cost graphs. """
+        if name == 'updates':
+            self.updates = {}
+            for param in self.params:
+                init = np.zeros(param.get_value(borrow=True).shape,
+                                dtype=theano.config.floatX)
+                update_name = param.name + '_update'
+                self.updates[param] = theano.shared(init, name=update_name)
+        elif name == 'loss':
+            loss_dict = {'squared': self.squared_loss, 'xent': self.xent_loss, 'softplus': self.softplus_loss}
+            self.loss = loss_dict[self.use_loss]
+        elif name == 'output':
+            self.output = self.encode(self.x)
+        elif name in ('finetune_cost', 'errors'):
             self.finish_sda_unsupervised()
+        else:
+            raise AttributeError(name)
+        return self.__dict__[name]
 
    
 #################### Legacy code below: logistic layer top for SdA that were intended for dual MLP
@@ -0,0 +1,118 @@
+""" Checkpoints of an SdA during finetuning.  A checkpoint holds the parameters of the SdA, the momentum or
+adagrad buffers of its updates, the parameters that gave the best validation score so far, and the counters of
+the training loop (epoch, patience, learning rate, ...), as the arrays of an uncompressed .npz file.
+
+Checkpoints are written by a background thread, so the training loop only pays for copying the parameters.
+Each is written to a temporary file, which is then renamed over the last checkpoint, so a job killed while
+writing leaves the last complete checkpoint in place. """
+
+import os
+import threading
+import Queue as queue
+
+import numpy as np
+
+CHECKPOINT_VERSION = 1
+
+
+def snapshot(sda, best_params=None, **counters):
+    """ Return a copy of the training state of the SdA as a dict of arrays, ready to be written by a
+    Checkpointer.
+
+    :type sda: SdA
+    :param sda: the model being trained
+
+    :type best_params: list of numpy.ndarray
+    :param best_params: the values of sda.params with the best validation score so far, if any
+
+    :param counters: the scalar state of the training loop, e.g epoch=3, patience=1000
+    """
+    state = {'version': np.asarray(CHECKPOINT_VERSION)}
+    for i, param in enumerate(sda.params):
+        state['param_%d' % i] = param.get_value()
+        if param in sda.updates:
+            state['update_%d' % i] = sda.updates[param].get_value()
+        if best_params is not None:
+            state['best_%d' % i] = np.array(best_params[i])
+    for name, value in counters.items():
+        state['counter_' + name] = np.asarray(value)
+    return state
+
+
+def write_atomically(path, write):
+    """ Call write(f) on a temporary file next to path, then rename it to path """
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    f = open(tmp_path, 'wb')
+    try:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.rename(tmp_path, path)
+
+
+def write_checkpoint(path, state):
+    """ Write the state returned by snapshot to path, atomically """
+    write_atomically(path, lambda f: np.savez(f, **state))
+
+
+def load_checkpoint(sda, path):
+    """ Restore the parameters and update buffers of the SdA from the checkpoint at path.  Returns a dict
+    of the counters of the checkpoint, with the best parameters (or None) under 'best_params'. """
+    state = np.load(path)
+    if int(state['version']) != CHECKPOINT_VERSION:
+        raise ValueError('checkpoint ' + path + ' has version ' + str(state['version']) + ', expected ' + str(CHECKPOINT_VERSION))
+    best_params = []
+    for i, param in enumerate(sda.params):
+        value = state['param_%d' % i]
+        if value.shape != param.get_value(borrow=True).shape:
+            raise ValueError('checkpoint ' + path + ' does not match the model: parameter ' + str(param.name) + ' has shape ' + str(value.shape))
+        param.set_value(value.astype(param.dtype))
+        if param in sda.updates and 'update_%d' % i in state.files:
+            sda.updates[param].set_value(state['update_%d' % i].astype(param.dtype))
+        if 'best_%d' % i in state.files:
+            best_params.append(state['best_%d' % i].astype(param.dtype))
+    counters = dict((name[len('counter_'):], state[name].item()) for name in state.files if name.startswith('counter_'))
+    counters['best_params'] = best_params if best_params else None
+    state.close()
+    return counters
+
+
+class Checkpointer(object):
+
+    def __init__(self, path):
+        """ Write checkpoints to path from a background thread.  Only one checkpoint waits to be written at
+        a time; save blocks while an older one is still waiting.
+
+        :type path: string
+        :param path: the checkpoint file, conventionally the model's pickle file name with .ckpt.npz added
+        """
+        self.path = path
+        self.pending = queue.Queue(maxsize=1)
+        self.error = None
+        self.writer = threading.Thread(target=self._write_all)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def _write_all(self):
+        for state in iter(self.pending.get, None):
+            try:
+                write_checkpoint(self.path, state)
+            except Exception as e:
+                self.error = e
+
+    def _check(self):
+        if self.error is not None:
+            raise IOError('could not write checkpoint ' + self.path + ': ' + str(self.error))
+
+    def save(self, state):
+        """ Queue the state returned by snapshot to be written """
+        self._check()
+        self.pending.put(state)
+
+    def close(self):
+        """ Wait for the last checkpoint to be written """
+        self.pending.put(None)
+        self.writer.join()
+        self._check()
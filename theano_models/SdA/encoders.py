@@ -0,0 +1,213 @@
+""" Encoders that feed data forward through a trained SdA, producing the representation of the highest
+(i.e lowest dimensional) layer.  CompiledEncoder imports theano only when it is built, so that the
+importing script may first bind a GPU; SdAEncoder does not use theano at all. """
+
+import os
+import sys
+import cPickle
+
+import numpy as np
+
+from scheduler import THREAD_VARS
+
+
+class CompiledEncoder(object):
+
+    def __init__(self, sda_model, n_features, slab_size=20000):
+        """ Compile the encoding function of an SdA once, against a fixed capacity shared buffer, and
+        reuse it for every array to be encoded by swapping the buffer contents.  Arrays with more rows
+        than the buffer are encoded in slabs, so memory stays bounded regardless of the array size.
+
+        :type sda_model: SdA
+        :param sda_model: a trained (e.g unpickled) SdA model
+
+        :type n_features: int
+        :param n_features: the number of columns in the data to be encoded
+
+        :type slab_size: int
+        :param slab_size: the capacity of the buffer, in rows
+        """
+        import theano
+
+        self.slab_size = slab_size
+        self.dtype = theano.config.floatX
+        self.n_outs = sda_model.dA_layers[-1].n_hidden
+
+        self.slab = np.zeros((slab_size, n_features), dtype=self.dtype)
+        self.buffer = theano.shared(self.slab, borrow=True)
+        self.encode_fn = sda_model.build_encoding_functions(dataset=self.buffer)
+
+    def encode(self, data):
+        """ Return the encoding of each row of data, computed one slab at a time.
+
+        :type data: numpy ndarray
+        :param data: the (already scaled) data to be encoded
+        """
+        reduced_data = np.empty((data.shape[0], self.n_outs), dtype=self.dtype)
+        for start in xrange(0, data.shape[0], self.slab_size):
+            end = min(start + self.slab_size, data.shape[0])
+            self.slab[:end - start] = data[start:end]
+            self.buffer.set_value(self.slab, borrow=True)
+            reduced_data[start:end] = self.encode_fn(start=0, end=end - start)
+        return reduced_data
+
+
+class SdAEncoder(object):
+
+    def __init__(self, W_list, bhid_list, layer_types, dtype=np.float32, batch_size=10000, n_threads=None):
+        """ Feed data forward through a trained SdA using only numpy.  No symbolic graph is built
+        and nothing is compiled, so this needs neither theano nor a compiler.
+
+        :type W_list: list of numpy ndarrays
+        :param W_list: the weight matrix of each dA layer, shaped (n_visible, n_hidden)
+
+        :type bhid_list: list of numpy ndarrays
+        :param bhid_list: the hidden unit bias of each dA layer
+
+        :type layer_types: list of string
+        :param layer_types: the type of each dA layer: 'gaussian', 'bernoulli' or 'relu'
+
+        :type dtype: numpy dtype
+        :param dtype: the dtype in which to store the weights and compute the encoding
+
+        :type batch_size: int
+        :param batch_size: encode at most this many rows at once, to bound the memory used by
+                           the hidden layer activations
+
+        :type n_threads: int
+        :param n_threads: if given, limit the number of BLAS threads used to this many
+        """
+        assert len(W_list) == len(bhid_list) == len(layer_types)
+
+        self.dtype = dtype
+        self.batch_size = batch_size
+        self.layer_types = [lt.lower() for lt in layer_types]
+        self.W_list = [np.ascontiguousarray(W, dtype=dtype) for W in W_list]
+        self.bhid_list = [np.asarray(b, dtype=dtype) for b in bhid_list]
+        self.n_outs = self.W_list[-1].shape[1]
+
+        activations = {'gaussian': sigmoid, 'bernoulli': sigmoid, 'relu': relu}
+        for lt in self.layer_types:
+            if lt not in activations:
+                raise ValueError('incompatible layer type specified : ' + lt)
+        self.activations = [activations[lt] for lt in self.layer_types]
+
+        if n_threads is not None:
+            self.thread_limits = limit_blas_threads(n_threads)
+
+    @classmethod
+    def from_state(cls, state, **kwargs):
+        """ Build an encoder from the tuple returned by SdA.__getstate__ """
+        (layers, n_outs, W_list, bhid_list, bvis_list, corruption_levels, layer_types, use_loss, dropout_rates, opt_method) = state
+        return cls(W_list, bhid_list, layer_types, **kwargs)
+
+    @classmethod
+    def from_pickle(cls, filename, **kwargs):
+        """ Build an encoder from a pickled SdA, without calling SdA.__setstate__ """
+        return cls.from_state(read_pickle_state(filename), **kwargs)
+
+    @classmethod
+    def from_file(cls, filename, **kwargs):
+        """ Build an encoder from either an SdA model file or a pickled SdA """
+        from model_format import is_model_file
+        if is_model_file(filename):
+            return cls.from_model_file(filename, **kwargs)
+        return cls.from_pickle(filename, **kwargs)
+
+    @classmethod
+    def from_model_file(cls, filename, **kwargs):
+        """ Build an encoder from an SdA model file (see model_format), reading only W and bhid of each layer """
+        from model_format import ModelFile
+        model_file = ModelFile(filename)
+        layers = [model_file.layer(i) for i in xrange(model_file.n_layers)]
+        return cls([l[0] for l in layers], [l[1] for l in layers], model_file.layer_types, **kwargs)
+
+    @classmethod
+    def from_npz(cls, filename, **kwargs):
+        """ Build an encoder from the .npz file written by save_npz """
+        archive = np.load(filename)
+        layer_types = [str(lt) for lt in archive['layer_types']]
+        W_list = [archive['W_%d' % i] for i in xrange(len(layer_types))]
+        bhid_list = [archive['bhid_%d' % i] for i in xrange(len(layer_types))]
+        archive.close()
+        return cls(W_list, bhid_list, layer_types, **kwargs)
+
+    def save_npz(self, filename):
+        """ Export the encoding half of the model (layer types, W and bhid of each layer) to an .npz file """
+        arrays = {'layer_types': np.asarray(self.layer_types)}
+        for i, (W, bhid) in enumerate(zip(self.W_list, self.bhid_list)):
+            arrays['W_%d' % i] = W
+            arrays['bhid_%d' % i] = bhid
+        np.savez(filename, **arrays)
+
+    def get_hidden_values(self, i, data):
+        """ Compute the values of the hidden layer of dA layer i, given its input """
+        hidden = np.dot(data, self.W_list[i])
+        hidden += self.bhid_list[i]
+        return self.activations[i](hidden)
+
+    def encode(self, data):
+        """ Return the encoding of each row of data, computed in batches of at most self.batch_size rows.
+
+        :type data: numpy ndarray
+        :param data: the (already scaled) data to be encoded
+        """
+        reduced_data = np.empty((data.shape[0], self.n_outs), dtype=self.dtype)
+        for start in xrange(0, data.shape[0], self.batch_size):
+            end = min(start + self.batch_size, data.shape[0])
+            X_prime = np.asarray(data[start:end], dtype=self.dtype)
+            for i in xrange(len(self.W_list)):
+                X_prime = self.get_hidden_values(i, X_prime)
+            reduced_data[start:end] = X_prime
+        return reduced_data
+
+
+def sigmoid(X):
+    """ Apply the logistic sigmoid to X in place """
+    with np.errstate(over='ignore'):
+        np.negative(X, out=X)
+        np.exp(X, out=X)
+    X += 1
+    np.reciprocal(X, out=X)
+    return X
+
+
+def relu(X):
+    """ Apply ReLU to X in place """
+    np.maximum(X, 0, out=X)
+    return X
+
+
+def limit_blas_threads(n_threads):
+    """ Limit the number of threads used by BLAS.  This uses threadpoolctl if it is installed, otherwise it
+    sets the usual environment variables, which only affect BLAS libraries loaded later (e.g in a
+    child process). """
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        for var in THREAD_VARS:
+            os.environ[var] = str(n_threads)
+        return None
+    return threadpool_limits(limits=n_threads, user_api='blas')
+
+
+class _SdAState(object):
+    """ Stands in for the SdA class when unpickling, to capture the state without rebuilding the model """
+    def __setstate__(self, state):
+        self.state = state
+
+
+def read_pickle_state(filename):
+    """ Return the state tuple (as returned by SdA.__getstate__) of a pickled SdA, without importing theano """
+    def find_global(module, name):
+        if name == 'SdA':
+            return _SdAState
+        __import__(module)
+        return getattr(sys.modules[module], name)
+
+    f = file(filename, 'rb')
+    unpickler = cPickle.Unpickler(f)
+    unpickler.find_global = find_global
+    sda_state = unpickler.load()
+    f.close()
+    return sda_state.state
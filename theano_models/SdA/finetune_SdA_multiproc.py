@@ -1,9 +1,9 @@
-""" SdA finetuning script that uses two GPUs, one per sub-process,
-via the Python multiprocessing module.  """
+""" SdA finetuning script that runs each model in its own sub-process, on a GPU or on the
+CPU, via the Python multiprocessing module (see scheduler.py).  """
 
 
 # These imports will not trigger any theano GPU binding, so are safe to sit here.
-from multiprocessing import Process, Manager
+from multiprocessing import Manager
 from optparse import OptionParser
 import os, re
 
@@ -12,9 +12,14 @@ import time
 
 import numpy
 
-from extract_datasets import extract_unlabeled_chunkrange
-from load_shared import load_data_unlabeled
-from common_utils import extract_arch, parse_dropout, write_metadata
+from chunk_stream import ChunkStream
+from streaming_scaler import load_scaler
+from data_cache import load_window, open_cache
+from batch_sampler import BatchSampler, chunk_rows
+from common_utils import extract_arch, parse_dropout, use_compile_cache, write_metadata, BufferedLog, batch_blocks
+from scheduler import add_scheduler_options, read_job_specs, restart_with_thread_limit, run_jobs
+from schedules import add_schedule_options, training_schedule, SCHEDULE_OPTIONS
+from model_format import load_model, save_model
 from tables import openFile
 
 from datetime import datetime
@@ -33,17 +38,25 @@ def finetune_SdA(shared_args, private_args):
     
     """
     
-    # Import sandbox.cuda to bind the specified GPU to this subprocess
+    shared_args_dict = shared_args[0]
+    
+    # each model may read its own window of the data
+    offset = private_args.get('offset', shared_args_dict['offset'])
+    
+    # Share compiled modules with the other jobs, if asked (must precede the theano imports)
+    use_compile_cache(shared_args_dict['compile_cache'])
+    
+    # Import sandbox.cuda to bind the specified GPU to this subprocess (unless it runs on a cpu slot)
     # then import the remaining theano and model modules.
-    import theano.sandbox.cuda
-    theano.sandbox.cuda.use(private_args['gpu'])
+    if private_args['gpu'].startswith('gpu'):
+        import theano.sandbox.cuda
+        theano.sandbox.cuda.use(private_args['gpu'])
     
     import theano
     import theano.tensor as T
     
     from SdA import SdA    
-    
-    shared_args_dict = shared_args[0]
+    from checkpoint import Checkpointer, load_checkpoint, snapshot
     
     current_dir = os.getcwd()    
     os.chdir(shared_args_dict['dir'])
@@ -51,36 +64,72 @@ def finetune_SdA(shared_args, private_args):
     day = str(today.date())
     hour = str(today.time())   
     output_filename = "finetune_sda_" + private_args['arch'] + "." + day + "." + hour
-    output_file = open(output_filename,'w')
+    output_file = BufferedLog(open(output_filename,'w'))
     os.chdir(current_dir)    
     print >> output_file, "Run on " + str(datetime.now())    
     
+    # Scale with the statistics precomputed over the whole input file, if given
+    scaler = load_scaler(shared_args_dict['scaler'])
+    cache = open_cache(shared_args_dict['cache_dir'], shared_args_dict['cache_size'])
+    
     # Get the training and validation data samples from the input file
     data_set_file = openFile(str(shared_args_dict['input']), mode = 'r')
-    datafiles = extract_unlabeled_chunkrange(data_set_file, num_files = 30, offset = shared_args_dict['offset'])
-    if datafiles is None:
-        print("No data was returned, exiting.")
-        data_set_file.close()
-        output_file.close()
-        return
+    num_files = shared_args_dict['num_files']
+    if num_files is None:
+        if shared_args_dict['stream']:
+            # hold back the last 5 chunks for validation
+            num_files = len(data_set_file.listNodes("/recarrays", classname='Array')) - offset - 5
+        else:
+            num_files = 30
+            
+    if shared_args_dict['stream']:
+        # Stream the training chunks through a swappable shared buffer, keep the file open until training is done
+        stream = ChunkStream(data_set_file, offset = offset, num_files = num_files, dtype = theano.config.floatX, scaler = scaler)
+        train_set_x = stream.shared_buffer()
+        n_train_batches = stream.n_batches(shared_args_dict['batch_size'])
+    else:
+        datafiles = load_window(data_set_file, num_files = num_files, offset = offset, dtype = theano.config.floatX, scaler = scaler, cache = cache)
+        if datafiles is None:
+            print("No data was returned, exiting.")
+            data_set_file.close()
+            output_file.close()
+            return
+        
+        stream = None
+        train_set_x = theano.shared(datafiles, borrow = True)
+        strata = chunk_rows(data_set_file, num_files, offset)
+        
+    validation_datafiles = load_window(data_set_file, num_files = 5, offset = offset + num_files, dtype = theano.config.floatX, scaler = scaler, cache = cache)
+    valid_set_x = theano.shared(validation_datafiles, borrow = True)    
     
-    train_set_x = load_data_unlabeled(datafiles)
-    validation_datafiles = extract_unlabeled_chunkrange(data_set_file, num_files = 5, offset = shared_args_dict['offset'] + 30)
-    valid_set_x = load_data_unlabeled(validation_datafiles)    
-    data_set_file.close()
+    if stream is None:
+        data_set_file.close()
 
-    # compute number of minibatches for training, validation and testing
-    n_train_batches, n_features = train_set_x.get_value(borrow=True).shape
-    n_train_batches /= shared_args_dict['batch_size']
+        # compute number of minibatches for training, validation and testing
+        n_train_batches, n_features = train_set_x.get_value(borrow=True).shape
+        n_train_batches /= shared_args_dict['batch_size']
+    
+    # Draw the minibatches in a new random order each epoch, optionally in proportion to the chunks of the file
+    if shared_args_dict['shuffle'] is not None:
+        sampler = BatchSampler(len(datafiles), strata if shared_args_dict['shuffle'] == 'plates' else None)
+        perm = sampler.shared_permutation()
+    else:
+        sampler = None
+        perm = None
     
     print >> output_file, 'Unpickling the model from %s ...' % (private_args['restore'])        
-    f = file(private_args['restore'], 'rb')
-    sda_model = cPickle.load(f)
-    f.close()        
+    sda_model = load_model(private_args['restore'])
+    
+    # Pick up from the last checkpoint of this model, if asked (before the training functions take the parameters)
+    checkpoint_file = private_args['save'] + '.ckpt.npz'
+    resume_state = None
+    if shared_args_dict['resume'] and os.path.exists(checkpoint_file):
+        print >> output_file, 'Resuming from the checkpoint %s ...' % (checkpoint_file)
+        resume_state = load_checkpoint(sda_model, checkpoint_file)
     
     print '... writing meta-data to output file'
     metadict = {'n_train_batches': n_train_batches}
-    metadict = dict(metadict.items() + shared_args_dict.items())
+    metadict = dict(metadict.items() + shared_args_dict.items() + [('offset', offset)])
     write_metadata(output_file, metadict)
       
     ########################
@@ -90,11 +139,19 @@ def finetune_SdA(shared_args, private_args):
     # get the training, validation function for the model
     datasets = (train_set_x,valid_set_x)
     
+    # Set the initial value of the learning rate.  This is a shared variable in floatX, so the training
+    # functions follow its decay (and the value restored on resume), and it does not upcast the updates.
+    learning_rate = theano.shared(numpy.asarray(shared_args_dict['finetune_lr'], 
+                                                 dtype=theano.config.floatX)) 
+    
     print '... getting the finetuning functions'
     train_fn, validate_model = sda_model.build_finetune_full_reconstruction(
                 datasets=datasets, batch_size=shared_args_dict['batch_size'],
-                learning_rate=shared_args_dict['finetune_lr'],
-                method=shared_args_dict['sgd'])
+                learning_rate=learning_rate,
+                method=shared_args_dict['sgd'],
+                fused=shared_args_dict['fuse'] > 1,
+                n_workers=shared_args_dict['dp_workers'],
+                perm=perm)
 
     print '... fine-tuning the model'    
 
@@ -112,46 +169,89 @@ def finetune_SdA(shared_args, private_args):
 
     best_params = None
     best_validation_loss = numpy.inf
+    best_iter = 0
     done_looping = False
     epoch = 0
     
-    # Set the initial value of the learning rate
-    learning_rate = theano.shared(numpy.asarray(shared_args_dict['finetune_lr'], 
-                                                 dtype=theano.config.floatX)) 
+    # Schedule the learning rate of each epoch, and the momentum of each minibatch
+    schedule = training_schedule(learning_rate, shared_args_dict, shared_args_dict['finetune_lr'], shared_args_dict['finetuning_epochs'])
+    
+    if resume_state is not None:
+        epoch = resume_state['epoch']
+        patience = resume_state['patience']
+        best_validation_loss = resume_state['best_validation_loss']
+        best_iter = resume_state['best_iter']
+        best_params = resume_state['best_params']
+        schedule.restore(resume_state)
+        print >> output_file, 'Resumed after epoch %i, best validation error %f ' % (epoch, best_validation_loss)
     
-    # Function to decrease the learning rate
-    decay_learning_rate = theano.function(inputs=[], outputs=learning_rate,
-                    updates={learning_rate: learning_rate * shared_args_dict['lr_decay']})    
+    # Checkpoints are written in the background, at the end of an epoch
+    checkpointer = Checkpointer(checkpoint_file)
     
     # Use weight decay?
     use_wd = shared_args_dict['sgd'].endswith('wd')
     
     start_time = time.clock()
+    
+    # the minibatches of the current epoch; unset if a resumed run has no epochs left
+    batches = None
 
     while (epoch < shared_args_dict['finetuning_epochs']) and (not done_looping):
         epoch = epoch + 1
+        schedule.start_epoch(epoch - 1)
+        if sampler is not None:
+            sampler.shuffle()
         
-        for minibatch_index in xrange(n_train_batches):
-            # Calculate momentum value
-            t = (epoch - 1) * n_train_batches + minibatch_index          
-                
+        # run the minibatches in blocks of fuse per call; the costs come back as a vector
+        fuse = shared_args_dict['fuse']
+        if stream is not None:
+            if fuse > 1:
+                batches = stream.batch_blocks(train_set_x, shared_args_dict['batch_size'], fuse)
+            else:
+                batches = stream.batch_indices(train_set_x, shared_args_dict['batch_size'])
+        else:
+            if fuse > 1:
+                batches = batch_blocks(n_train_batches, fuse)
+            else:
+                batches = xrange(n_train_batches)
+        
+        minibatch_index = -1
+        epoch_cost = 0.0
+        improved = False
+        for batch_index in batches:
+            # the momentum for the first minibatch of this block
+            momentum = schedule.momentum((epoch - 1) * n_train_batches + minibatch_index + 1)
             if use_wd:
-                minibatch_avg_cost = train_fn(minibatch_index, shared_args_dict['momentum'], shared_args_dict['weight_decay'])
+                sgd_args = (momentum, shared_args_dict['weight_decay'])
             else:
-                minibatch_avg_cost = train_fn(minibatch_index, shared_args_dict['momentum'])
+                sgd_args = (momentum,)
             
-            # DEBUG: monitor the training error
-            print >> output_file, ('epoch %i, minibatch %i/%i, training error %f ' %
+            if fuse > 1:
+                costs = train_fn(batch_index, *sgd_args)
+            else:
+                costs = [train_fn(batch_index, *sgd_args)]
+            minibatch_index += len(costs)
+            minibatch_avg_cost = numpy.mean(costs)
+            epoch_cost += numpy.sum(costs)
+            
+            # monitor the training error, at most every few seconds
+            output_file.progress('epoch %i, minibatch %i/%i, training error %f ' %
                     (epoch, minibatch_index + 1, n_train_batches,
                     minibatch_avg_cost))                 
+            
+            # the iteration count of the last minibatch, and of the first in this block
+            t = (epoch - 1) * n_train_batches + minibatch_index
+            t_first = t - len(costs) + 1
 
-            if (t + 1) % validation_frequency == 0:               
+            # validate if a multiple of validation_frequency minibatches was reached in this block
+            if (t + 1) / validation_frequency > t_first / validation_frequency:
                 validation_losses = validate_model()
                 this_validation_loss = numpy.mean(validation_losses)
                 
                 print >> output_file, ('epoch %i, minibatch %i/%i, validation error %f ' %
                       (epoch, minibatch_index + 1, n_train_batches,
                        this_validation_loss))
+                schedule.observe(this_validation_loss)
 
                 # if we got the best validation score until now
                 if this_validation_loss < best_validation_loss:
@@ -165,17 +265,41 @@ def finetune_SdA(shared_args, private_args):
                     best_validation_loss = this_validation_loss
                     best_iter = t
                     
-                    # save best model that achieved this best loss    
-                    print >> output_file, 'Pickling the model...'          
-                    f = file(private_args['save'], 'wb')
-                    cPickle.dump(sda_model, f, protocol=cPickle.HIGHEST_PROTOCOL)
-                    f.close()                    
+                    # keep a copy of the parameters that achieved this best loss
+                    best_params = [param.get_value() for param in sda_model.params]
+                    improved = True
                     
             if patience <= t:
                 done_looping = True
                 break
+        
+        print >> output_file, 'epoch %i, mean training error %f ' % (epoch, epoch_cost / (minibatch_index + 1))
+        
+        # checkpoint whenever the best model improves, and every few epochs
+        if improved or epoch % shared_args_dict['checkpoint_every'] == 0:
+            checkpointer.save(snapshot(sda_model, best_params, epoch=epoch, patience=patience, 
+                                       best_validation_loss=best_validation_loss, best_iter=best_iter,
+                                       learning_rate=learning_rate.get_value(), **schedule.state()))
 
     end_time = time.clock()
+    checkpointer.close()
+    
+    if shared_args_dict['dp_workers'] > 1:
+        train_fn.close()
+    
+    # save the model with the best validation score
+    if best_params is not None:
+        for param, value in zip(sda_model.params, best_params):
+            param.set_value(value)
+    print >> output_file, 'Pickling the model...'          
+    output_file.flush()
+    save_model(sda_model, private_args['save'])
+    
+    if stream is not None:
+        if batches is not None:
+            batches.close()
+        data_set_file.close()
+    
     print >> output_file, (('Optimization complete with best validation score of %f ') %
                  (best_validation_loss))
     print >> output_file, ('The training code for file ' +
@@ -199,7 +323,26 @@ if __name__ == '__main__':
     parser.add_option("-m", "--momentum", dest="momentum", type=float, default=0.90, help="The auto-correlation coefficient for tracking the sum of squares of gradients for adagrad.")
     parser.add_option("-s", "--sgdflavour", dest="sgd", default="cm", help="Variant of SGD to employ.  Currently accepting cm, adagrad, adagrad_momentum, cm_wd, adagrad_momentum_wd." )
     parser.add_option("-w", "--weightdecay", dest = "weight_decay", type=float, default=0.0001, help="L2 weight decay penalty on layer params.")
+    parser.add_option("--numfiles", dest = "num_files", type = int, default = None, help = "train on this many data chunks from the offset; the next 5 are used for validation.  Defaults to 30, or to all but the last 5 chunks when streaming.")
+    parser.add_option("--stream", dest = "stream", action = "store_true", default = False, help = "stream the training chunks through a double-buffered shared variable instead of loading them all into memory")
+    parser.add_option("--scaler", dest = "scaler", default = None, help = "scale with the statistics saved by streaming_scaler.py (the .npz file, or the h5 file it sits next to) instead of scaling each data window separately")
+    parser.add_option("--cache_dir", dest = "cache_dir", default = None, help = "keep the scaled data windows in this directory (ideally on node-local disk), and map them from there in later runs")
+    parser.add_option("--cache_size", dest = "cache_size", type = float, default = 50.0, help = "evict the least recently used windows to keep the cache under this many GB")
+    parser.add_option("--compile_cache", dest = "compile_cache", default = None, help = "keep theano's compiled modules in this directory, shared by all the jobs given it, so later jobs skip recompiling the modules any job has compiled")
+    parser.add_option("--fuse", dest = "fuse", type = int, default = 1, help = "run this many minibatches per call of the compiled training function (with theano.scan), to cut the per-call python overhead")
+    parser.add_option("--dp_workers", dest = "dp_workers", type = int, default = 1, help = "split each minibatch between this many CPU worker processes, which compute its gradient in parallel (synchronous data-parallel SGD; the batch size must be a multiple of this)")
+    parser.add_option("--checkpoint_every", dest = "checkpoint_every", type = int, default = 5, help = "checkpoint the model and the optimizer state every this many epochs, and whenever the validation error improves.  The checkpoint is written next to the saved model, with .ckpt.npz added")
+    parser.add_option("--resume", dest = "resume", action = "store_true", default = False, help = "resume each model from its last checkpoint, if it has one")
+    parser.add_option("--shuffle", dest = "shuffle", type = "choice", choices = ["rows", "plates"], default = None, help = "take the minibatches in a new random order each epoch, gathering the rows by index rather than copying the data.  'rows' shuffles all the rows, 'plates' draws each minibatch from every data chunk in proportion to its size.  Cannot be used with --stream.")
+    add_schedule_options(parser, lr_schedule='constant', lr_decay=0.99, max_momentum=0.9)
+    add_scheduler_options(parser)
     (options, args) = parser.parse_args()    
+    restart_with_thread_limit(options.threads)
+    
+    if options.dp_workers > 1 and (options.stream or options.fuse > 1):
+        parser.error("--dp_workers needs the training data in memory, and one minibatch per call: it cannot be combined with --stream or --fuse")
+    if options.shuffle is not None and options.stream:
+        parser.error("--shuffle needs the training data in memory, it cannot be used with --stream")
     
     # Construct a dict of shared arguments that should be read by both processes
     manager = Manager()
@@ -210,46 +353,47 @@ if __name__ == '__main__':
     shared_args['dir'] = os.path.join(options.dir,options.extension)
     shared_args['input'] = options.inputfile
     shared_args['offset'] = options.offset
-    shared_args['momentum'] = 0.9
+    shared_args['cache_dir'] = options.cache_dir
+    shared_args['cache_size'] = options.cache_size
+    shared_args['compile_cache'] = options.compile_cache
+    shared_args['num_files'] = options.num_files
+    shared_args['stream'] = options.stream
+    shared_args['fuse'] = options.fuse
+    shared_args['dp_workers'] = options.dp_workers
+    shared_args['shuffle'] = options.shuffle
+    for name in SCHEDULE_OPTIONS:
+        shared_args[name] = getattr(options, name)
+    shared_args['checkpoint_every'] = options.checkpoint_every
+    shared_args['resume'] = options.resume
+    shared_args['scaler'] = options.scaler
     shared_args['weight_decay'] = options.weight_decay
     shared_args['sgd'] = options.sgd
     shared_args['finetune_lr'] = 0.00001
     shared_args['finetuning_epochs'] = 300
-    shared_args['lr_decay'] = 0.99
     shared_args['batch_size'] = 100   
     args[0] = shared_args
     
-    # Construct the specific args for each of the two processes
-    p_args = {}
-    q_args = {}
-       
-    p_args['gpu'] = 'gpu0'
-    q_args['gpu'] = 'gpu1'
+    # The models are given by their pickle files: either the two given on the command line, or those in the jobs file
+    if options.jobs is not None:
+        specs = read_job_specs(options.jobs)
+    else:
+        specs = [{'restore': options.pr_file}, {'restore': options.qr_file}]
     
     # Compile regular expression for extracting model architecture names
     model_name = re.compile(".*?_([\d_]+).pkl")    
-    p_args['arch'] = extract_arch(options.pr_file,model_name)
-    q_args['arch'] = extract_arch(options.qr_file,model_name)
-         
-    # Determine where to load & save the first model
     parts = os.path.split(options.dir)
-    pkl_load_file = os.path.join(parts[0],'pretrain_pkl_files',options.experiment,options.pr_file)
-    pkl_save_file = os.path.join(parts[0],'finetune_pkl_files',options.extension,options.pr_file)
-    p_args['restore'] = pkl_load_file
-    p_args['save'] = pkl_save_file
-   
-    # Determine where to load & save the second model
-    pkl_load_file = os.path.join(parts[0],'pretrain_pkl_files',options.experiment,options.qr_file)
-    pkl_save_file = os.path.join(parts[0],'finetune_pkl_files',options.extension,options.qr_file)
-    q_args['restore'] = pkl_load_file
-    q_args['save'] = pkl_save_file
-
-    # Run both sub-processes
-    p = Process(target=finetune_SdA, args=(args,p_args,))
-    q = Process(target=finetune_SdA, args=(args,q_args,))
-    p.start()
-    q.start()
-    p.join()
-    q.join()
-
     
+    jobs = []
+    for spec in specs:
+        if not spec.has_key('restore'):
+            parser.error("each model needs a restore file: " + str(spec))
+        job_args = dict(spec)
+        job_args['arch'] = extract_arch(spec['restore'],model_name)
+         
+        # Determine where to load & save the model
+        job_args['restore'] = os.path.join(parts[0],'pretrain_pkl_files',options.experiment,spec['restore'])
+        job_args['save'] = os.path.join(parts[0],'finetune_pkl_files',options.extension,spec['restore'])
+        jobs.append(job_args)
+
+    # Run the models on the slots, each in its own sub-process
+    run_jobs(finetune_SdA, args, jobs, options.devices.split(','), threads=options.threads, retries=options.retries)
@@ -1,9 +1,9 @@
-""" SdA hybrid pretraining script that uses two GPUs, one per sub-process,
-via the Python multiprocessing module.  """
+""" SdA hybrid pretraining script that runs each model in its own sub-process, on a GPU or on the
+CPU, via the Python multiprocessing module (see scheduler.py).  """
 
 
 # These imports will not trigger any theano GPU binding, so are safe to sit here.
-from multiprocessing import Process, Manager
+from multiprocessing import Manager
 from optparse import OptionParser
 import os
 
@@ -14,10 +14,15 @@ import time
 
 import numpy
 
-from extract_datasets import extract_unlabeled_chunkrange
-from load_shared import load_data_unlabeled
-from common_utils import get_arch_list, parse_layer_type, write_metadata
+from chunk_stream import ChunkStream
+from streaming_scaler import load_scaler
+from data_cache import load_window, open_cache
+from batch_sampler import BatchSampler, chunk_rows
+from common_utils import get_arch_list, parse_layer_type, use_compile_cache, write_metadata, BufferedLog, batch_blocks
 
+from scheduler import add_scheduler_options, read_job_specs, restart_with_thread_limit, run_jobs
+from schedules import add_schedule_options, training_schedule, SCHEDULE_OPTIONS
+from model_format import load_model, save_model
 from tables import openFile
 
 from datetime import datetime
@@ -34,18 +39,25 @@ def pretrain(shared_args, private_args):
     
     """
     
-    # Import sandbox.cuda to bind the specified GPU to this subprocess
+    shared_args_dict = shared_args[0]
+    
+    # each model may read its own window of the data
+    offset = private_args.get('offset', shared_args_dict['offset'])
+    
+    # Share compiled modules with the other jobs, if asked (must precede the theano imports)
+    use_compile_cache(shared_args_dict['compile_cache'])
+    
+    # Import sandbox.cuda to bind the specified GPU to this subprocess (unless it runs on a cpu slot)
     # then import the remaining theano and model modules.
-    import theano.sandbox.cuda
-    theano.sandbox.cuda.use(private_args['gpu'])
+    if private_args['gpu'].startswith('gpu'):
+        import theano.sandbox.cuda
+        theano.sandbox.cuda.use(private_args['gpu'])
     
     import theano
     import theano.tensor as T
     from theano.tensor.shared_randomstreams import RandomStreams
     from SdA import SdA    
     
-    shared_args_dict = shared_args[0]
-    
     current_dir = os.getcwd()    
     
     os.chdir(shared_args_dict['dir'])
@@ -57,29 +69,60 @@ def pretrain(shared_args, private_args):
     layer_types = parse_layer_type(shared_args_dict['layertype'], len(arch_list))    
     
     output_filename = "hybrid_pretraining_sda_" + "_".join(elem for elem in layer_types) + private_args['arch'] + "." + day + "." + hour
-    output_file = open(output_filename,'w')
+    output_file = BufferedLog(open(output_filename,'w'))
     os.chdir(current_dir)    
     print >> output_file, "Run on " + str(datetime.now())    
     
+    # Scale with the statistics precomputed over the whole input file, if given
+    scaler = load_scaler(shared_args_dict['scaler'])
+    cache = open_cache(shared_args_dict['cache_dir'], shared_args_dict['cache_size'])
+    
     # Get the training data sample from the input file
     data_set_file = openFile(str(shared_args_dict['input']), mode = 'r')
-    datafiles = extract_unlabeled_chunkrange(data_set_file, num_files = 30, offset = shared_args_dict['offset'])
-    if datafiles is None:
-            print("No data was returned, exiting.")
-            data_set_file.close()
-            output_file.close()
-            return    
-    
-    train_set_x = load_data_unlabeled(datafiles)
+    num_files = shared_args_dict['num_files']
+    if num_files is None:
+        if shared_args_dict['stream']:
+            # hold back the last 5 chunks for validation
+            num_files = len(data_set_file.listNodes("/recarrays", classname='Array')) - offset - 5
+        else:
+            num_files = 30
+    
+    if shared_args_dict['stream']:
+        # Stream the training chunks through a swappable shared buffer, keep the file open until training is done
+        stream = ChunkStream(data_set_file, offset = offset, num_files = num_files, dtype = theano.config.floatX, scaler = scaler)
+        train_set_x = stream.shared_buffer()
+        n_train_batches = stream.n_batches(shared_args_dict['batch_size'])
+        n_features = stream.n_features()
+    else:
+        datafiles = load_window(data_set_file, num_files = num_files, offset = offset, dtype = theano.config.floatX, scaler = scaler, cache = cache)
+        if datafiles is None:
+                print("No data was returned, exiting.")
+                data_set_file.close()
+                output_file.close()
+                return    
+        
+        stream = None
+        train_set_x = theano.shared(datafiles, borrow = True)
+        strata = chunk_rows(data_set_file, num_files, offset)
 
     # DEBUG: get validation set too
-    validation_datafiles = extract_unlabeled_chunkrange(data_set_file, num_files = 5, offset = shared_args_dict['offset'] + 30)
-    valid_set_x = load_data_unlabeled(validation_datafiles)      
-    data_set_file.close()
+    validation_datafiles = load_window(data_set_file, num_files = 5, offset = offset + num_files, dtype = theano.config.floatX, scaler = scaler, cache = cache)
+    valid_set_x = theano.shared(validation_datafiles, borrow = True)      
+    
+    if stream is None:
+        data_set_file.close()
 
-    # compute number of minibatches for training, validation and testing
-    n_train_batches, n_features = train_set_x.get_value(borrow=True).shape
-    n_train_batches /= shared_args_dict['batch_size']
+        # compute number of minibatches for training, validation and testing
+        n_train_batches, n_features = train_set_x.get_value(borrow=True).shape
+        n_train_batches /= shared_args_dict['batch_size']
+    
+    # Draw the minibatches in a new random order each epoch, optionally in proportion to the chunks of the file
+    if shared_args_dict['shuffle'] is not None:
+        sampler = BatchSampler(len(datafiles), strata if shared_args_dict['shuffle'] == 'plates' else None)
+        perm = sampler.shared_permutation()
+    else:
+        sampler = None
+        perm = None
     
     # numpy random generator
     numpy_rng = numpy.random.RandomState(89677)
@@ -95,9 +138,7 @@ def pretrain(shared_args, private_args):
         print >> output_file, 'Unpickling the model from %s ...' % (private_args['restore'])
         current_dir = os.getcwd()    
         os.chdir(shared_args_dict['dir'])         
-        f = file(private_args['restore'], 'rb')
-        sda_model = cPickle.load(f)
-        f.close()        
+        sda_model = load_model(private_args['restore'])
         os.chdir(current_dir)
     else:
         print '... building the model'  
@@ -119,13 +160,18 @@ def pretrain(shared_args, private_args):
     pretraining_fns = sda_model.pretraining_functions(train_set_x=train_set_x,
                                                 batch_size=shared_args_dict['batch_size'],
                                                 learning_rate=learning_rate,
-                                                method='cm')
+                                                method='cm',
+                                                cache_hidden=shared_args_dict['cache_hidden'],
+                                                hidden_dir=shared_args_dict['cache_dir'],
+                                                fused=shared_args_dict['fuse'] > 1,
+                                                perm=perm)
 
     print '... getting the hybrid training functions'
     hybrid_pretraining_fns = sda_model.build_finetune_limited_reconstruction(train_set_x=train_set_x, 
                                                                       batch_size=shared_args_dict['batch_size'], 
                                                                       learning_rate=learning_rate,
-                                                                      method='cm')
+                                                                      method='cm',
+                                                                      perm=perm)
     
     # DEBUG: get full finetuning theano function
     # get the training, validation function for the model
@@ -135,7 +181,9 @@ def pretrain(shared_args, private_args):
     finetune_train_fn, validate_model = sda_model.build_finetune_full_reconstruction(
                 datasets=datasets, batch_size=shared_args_dict['batch_size'],
                 learning_rate=learning_rate,
-                method='cm')    
+                method='cm',
+                fused=shared_args_dict['fuse'] > 1,
+                perm=perm)    
 
     
     # DEBUG: should only have n_layers - 2 hybrid pretraining functions
@@ -143,7 +191,7 @@ def pretrain(shared_args, private_args):
     
     print '... writing meta-data to output file'
     metadict = {'n_train_batches': n_train_batches}
-    metadict = dict(metadict.items() + shared_args_dict.items())
+    metadict = dict(metadict.items() + shared_args_dict.items() + [('offset', offset)])
     write_metadata(output_file, metadict)    
     
     print '... pre-training the model'
@@ -152,14 +200,8 @@ def pretrain(shared_args, private_args):
     # Get corruption levels from the SdA.  
     corruption_levels = sda_model.corruption_levels
     
-    # Function to decrease the learning rate
-    decay_learning_rate = theano.function(inputs=[], outputs=learning_rate,
-                updates={learning_rate: learning_rate * shared_args_dict['lr_decay']})  
-    
-    # Function to reset the learning rate
-    lr_val = T.scalar('original_lr')
-    reset_learning_rate = theano.function(inputs=[lr_val], outputs=learning_rate,
-                updates={learning_rate: lr_val})
+    # Schedule the learning rate and momentum of each layer's pretraining, and of the final finetuning
+    schedule = training_schedule(learning_rate, shared_args_dict, shared_args_dict['pretrain_lr'], shared_args_dict['pretraining_epochs'])
     
     # Set up functions for max norm regularization
     apply_max_norm_regularization = sda_model.max_norm_regularization()  
@@ -167,65 +209,120 @@ def pretrain(shared_args, private_args):
     for i in xrange(sda_model.n_layers):       
                 
         for epoch in xrange(shared_args_dict['pretraining_epochs']):
-            # go through the training set
+            schedule.start_epoch(epoch)
+            if sampler is not None:
+                sampler.shuffle()
+            
+            # go through the training set; t counts the updates of this layer, for the momentum schedule
             c = []
-            for batch_index in xrange(n_train_batches):
-                c.append(pretraining_fns[i](index=batch_index,
-                         corruption=corruption_levels[i],momentum=shared_args_dict['momentum']))
+            t = epoch * n_train_batches
+            fuse = shared_args_dict['fuse']
+            if fuse > 1:
+                # run the minibatches in blocks of fuse per call; the costs come back as a vector
+                if stream is not None:
+                    blocks = stream.batch_blocks(train_set_x, shared_args_dict['batch_size'], fuse)
+                else:
+                    blocks = batch_blocks(n_train_batches, fuse)
+                for block in blocks:
+                    c.extend(pretraining_fns[i](indices=block,
+                             corruption=corruption_levels[i],momentum=schedule.momentum(t)))
+                    t += len(block)
+            else:
+                if stream is not None:
+                    batches = stream.batch_indices(train_set_x, shared_args_dict['batch_size'])
+                else:
+                    batches = xrange(n_train_batches)
+                for batch_index in batches:
+                    c.append(pretraining_fns[i](index=batch_index,
+                             corruption=corruption_levels[i],momentum=schedule.momentum(t)))
+                    t += 1
                                 
             print >> output_file, 'Pre-training layer %i, epoch %d, cost ' % (i, epoch),
             print >> output_file, numpy.mean(c)
             print >> output_file, learning_rate.get_value(borrow=True)
-            decay_learning_rate()
+            
+            # there is no validation set for pretraining, so a plateau is judged on the training cost
+            schedule.observe(numpy.mean(c))
             apply_max_norm_regularization(norm_limit=shared_args_dict['maxnorm'])
         
         # Do hybrid pretraining only on the middle layer(s)
         if i > 0 and i < sda_model.n_layers - 1:
             for h_epoch in xrange(20):
                 hybrid_c = []
-                for batch_index in xrange(n_train_batches):
-                    hybrid_c.append(hybrid_pretraining_fns[i-1](index=batch_index,momentum=shared_args_dict['momentum']))  
+                if sampler is not None:
+                    sampler.shuffle()
+                if stream is not None:
+                    batches = stream.batch_indices(train_set_x, shared_args_dict['batch_size'])
+                else:
+                    batches = xrange(n_train_batches)
+                for batch_index in batches:
+                    hybrid_c.append(hybrid_pretraining_fns[i-1](index=batch_index,momentum=schedule.momentum(t)))  
+                    t += 1
                 print >> output_file, "Hybrid pre-training on layers %i and below, epoch %d, cost" % (i, h_epoch),
                 print >> output_file, numpy.mean(hybrid_c)
         
-        # Reset the learning rate
-        reset_learning_rate(numpy.asarray(shared_args_dict['pretrain_lr'], dtype=numpy.float32))
+        # Start the next layer's schedule from the pretraining learning rate
+        schedule.restart(shared_args_dict['pretrain_lr'])
         
         if private_args.has_key('save'):
             print >> output_file, 'Pickling the model...'
             current_dir = os.getcwd()    
             os.chdir(shared_args_dict['dir'])            
-            f = file(private_args['save'], 'wb')
-            cPickle.dump(sda_model, f, protocol=cPickle.HIGHEST_PROTOCOL)
-            f.close()
+            save_model(sda_model, private_args['save'])
             os.chdir(current_dir)
 
     print '... finetuning with final layer'
     best_validation_loss = numpy.inf
     for f_epoch in xrange(20):
-        for minibatch_index in xrange(n_train_batches):
-            minibatch_avg_cost = finetune_train_fn(minibatch_index, shared_args_dict['momentum'])
+        schedule.start_epoch(f_epoch)
+        if sampler is not None:
+            sampler.shuffle()
+        
+        # run the minibatches in blocks of fuse per call; the costs come back as a vector
+        fuse = shared_args_dict['fuse']
+        if stream is not None:
+            if fuse > 1:
+                batches = stream.batch_blocks(train_set_x, shared_args_dict['batch_size'], fuse)
+            else:
+                batches = stream.batch_indices(train_set_x, shared_args_dict['batch_size'])
+        else:
+            if fuse > 1:
+                batches = batch_blocks(n_train_batches, fuse)
+            else:
+                batches = xrange(n_train_batches)
+        
+        minibatch_index = -1
+        epoch_cost = 0.0
+        for batch_index in batches:
+            momentum = schedule.momentum(f_epoch * n_train_batches + minibatch_index + 1)
+            if fuse > 1:
+                costs = finetune_train_fn(batch_index, momentum)
+            else:
+                costs = [finetune_train_fn(batch_index, momentum)]
+            minibatch_index += len(costs)
+            epoch_cost += numpy.sum(costs)
                     
-            # DEBUG: monitor the training error
-            print >> output_file, ('Fine-tuning epoch %i, minibatch %i/%i, training error %f ' %
+            # monitor the training error, at most every few seconds
+            output_file.progress('Fine-tuning epoch %i, minibatch %i/%i, training error %f ' %
                     (f_epoch, minibatch_index + 1, n_train_batches,
-                    minibatch_avg_cost))            
+                    numpy.mean(costs)))
     
             # apply max-norm regularization
             apply_max_norm_regularization(shared_args_dict['maxnorm'])          
+        
+        print >> output_file, 'Fine-tuning epoch %i, mean training error %f ' % (f_epoch, epoch_cost / (minibatch_index + 1))
     
         # validate every epoch               
         validation_losses = validate_model()
         this_validation_loss = numpy.mean(validation_losses)
+        schedule.observe(this_validation_loss)
         
         # save best model that achieved this best loss  
         if this_validation_loss < best_validation_loss:  
             print >> output_file, 'Pickling the model...'  
             current_dir = os.getcwd()    
             os.chdir(shared_args_dict['dir'])            
-            f = file(private_args['save'], 'wb')
-            cPickle.dump(sda_model, f, protocol=cPickle.HIGHEST_PROTOCOL)
-            f.close()
+            save_model(sda_model, private_args['save'])
             os.chdir(current_dir)
             
         print >> output_file, ('epoch %i, minibatch %i/%i, validation error %f ' %
@@ -233,6 +330,9 @@ def pretrain(shared_args, private_args):
                this_validation_loss))        
 
     end_time = time.clock()
+    
+    if stream is not None:
+        data_set_file.close()
 
     print >> output_file, ('The hybrid training code for file ' +
                           os.path.split(__file__)[1] +
@@ -258,8 +358,24 @@ if __name__ == '__main__':
     parser.add_option("-n","--normlimit", dest = "norm_limit", type = float, default = 3.0, help = "limit the norm of each vector in each W matrix to norm_limit")
     parser.add_option("-m","--method", dest = "opt_method", default = 'CM', help = "Use either classical momentum (CM) or Nesterov's Accelerated gradient (NAG)")
     parser.add_option("-s","--sparsity", dest = "sparse_init", type = int, default = -1, help = "Controls the sparsity of initial connections.  Use -1 for dense init.")
-    
+    parser.add_option("--numfiles", dest = "num_files", type = int, default = None, help = "train on this many data chunks from the offset; the next 5 are used for validation.  Defaults to 30, or to all but the last 5 chunks when streaming.")
+    parser.add_option("--stream", dest = "stream", action = "store_true", default = False, help = "stream the training chunks through a double-buffered shared variable instead of loading them all into memory")
+    parser.add_option("--scaler", dest = "scaler", default = None, help = "scale with the statistics saved by streaming_scaler.py (the .npz file, or the h5 file it sits next to) instead of scaling each data window separately")
+    parser.add_option("--cache_dir", dest = "cache_dir", default = None, help = "keep the scaled data windows in this directory (ideally on node-local disk), and map them from there in later runs")
+    parser.add_option("--cache_size", dest = "cache_size", type = float, default = 50.0, help = "evict the least recently used windows to keep the cache under this many GB")
+    parser.add_option("--compile_cache", dest = "compile_cache", default = None, help = "keep theano's compiled modules in this directory, shared by all the jobs given it, so later jobs skip recompiling the modules any job has compiled")
+    parser.add_option("--cache_hidden", dest = "cache_hidden", action = "store_true", default = False, help = "train each layer above the first on the activations of the layer below, computed once per layer rather than for every minibatch.  Kept in --cache_dir if given, else in memory.  Cannot be used with --stream.")
+    parser.add_option("--fuse", dest = "fuse", type = int, default = 1, help = "run this many minibatches per call of the compiled pretraining and finetuning functions (with theano.scan), to cut the per-call python overhead.  The hybrid pretraining of the middle layers still runs one minibatch per call.")
+    parser.add_option("--shuffle", dest = "shuffle", type = "choice", choices = ["rows", "plates"], default = None, help = "take the minibatches in a new random order each epoch, gathering the rows by index rather than copying the data.  'rows' shuffles all the rows, 'plates' draws each minibatch from every data chunk in proportion to its size.  Cannot be used with --stream.")
+    
+    add_schedule_options(parser, lr_decay=0.98, max_momentum=0.8)
+    add_scheduler_options(parser)
     (options, args) = parser.parse_args()    
+    restart_with_thread_limit(options.threads)
+    if options.cache_hidden and options.stream:
+        parser.error("--cache_hidden cannot be used with --stream, the cached activations would go stale as the chunks are swapped")
+    if options.shuffle is not None and options.stream:
+        parser.error("--shuffle needs the training data in memory, it cannot be used with --stream")
     
     # Construct a dict of shared arguments that should be read by both processes
     manager = Manager()
@@ -269,11 +385,21 @@ if __name__ == '__main__':
     shared_args = args[0]
     shared_args['dir'] = options.dir
     shared_args['input'] = options.inputfile
-    shared_args['momentum'] = 0.8 # deprecated, should be max_momentum
     shared_args['weight_decay'] = 0.0
     shared_args['learning_rate'] = 0.0001 # initial learning rate that is then scheduled    
     shared_args['corruption'] = options.corruption
     shared_args['offset'] = options.offset
+    shared_args['cache_dir'] = options.cache_dir
+    shared_args['cache_size'] = options.cache_size
+    shared_args['compile_cache'] = options.compile_cache
+    shared_args['num_files'] = options.num_files
+    shared_args['stream'] = options.stream
+    shared_args['cache_hidden'] = options.cache_hidden
+    shared_args['shuffle'] = options.shuffle
+    shared_args['fuse'] = options.fuse
+    for name in SCHEDULE_OPTIONS:
+        shared_args[name] = getattr(options, name)
+    shared_args['scaler'] = options.scaler
     shared_args['layertype'] = options.layer_type
     shared_args['loss'] = options.loss
     shared_args['maxnorm'] = options.norm_limit
@@ -281,43 +407,29 @@ if __name__ == '__main__':
     shared_args['sparse_init'] = options.sparse_init
     shared_args['pretraining_epochs'] = 50
     shared_args['pretrain_lr'] = 0.000001
-    shared_args['lr_decay'] = 0.98
     shared_args['batch_size'] = 50
     
     args[0] = shared_args
     
-    # Construct the specific args for each of the two processes
-    p_args = {}
-    q_args = {}
-
-    # Determine where to save the model
-    if options.pr_file is not None:
-        # Save over the old restorefile
-        p_args['save'] = options.pr_file
-        p_args['restore'] = options.pr_file
-    else:
-        # Write to pkl file whose name derives from the specified architecture
-        savename = options.p_arch
-        p_args['save'] = "SdA_" + savename.replace('-','_') + ".pkl"
-            
-    if options.qr_file is not None:
-        q_args['save'] = options.qr_file
-        q_args['restore'] = options.qr_file
+    # Construct the specific args for each model: either the two given on the command line, or those in the jobs file
+    if options.jobs is not None:
+        specs = read_job_specs(options.jobs)
     else:
-        savename = options.q_arch
-        q_args['save'] = "SdA_" + savename.replace('-','_') + ".pkl"
-        
-    p_args['arch'] = options.p_arch
-    p_args['gpu'] = 'gpu0'
-    q_args['arch'] = options.q_arch
-    q_args['gpu'] = 'gpu1'
-
-    # Run both sub-processes
-    p = Process(target=pretrain, args=(args,p_args,))
-    q = Process(target=pretrain, args=(args,q_args,))
-    p.start()
-    q.start()
-    p.join()
-    q.join()
+        specs = [{'arch': options.p_arch, 'restore': options.pr_file}, {'arch': options.q_arch, 'restore': options.qr_file}]
+    
+    jobs = []
+    for spec in specs:
+        job_args = dict((key, value) for key, value in spec.items() if value is not None)
+        if not job_args.has_key('arch'):
+            parser.error("each model needs an arch: " + str(spec))
+        # Determine where to save the model
+        if job_args.has_key('restore'):
+            # Save over the old restorefile
+            job_args['save'] = job_args['restore']
+        else:
+            # Write to pkl file whose name derives from the specified architecture
+            job_args['save'] = "SdA_" + job_args['arch'].replace('-','_') + ".pkl"
+        jobs.append(job_args)
 
-    
+    # Run the models on the slots, each in its own sub-process
+    run_jobs(pretrain, args, jobs, options.devices.split(','), threads=options.threads, retries=options.retries)
@@ -12,8 +12,7 @@ import time
 
 import numpy
 
-from extract_datasets import extract_unlabeled_chunkrange
-from load_shared import load_data_unlabeled
+from data_cache import load_window, open_cache
 from common_utils import extract_arch, parse_dropout, write_metadata
 from tables import openFile
 
@@ -57,10 +56,11 @@ def finetune_SdA(shared_args, private_args, finetuning_epochs=300, batch_size=10
     
     # Get the training and validation data samples from the input file
     data_set_file = openFile(str(shared_args_dict['input']), mode = 'r')
-    datafiles = extract_unlabeled_chunkrange(data_set_file, num_files = 30, offset = shared_args_dict['offset'])
-    train_set_x = load_data_unlabeled(datafiles)
-    validation_datafiles = extract_unlabeled_chunkrange(data_set_file, num_files = 5, offset = shared_args_dict['offset'] + 30)
-    valid_set_x = load_data_unlabeled(validation_datafiles)    
+    cache = open_cache(shared_args_dict['cache_dir'], shared_args_dict['cache_size'])
+    datafiles = load_window(data_set_file, num_files = 30, offset = shared_args_dict['offset'], dtype = theano.config.floatX, cache = cache)
+    train_set_x = theano.shared(datafiles, borrow = True)
+    validation_datafiles = load_window(data_set_file, num_files = 5, offset = shared_args_dict['offset'] + 30, dtype = theano.config.floatX, cache = cache)
+    valid_set_x = theano.shared(validation_datafiles, borrow = True)    
     data_set_file.close()
 
     # compute number of minibatches for training, validation and testing
@@ -178,6 +178,8 @@ if __name__ == '__main__':
     parser.add_option("-t","--tag", dest="tag", help="identifies which hyperparam is being tested in this experiment.")
     parser.add_option("-n","--normlimit", dest = "norm_limit", type=float, default=3.0, help="limit the norm of each vector in each W matrix to norm_limit")
     parser.add_option("-u","--dropout", dest="dropout", default="none", help="A dash delimited string describing how dropout should be applied in finetuning, or 'none' for regular finetuning.")    
+    parser.add_option("--cache_dir", dest = "cache_dir", default = None, help = "keep the scaled data windows in this directory (ideally on node-local disk), and map them from there in later runs")
+    parser.add_option("--cache_size", dest = "cache_size", type = float, default = 50.0, help = "evict the least recently used windows to keep the cache under this many GB")
     (options, args) = parser.parse_args()    
     
     # Construct a dict of shared arguments that should be read by both processes
@@ -189,6 +191,8 @@ if __name__ == '__main__':
     shared_args['dir'] = options.dir
     shared_args['input'] = options.inputfile
     shared_args['offset'] = options.offset
+    shared_args['cache_dir'] = options.cache_dir
+    shared_args['cache_size'] = options.cache_size
     shared_args['momentum'] = options.momentum
     shared_args['weight_decay'] = options.weight_decay
     shared_args['learning_rate'] = options.learningrate
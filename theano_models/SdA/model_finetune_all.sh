@@ -1,22 +1,26 @@
 #!/bin/bash
 
 # Batch qsub submission script for model search over SdA layer sizes 
+# Lists every model in a jobs file, and submits a single job that finetunes them all, 
+# one model per GPU at a time (see scheduler.py)
 
 arr=(`ls $SCRATCH/gpu_tests/SdA_results/pretrain_control_vs_hybrid/hybrid/3_layers/pretrain_pkl_files/10/relu`)
 offset=0
 len=${#arr[*]}
+jobsfile=finetune_jobs.$$.txt
+> $jobsfile
 
-for((i=1; i<=$len; i+=2 ))
+for((i=0; i<$len; i++ ))
 do
-    let prev=$i-1
-    first=${arr[$i]}
-    second=${arr[$prev]}
-    qsub submit_finetune_gravity.sh -v FIRSTMODEL="$first",SECONDMODEL="$second",OFFSET="$offset"
-    ((offset+=5))
-    sleep 5
+    echo "restore=${arr[$i]} offset=$offset" >> $jobsfile
     
-    # Each pair of jobs needs 30 data chunks, and there are 211 in total.  Reset the offset parameter if necessary.
+    # Each pair of models moves on 5 data chunks; each needs 30 data chunks, and there are 211 in total.  Reset the offset parameter if necessary.
+    if (( i % 2 == 1 )); then
+       ((offset+=5))
+    fi
     if (( offset > 181 )); then 
        offset=0
     fi    
 done
+
+qsub submit_finetune_gravity.sh -v JOBS="$PWD/$jobsfile"
@@ -0,0 +1,200 @@
+#! /usr/bin/env python
+
+""" A compact, versioned file format for trained SdA models, in place of pickled SdA objects.
+
+A model file starts with the magic bytes 'SDAMODEL', the format version and the length of a JSON header,
+all little endian.  The header describes the model (layer types, corruption levels, loss, dropout rates, ...)
+and gives the dtype, shape and offset of each array.  The arrays follow the header, each starting on a 64
+byte boundary, so each one can be memory mapped on its own: a single layer can be read without reading the
+rest of the file.  The arrays are W_i, bhid_i and bvis_i for each layer i, stored in float32 by default, and
+optionally the optimizer state of each parameter (update_W_i, ...), i.e the momentum or adagrad buffers.
+
+Nothing here imports theano, except load_sda and save_sda which build or read an SdA object.
+
+Run as a script, this converts a pickled SdA to a model file or back, by the suffix of the output file:
+
+    model_format.py SdA_1000_400_20.pkl SdA_1000_400_20.sda
+    model_format.py SdA_1000_400_20.sda SdA_1000_400_20.pkl """
+
+import json
+import struct
+import sys
+import cPickle
+
+import numpy as np
+
+from checkpoint import write_atomically
+from encoders import read_pickle_state
+
+MAGIC = 'SDAMODEL'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+PARAM_NAMES = ['W', 'bhid', 'bvis']
+
+
+def _aligned(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def is_model_file(filename):
+    """ Return True if filename is a model file, False if it is something else (e.g a pickle) """
+    f = open(filename, 'rb')
+    magic = f.read(len(MAGIC))
+    f.close()
+    return magic == MAGIC
+
+
+def write_state(filename, state, dtype=np.float32, updates=None):
+    """ Write a model file from the state tuple of an SdA (as returned by SdA.__getstate__).
+
+    :type state: tuple
+    :param state: (n_layers, n_outs, W_list, bhid_list, bvis_list, corruption_levels, layer_types, loss, dropout_rates, opt_method)
+
+    :type dtype: numpy dtype
+    :param dtype: store the arrays in this dtype
+
+    :type updates: dict
+    :param updates: optional optimizer state, mapping array names (e.g 'W_0') to the buffer of that parameter
+    """
+    (n_layers, n_outs, W_list, bhid_list, bvis_list, corruption_levels, layer_types, loss, dropout_rates, opt_method) = state
+    arrays = []
+    for i in xrange(n_layers):
+        for name, value in zip(PARAM_NAMES, (W_list[i], bhid_list[i], bvis_list[i])):
+            arrays.append(('%s_%d' % (name, i), np.ascontiguousarray(value, dtype=dtype)))
+    if updates is not None:
+        for name, value in sorted(updates.items()):
+            arrays.append(('update_' + name, np.ascontiguousarray(value, dtype=dtype)))
+
+    # the offsets are relative to the start of the data, which follows the header on an aligned boundary
+    array_info = {}
+    offset = 0
+    for name, value in arrays:
+        array_info[name] = {'dtype': value.dtype.str, 'shape': list(value.shape), 'offset': offset}
+        offset = _aligned(offset + value.nbytes)
+    header = json.dumps({'n_layers': n_layers,
+                         'n_outs': n_outs,
+                         'corruption_levels': [float(c) for c in corruption_levels],
+                         'layer_types': [str(lt) for lt in layer_types],
+                         'loss': loss,
+                         'dropout_rates': None if dropout_rates is None else [float(d) for d in dropout_rates],
+                         'opt_method': opt_method,
+                         'arrays': array_info}, sort_keys=True)
+    preamble = MAGIC + struct.pack('<II', FORMAT_VERSION, len(header)) + header
+    data_start = _aligned(len(preamble))
+
+    def write(f):
+        f.write(preamble)
+        f.write('\0' * (data_start - len(preamble)))
+        for name, value in arrays:
+            position = data_start + array_info[name]['offset']
+            f.write('\0' * (position - f.tell()))
+            f.write(value.tostring())
+    write_atomically(filename, write)
+
+
+class ModelFile(object):
+
+    def __init__(self, filename):
+        """ Read the header of a model file.  Arrays are memory mapped when asked for, one at a time. """
+        self.filename = filename
+        f = open(filename, 'rb')
+        magic = f.read(len(MAGIC))
+        if magic != MAGIC:
+            f.close()
+            raise ValueError(filename + ' is not an SdA model file')
+        version, header_length = struct.unpack('<II', f.read(8))
+        if version > FORMAT_VERSION:
+            f.close()
+            raise ValueError(filename + ' has format version ' + str(version) + ', this code reads up to version ' + str(FORMAT_VERSION))
+        self.header = json.loads(f.read(header_length))
+        f.close()
+        self.version = version
+        self.data_start = _aligned(len(MAGIC) + 8 + header_length)
+        self.n_layers = self.header['n_layers']
+        self.layer_types = [str(lt) for lt in self.header['layer_types']]
+
+    def array(self, name):
+        """ Return the named array (e.g 'W_0') as a read-only memory map """
+        info = self.header['arrays'][name]
+        return np.memmap(self.filename, dtype=np.dtype(str(info['dtype'])), mode='r', offset=self.data_start + info['offset'], shape=tuple(info['shape']))
+
+    def layer(self, i):
+        """ Return the (W, bhid, bvis) arrays of layer i, as memory maps """
+        return tuple(self.array('%s_%d' % (name, i)) for name in PARAM_NAMES)
+
+    def updates(self):
+        """ Return the optimizer state stored with the model as a dict of array name to memory map, or None """
+        names = [name for name in self.header['arrays'] if name.startswith('update_')]
+        if not names:
+            return None
+        return dict((name[len('update_'):], self.array(name)) for name in names)
+
+    def state(self, dtype=None):
+        """ Return the state tuple of the SdA, as SdA.__getstate__ would, with arrays converted to dtype
+        (or left as memory maps if dtype is None) """
+        layers = [self.layer(i) for i in xrange(self.n_layers)]
+        if dtype is not None:
+            layers = [tuple(np.array(a, dtype=dtype) for a in layer) for layer in layers]
+        h = self.header
+        return (self.n_layers, h['n_outs'], [l[0] for l in layers], [l[1] for l in layers], [l[2] for l in layers],
+                h['corruption_levels'], self.layer_types, str(h['loss']), h['dropout_rates'], str(h['opt_method']))
+
+
+def save_sda(sda, filename, dtype=np.float32, optimizer_state=False):
+    """ Write an SdA to a model file, with the optimizer state of its parameters if asked """
+    updates = None
+    if optimizer_state:
+        updates = {}
+        for i, layer in enumerate(sda.dA_layers):
+            for name, param in zip(PARAM_NAMES, layer.get_params()):
+                if param in sda.updates:
+                    updates['%s_%d' % (name, i)] = sda.updates[param].get_value(borrow=True)
+    write_state(filename, sda.__getstate__(), dtype=dtype, updates=updates)
+
+
+def load_sda(filename):
+    """ Build an SdA from a model file, with its parameters in theano's floatX, and restore the optimizer
+    state if the file has it """
+    import theano
+    from SdA import SdA
+
+    model_file = ModelFile(filename)
+    sda = SdA.__new__(SdA)
+    sda.__setstate__(model_file.state(dtype=theano.config.floatX))
+    updates = model_file.updates()
+    if updates is not None:
+        for i, layer in enumerate(sda.dA_layers):
+            for name, param in zip(PARAM_NAMES, layer.get_params()):
+                if '%s_%d' % (name, i) in updates:
+                    sda.updates[param].set_value(np.array(updates['%s_%d' % (name, i)], dtype=theano.config.floatX))
+    return sda
+
+
+def load_model(filename):
+    """ Load an SdA from either a model file or a pickle """
+    if is_model_file(filename):
+        return load_sda(filename)
+    f = open(filename, 'rb')
+    sda = cPickle.load(f)
+    f.close()
+    return sda
+
+
+def save_model(sda, filename):
+    """ Save an SdA as a model file if filename ends with .sda, else pickle it """
+    if filename.endswith('.sda'):
+        save_sda(sda, filename)
+    else:
+        write_atomically(filename, lambda f: cPickle.dump(sda, f, protocol=cPickle.HIGHEST_PROTOCOL))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print "usage: model_format.py <input .pkl or .sda> <output .sda or .pkl>"
+        sys.exit(1)
+    infile, outfile = sys.argv[1:]
+    if outfile.endswith('.sda'):
+        # read the pickle without building the model
+        write_state(outfile, read_pickle_state(infile))
+    else:
+        save_model(load_model(infile), outfile)
@@ -0,0 +1,282 @@
+""" Training an SdA in several CPU worker processes, over parameters kept in shared memory so that no
+parameters or gradients are ever pickled or sent through a pipe.
+
+DataParallelTrainer finetunes by synchronous data-parallel SGD.  Each minibatch is split into equal shards,
+one per worker process.  The workers compute the gradient of the reconstruction cost on their shard, and
+write it into a block of shared memory.  The parent process averages the gradients, and applies them with
+the SdA's own update rule (sgd_cm, sgd_adagrad, ...).
+
+HogwildTrainer pretrains one dA layer by asynchronous, lock-free SGD (Hogwild).  Each worker trains on its
+own contiguous shard of the minibatches, and adds each of its parameter steps straight into the shared
+parameters while the other workers read and update them.  Each worker keeps its own momentum.
+
+The workers are forked from the process that builds the trainer, so they inherit the model, the training
+data and the compiled functions.  The training data must therefore be in memory (not streamed)
+before the trainer is built.  Each worker is best limited to a single BLAS thread (e.g OMP_NUM_THREADS=1). """
+
+import Queue as queue
+from collections import OrderedDict
+from multiprocessing import Process, Queue, RawArray
+
+import numpy as np
+
+import theano
+import theano.tensor as T
+
+from SdA import minibatch
+
+
+def compute_gradients(worker_id, grad_fn, grads, shard_size, tasks, done):
+    """ Worker process: take the first row of a minibatch from the tasks queue until a None is found.
+    Compute the cost and gradient on this worker's shard of the minibatch, write the gradient into grads
+    and put (worker_id, cost) on the done queue.
+
+    :type grads: numpy.ndarray
+    :param grads: this worker's block of the shared gradient memory, a flat array of all the gradients
+    """
+    for batch_start in iter(tasks.get, None):
+        start = batch_start + worker_id * shard_size
+        outputs = grad_fn(start, start + shard_size)
+        offset = 0
+        for g in outputs[1:]:
+            grads[offset:offset + g.size] = g.ravel()
+            offset += g.size
+        done.put((worker_id, float(outputs[0])))
+
+
+def hogwild_steps(worker_id, train_fn, param_views, learning_rate, theano_rng, seed, tasks, done):
+    """ Worker process: take (minibatch indices, their momenta or None, learning rate, training function
+    arguments) from the tasks queue until a None is found.  Train on each minibatch in turn, adding the step
+    of the parameters into param_views without taking any lock, then put (worker_id, costs) on the done
+    queue. """
+    # each worker draws its own corruption noise
+    theano_rng.seed(seed + worker_id)
+    for batches, momenta, lr, fn_args in iter(tasks.get, None):
+        learning_rate.set_value(lr)
+        costs = []
+        for k, index in enumerate(batches):
+            if momenta is not None:
+                fn_args['momentum'] = momenta[k]
+            outputs = train_fn(index=index, **fn_args)
+            for view, step in zip(param_views, outputs[1:]):
+                view += step
+            costs.append(float(outputs[0]))
+        done.put((worker_id, costs))
+
+
+def move_to_shared_memory(params):
+    """ Copy the values of the theano shared variables in params into one block of shared memory, and point
+    each variable at its view of the block.  Processes forked after this read and write the same values.
+    Returns the list of views, one per parameter. """
+    values = [p.get_value(borrow=True) for p in params]
+    dtype = values[0].dtype
+    typecode = 'f' if dtype == np.float32 else 'd'
+    flat = np.frombuffer(RawArray(typecode, sum(v.size for v in values)), dtype=dtype)
+    views = split_like(flat, values)
+    for param, value, view in zip(params, values, views):
+        view[...] = value
+        param.set_value(view, borrow=True)
+    return views
+
+
+def split_like(flat, arrays):
+    """ Return views of the flat array in the shapes of the given arrays """
+    views = []
+    offset = 0
+    for a in arrays:
+        views.append(flat[offset:offset + a.size].reshape(a.shape))
+        offset += a.size
+    return views
+
+
+def wait_for(done, n, workers):
+    """ Return the next n results from the done queue, raising a RuntimeError if any of the workers exits
+    before they all arrive. """
+    results = []
+    while len(results) < n:
+        try:
+            results.append(done.get(timeout=10))
+        except queue.Empty:
+            if not all(w.is_alive() for w in workers):
+                raise RuntimeError('a worker process exited during training')
+    return results
+
+
+class DataParallelTrainer(object):
+
+    def __init__(self, sda, train_set_x, batch_size, learning_rate, method='cm', n_workers=2, perm=None):
+        """ Start the worker processes, and compile the gradient and update functions.  The trainer is
+        called like the train function from SdA.build_finetune_full_reconstruction:
+        trainer(index, momentum[, weight_decay]) trains on minibatch index, and returns its cost.
+
+        :type sda: SdA
+        :param sda: the model to finetune.  Its parameters are moved into shared memory.
+
+        :type train_set_x: theano.tensor.TensorType
+        :param train_set_x: Shared variable that contains all the training datapoints
+
+        :type batch_size: int
+        :param batch_size: size of a minibatch, must be a multiple of n_workers
+
+        :type learning_rate: theano.tensor.shared
+        :param learning_rate: learning rate used during finetune stage
+
+        :type method: string
+        :param method: the SGD update rule, as for SdA.build_finetune_full_reconstruction
+
+        :type n_workers: int
+        :param n_workers: the number of worker processes, each of which gets an equal shard of each minibatch
+
+        :type perm: theano.tensor.shared
+        :param perm: if given, take the minibatches in the order of this vector of row indices.  The workers
+                     see it change only if its memory is shared, as with batch_sampler.BatchSampler.
+        """
+        if batch_size % n_workers != 0:
+            errormsg = 'batch size ' + str(batch_size) + ' is not a multiple of the number of workers ' + str(n_workers)
+            raise ValueError(errormsg)
+
+        self.batch_size = batch_size
+        self.n_workers = n_workers
+        self.shard_size = batch_size / n_workers
+        self.params = sda.params
+        self.param_views = move_to_shared_memory(self.params)
+        n_values = sum(view.size for view in self.param_views)
+        dtype = self.param_views[0].dtype
+        typecode = 'f' if dtype == np.float32 else 'd'
+
+        # one block of gradients per worker
+        self.shared_grads = np.frombuffer(RawArray(typecode, n_workers * n_values), dtype=dtype).reshape(n_workers, n_values)
+
+        # the gradient of the cost on a range of rows, for the workers
+        start = T.lscalar('start')
+        end = T.lscalar('end')
+        gparams = T.grad(sda.finetune_cost, self.params)
+        grad_fn = theano.function(inputs=[start, end], outputs=[sda.finetune_cost] + gparams,
+                                  givens={sda.x: minibatch(train_set_x, start, end, perm)})
+
+        # the update of the parameters given the averaged gradients, for this process
+        grad_inputs = [T.TensorType(p.dtype, p.broadcastable)('grad_%d' % i) for i, p in enumerate(self.params)]
+        mod_updates, sgd_inputs = sda.finetune_updates(learning_rate, zip(self.params, grad_inputs), method)
+        self.update_fn = theano.function(inputs=grad_inputs + sgd_inputs, outputs=[], updates=mod_updates)
+
+        # fork the workers, which inherit the data, the compiled gradient function and the shared memory
+        self.tasks = [Queue() for i in xrange(n_workers)]
+        self.done = Queue()
+        self.workers = []
+        for i in xrange(n_workers):
+            worker = Process(target=compute_gradients, args=(i, grad_fn, self.shared_grads[i], self.shard_size, self.tasks[i], self.done))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def __call__(self, index, *sgd_args):
+        """ Train on minibatch index, return the cost of the minibatch """
+        for tasks in self.tasks:
+            tasks.put(index * self.batch_size)
+
+        # wait for every worker's gradient
+        costs = [cost for worker_id, cost in wait_for(self.done, self.n_workers, self.workers)]
+
+        # all-reduce: the shards are of equal size, so the minibatch gradient is the mean of the shard gradients
+        grads = split_like(self.shared_grads.mean(axis=0), self.param_views)
+        self.update_fn(*(grads + list(sgd_args)))
+
+        # the update put the new values in new arrays, move them back into shared memory for the workers
+        for param, view in zip(self.params, self.param_views):
+            view[...] = param.get_value(borrow=True)
+            param.set_value(view, borrow=True)
+        return np.mean(costs)
+
+    def close(self):
+        """ Stop the workers.  The parameters stay in shared memory, and can be used as usual. """
+        for tasks in self.tasks:
+            tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+class HogwildTrainer(object):
+
+    def __init__(self, sda, i, train_set_x, batch_size, learning_rate, method='cm', n_workers=2, seed=1234, perm=None):
+        """ Start the worker processes, and compile the training function of layer i.  Train with 
+        epoch(batches, corruption=..., momentum=...), which takes the same arguments as the functions from 
+        SdA.pretraining_functions, bar the minibatch index.
+
+        :type sda: SdA
+        :param sda: the model to pretrain.  The parameters of layer i are moved into shared memory.
+
+        :type i: int
+        :param i: the layer to pretrain.  The layers below are fixed while it is trained.
+
+        :type train_set_x: theano.tensor.TensorType
+        :param train_set_x: Shared variable that contains all the training datapoints
+
+        :type batch_size: int
+        :param batch_size: size of a minibatch
+
+        :type learning_rate: theano.tensor.shared
+        :param learning_rate: the learning rate for pretraining, read by the workers at the start of each epoch
+
+        :type method: string
+        :param method: the SGD update rule, as for SdA.pretraining_functions
+
+        :type n_workers: int
+        :param n_workers: the number of worker processes
+
+        :type seed: int
+        :param seed: worker k seeds its corruption noise with seed + k
+
+        :type perm: theano.tensor.shared
+        :param perm: if given, take the minibatches in the order of this vector of row indices, as for
+                     DataParallelTrainer
+        """
+        self.n_workers = n_workers
+        self.learning_rate = learning_rate
+        dA = sda.dA_layers[i]
+        self.params = dA.params
+        self.param_views = move_to_shared_memory(self.params)
+
+        # return the step of each parameter rather than applying it, keep the other updates (momentum, noise)
+        graph = sda.pretraining_graph(i, train_set_x, batch_size, learning_rate, method, perm=perm)
+        updates = graph['updates']
+        steps = [updates[p] - p for p in self.params]
+        local_updates = OrderedDict((var, new) for var, new in updates.items() if var not in self.params)
+        train_fn = theano.function(inputs=graph['inputs'], outputs=[graph['outputs']] + steps,
+                                   updates=local_updates, givens=graph['givens'])
+
+        # fork the workers, which inherit the data, the compiled training function and the shared memory
+        self.tasks = [Queue() for k in xrange(n_workers)]
+        self.done = Queue()
+        self.workers = []
+        for k in xrange(n_workers):
+            worker = Process(target=hogwild_steps, args=(k, train_fn, self.param_views, learning_rate, dA.theano_rng, seed, self.tasks[k], self.done))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def epoch(self, batches, momentum=None, **fn_args):
+        """ Train on each of the minibatch indices in batches, which are split into one contiguous shard per
+        worker.  Returns the costs of the minibatches, in the order of batches.
+
+        :type momentum: float or list of float
+        :param momentum: the momentum of every minibatch, or a list of one momentum per minibatch of batches
+                         (e.g from a momentum schedule)
+        """
+        batches = np.asarray(list(batches))
+        shards = np.array_split(batches, self.n_workers)
+        if momentum is None:
+            momenta = [None] * self.n_workers
+        else:
+            momenta = np.array_split(np.asarray(momentum, dtype=float) * np.ones(len(batches)), self.n_workers)
+        lr = self.learning_rate.get_value()
+        for tasks, shard, shard_momenta in zip(self.tasks, shards, momenta):
+            tasks.put((shard, shard_momenta, lr, fn_args))
+        results = sorted(wait_for(self.done, self.n_workers, self.workers))
+        return [cost for worker_id, costs in results for cost in costs]
+
+    def close(self):
+        """ Stop the workers.  The parameters stay in shared memory, and can be used as usual. """
+        for tasks in self.tasks:
+            tasks.put(None)
+        for worker in self.workers:
+            worker.join()
@@ -23,10 +23,11 @@ from SdA import SdA
 
 from extract_datasets import store_unlabeled_byarray
 from load_shared import load_data_unlabeled
+from storage_policy import add_storage_options, storage_from_options
 
 from datetime import datetime
 
-def feedforward_SdA(output_file,input_file,arch,restore_file): 
+def feedforward_SdA(output_file,input_file,arch,restore_file,h5_filters=None,chunkshape=None): 
     """ Walk through the input_file, feed each array through the SdA,
     save to a similar group/node structure in the output file.
     
@@ -42,6 +43,12 @@ def feedforward_SdA(output_file,input_file,arch,restore_file):
     :type restore_file: string
     :param restore_file: location on disk of the pickled SdA model
     
+    :type h5_filters: Filters
+    :param h5_filters: compress the output with these pytables filters (default zlib, level 5)
+    
+    :type chunkshape: tuple
+    :param chunkshape: the (rows, columns) chunk shape of the output arrays, or None to let pytables choose
+    
     """
     
     # Open and set up the input, output hdf5 files     
@@ -52,7 +59,8 @@ def feedforward_SdA(output_file,input_file,arch,restore_file):
     print "Reduced with ", arch
     
     # Create a new group under "/" (root)
-    zlib_filters = tables.Filters(complib='zlib', complevel=5)   
+    if h5_filters is None:
+        h5_filters = tables.Filters(complib='zlib', complevel=5)   
 
     print 'Unpickling the model from %s ...' % (restore_file)        
     f = file(restore_file, 'rb')
@@ -76,7 +84,7 @@ def feedforward_SdA(output_file,input_file,arch,restore_file):
         reduced_data = encode_fn(start=start,end=end)     
         # write the encoded data to the output file
         data_group = outfile_h5.createGroup(root,parent_name,'whatever, man.')
-        store_unlabeled_byarray(outfile_h5, data_group, zlib_filters, name, reduced_data)
+        store_unlabeled_byarray(outfile_h5, data_group, h5_filters, name, reduced_data, chunkshape)
                
     input_h5.close()
     outfile_h5.close()
@@ -112,6 +120,7 @@ if __name__ == '__main__':
     parser.add_option("-r","--restorefile",dest = "pr_file", help = "Restore the first model from this pickle file", default=None)
     parser.add_option("-i", "--inputfile", dest="inputfile", help="the data (hdf5 file) prepended with an absolute path")
     parser.add_option("-o", "--outputfile", dest="outputfile", help="the output hdf5 file")
+    add_storage_options(parser)
     (options, args) = parser.parse_args()    
     
     model_name = re.compile(".*?_([\d_]+).pkl")    
@@ -119,6 +128,7 @@ if __name__ == '__main__':
     
     restore_file = os.path.join(options.model_dir,options.pr_file)
     
-    feedforward_SdA(options.outputfile, options.inputfile, arch, restore_file)
+    h5_filters, chunkshape = storage_from_options(options)
+    feedforward_SdA(options.outputfile, options.inputfile, arch, restore_file, h5_filters, chunkshape)
 
     
\ No newline at end of file
@@ -3,7 +3,7 @@ layer dA output (i.e lowest dimensional representation) of that data to an outpu
 
 
 # These imports will not trigger any theano GPU binding, so are safe to sit here.
-from multiprocessing import Process, Manager
+from multiprocessing import Manager
 from optparse import OptionParser
 import os, re
 
@@ -19,6 +19,9 @@ from extract_datasets import store_unlabeled_byarray, store_labeled_byarray
 from common_utils import extract_arch
 from load_shared import load_data_unlabeled
 from tables import openFile, Filters 
+from storage_policy import add_storage_options, make_filters, parse_chunkshape
+from scheduler import add_scheduler_options, read_job_specs, restart_with_thread_limit, run_jobs
+from model_format import load_model
 
 from datetime import datetime
 
@@ -35,10 +38,11 @@ def feedforward_SdA(shared_args,private_args):
     
     """
     
-    # Import sandbox.cuda to bind the specified GPU to this subprocess
+    # Import sandbox.cuda to bind the specified GPU to this subprocess (unless it runs on a cpu slot)
     # then import the remaining theano and model modules.
-    import theano.sandbox.cuda
-    theano.sandbox.cuda.use(private_args['gpu'])
+    if private_args['gpu'].startswith('gpu'):
+        import theano.sandbox.cuda
+        theano.sandbox.cuda.use(private_args['gpu'])
     
     import theano
     import theano.tensor as T
@@ -65,7 +69,8 @@ def feedforward_SdA(shared_args,private_args):
     arrays_group = h5file.createGroup("/", 'recarrays', 'The lower dimensional data arrays')
     if save_labels:
         labels_group = h5file.createGroup("/", 'labels', 'The label arrays')
-    zlib_filters = Filters(complib='zlib', complevel=5)    
+    h5_filters = make_filters(shared_args_dict['codec'], shared_args_dict['complevel'], shared_args_dict['bitshuffle'])
+    chunkshape = parse_chunkshape(shared_args_dict['chunkshape'])
     
     # Get the data to be fed through the SdA from the input file
     data_set_file = openFile(str(shared_args_dict['input']), mode = 'r') 
@@ -75,9 +80,7 @@ def feedforward_SdA(shared_args,private_args):
     chunk_names, offsets = calculate_offsets(arrays_list)
     
     print 'Unpickling the model from %s ...' % (private_args['restore'])        
-    f = file(private_args['restore'], 'rb')
-    sda_model = cPickle.load(f)
-    f.close()    
+    sda_model = load_model(private_args['restore'])
     
     if save_labels:
         datafile, labelfile = extract_labeled_chunkrange(data_set_file, num_files=len(arrays_list))
@@ -94,9 +97,9 @@ def feedforward_SdA(shared_args,private_args):
         start,end = offsets[i]
         reduced_data = encode_fn(start=start,end=end)
         if save_labels:
-            store_labeled_byarray(h5file, arrays_group, labels_group, zlib_filters, chunk_names[i], reduced_data, labels_list[i])
+            store_labeled_byarray(h5file, arrays_group, labels_group, h5_filters, chunk_names[i], reduced_data, labels_list[i], chunkshape)
         else:
-            store_unlabeled_byarray(h5file, arrays_group, zlib_filters, chunk_names[i], reduced_data)
+            store_unlabeled_byarray(h5file, arrays_group, h5_filters, chunk_names[i], reduced_data, chunkshape)
         
     # tidy up    
     end_time = time.clock()
@@ -130,7 +133,10 @@ if __name__ == '__main__':
     parser.add_option("-q","--secondrestorefile",dest = "qr_file", help = "Restore the second model from this pickle file", default=None)
     parser.add_option("-i", "--inputfile", dest="inputfile", help="the data (hdf5 file) prepended with an absolute path")
     parser.add_option("-l", "--labels", dest="labels", action='store_true', default=False, help="use labels?")
+    add_storage_options(parser)
+    add_scheduler_options(parser)
     (options, args) = parser.parse_args()    
+    restart_with_thread_limit(options.threads)
     
     # Construct a dict of shared arguments that should be read by both processes
     manager = Manager()
@@ -141,35 +147,30 @@ if __name__ == '__main__':
     shared_args['dir'] = os.path.join(options.dir,options.extension)
     shared_args['input'] = options.inputfile
     shared_args['labels'] = options.labels
+    shared_args['codec'] = options.codec
+    shared_args['complevel'] = options.complevel
+    shared_args['bitshuffle'] = options.bitshuffle
+    shared_args['chunkshape'] = options.chunkshape
     args[0] = shared_args
     
-    # Construct the specific args for each of the two processes
-    p_args = {}
-    q_args = {}
-       
-    p_args['gpu'] = 'gpu0'
-    q_args['gpu'] = 'gpu1'
+    # The models are given by their pickle files: either the two given on the command line, or those in the jobs file
+    if options.jobs is not None:
+        specs = read_job_specs(options.jobs)
+    else:
+        specs = [{'restore': options.pr_file}, {'restore': options.qr_file}]
     
     # Compile regular expression for extracting model architecture names
     model_name = re.compile(".*?_([\d_]+).pkl")    
-    p_args['arch'] = extract_arch(options.pr_file,model_name)
-    q_args['arch'] = extract_arch(options.qr_file,model_name)
-         
-    # Determine where to load & save the first model
     parts = os.path.split(options.dir)
-    pkl_load_file = os.path.join(parts[0],'finetune_pkl_files',options.extension,options.pr_file)
-    p_args['restore'] = pkl_load_file
-   
-    # Determine where to load & save the second model
-    pkl_load_file = os.path.join(parts[0],'finetune_pkl_files',options.extension,options.qr_file)
-    q_args['restore'] = pkl_load_file
-
-    # Run both sub-processes
-    p = Process(target=feedforward_SdA, args=(args,p_args,))
-    q = Process(target=feedforward_SdA, args=(args,q_args,))
-    p.start()
-    q.start()
-    p.join()
-    q.join()
+    
+    jobs = []
+    for spec in specs:
+        if not spec.has_key('restore'):
+            parser.error("each model needs a restore file: " + str(spec))
+        job_args = dict(spec)
+        job_args['arch'] = extract_arch(spec['restore'],model_name)
+        job_args['restore'] = os.path.join(parts[0],'finetune_pkl_files',options.extension,spec['restore'])
+        jobs.append(job_args)
 
-    
\ No newline at end of file
+    # Run the models on the slots, each in its own sub-process
+    run_jobs(feedforward_SdA, args, jobs, options.devices.split(','), threads=options.threads, retries=options.retries)
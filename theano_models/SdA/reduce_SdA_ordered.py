@@ -3,19 +3,26 @@ layer dA output (i.e lowest dimensional representation) of that data to an outpu
 
 
 # These imports will not trigger any theano GPU binding, so are safe to sit here.
-from multiprocessing import Process, Manager
+from multiprocessing import Process, Manager, Queue
 from optparse import OptionParser
 import os, re
+import Queue as queue
 
 import cPickle
 import gzip
+import sys
 import time
 
 import numpy
 import tables
 
 from extract_datasets import store_unlabeled_byarray
-from load_shared import load_data_unlabeled
+from load_shared import preprocess_unlabeled
+from encoders import SdAEncoder
+from scheduler import restart_with_thread_limit
+from model_format import load_model
+from streaming_scaler import load_scaler
+from storage_policy import add_storage_options, make_filters, parse_chunkshape
 
 from datetime import datetime
 
@@ -36,17 +43,20 @@ def feedforward_SdA(shared_args,private_args):
     """
     
     # Import sandbox.cuda to bind the specified GPU to this subprocess
-    # then import the remaining theano and model modules
+    # then import the remaining theano and model modules.  The numpy 
+    # engine needs neither.
     
     shared_args_dict = shared_args[0]   
     
-    import theano.sandbox.cuda
-    theano.sandbox.cuda.use(private_args['gpu'])
-    
-    import theano
-    import theano.tensor as T
-    from theano.tensor.shared_randomstreams import RandomStreams
-    from SdA import SdA    
+    if shared_args_dict['engine'] == 'theano':
+        import theano.sandbox.cuda
+        theano.sandbox.cuda.use(private_args['gpu'])
+        
+        import theano
+        import theano.tensor as T
+        from theano.tensor.shared_randomstreams import RandomStreams
+        from SdA import SdA    
+        from encoders import CompiledEncoder
      
     # Open and set up the input, output hdf5 files     
     outfile_h5 = tables.openFile(private_args['output'], mode = 'w', title = "Reduced Data File")    
@@ -56,12 +66,19 @@ def feedforward_SdA(shared_args,private_args):
     print "Reduced with ", private_args['arch']
     
     # Create a new group under "/" (root)
-    zlib_filters = tables.Filters(complib='zlib', complevel=5)   
+    h5_filters = make_filters(shared_args_dict['codec'], shared_args_dict['complevel'], shared_args_dict['bitshuffle'])
+    chunkshape = parse_chunkshape(shared_args_dict['chunkshape'])
+    scaler = load_scaler(shared_args_dict['scaler'])
 
-    print 'Unpickling the model from %s ...' % (private_args['restore'])        
-    f = file(private_args['restore'], 'rb')
-    sda_model = cPickle.load(f)
-    f.close()    
+    if shared_args_dict['engine'] == 'theano':
+        print 'Unpickling the model from %s ...' % (private_args['restore'])        
+        sda_model = load_model(private_args['restore'])
+        
+        # the encoding function is compiled once, on the first well with data
+        encoder = None
+    else:
+        print 'Reading the model parameters from %s ...' % (private_args['restore'])
+        encoder = SdAEncoder.from_file(private_args['restore'], n_threads=shared_args_dict['threads'])
     
     out_root = outfile_h5.root 
     out_plates = outfile_h5.createGroup('/','plates','plate data')
@@ -76,19 +93,19 @@ def feedforward_SdA(shared_args,private_args):
             name = well._v_name
             parent_name = (well._v_parent)._v_name
             try:
-                data = well.read()
+                # read only the feature columns
+                data = well[:,5:916]
                 if data.shape[0] > 0:
-                    # load the node data into theano.shared memory on the GPU
-                    this_x = load_data_unlabeled(data)   
-                    # get the encoding function, encode the data
-                    encode_fn = sda_model.build_encoding_functions(dataset=this_x)   
-                    start, end = 0, data.shape[0]
-                    reduced_data = encode_fn(start=start,end=end)     
+                    # scale the node data, then swap it into the encoder's shared buffer slab by slab
+                    this_x = preprocess_unlabeled(data, scaler=scaler, projected=True)
+                    if encoder is None:
+                        encoder = CompiledEncoder(sda_model, this_x.shape[1], slab_size=shared_args_dict['slab_size'])
+                    reduced_data = encoder.encode(this_x)
                 else:
                     reduced_data = data[:,:10]
                     
                 # write reduced data to same place in outfile
-                store_unlabeled_byarray(outfile_h5, out_plate, zlib_filters, name, reduced_data)                
+                store_unlabeled_byarray(outfile_h5, out_plate, h5_filters, name, reduced_data, chunkshape)                
                 
             except:
                 print "Encountered a problem at this node: ", name
@@ -96,6 +113,112 @@ def feedforward_SdA(shared_args,private_args):
                
     input_h5.close()
     outfile_h5.close()
+
+
+def reduce_plates(shared_args_dict, private_args, plates, reduced):
+    """ Worker process for parallel_feedforward_SdA.  Take plate names from the plates queue until
+    a None is found, encode each well of the plate with the numpy engine and put the 
+    (plate, well, reduced data) tuples on the reduced queue.  Put a final None on the reduced queue when done.
+    
+    :type shared_args_dict: dict
+    :param shared_args_dict: dict of shared arguments provided from the parent process
+    
+    :type private_args: dict
+    :param private_args: dict containing the arguments for the model being reduced
+    
+    :type plates: multiprocessing.Queue
+    :param plates: queue of plate names to reduce
+    
+    :type reduced: multiprocessing.Queue
+    :param reduced: queue on which to put the reduced wells
+    """
+    
+    input_h5 = tables.openFile(str(shared_args_dict['input']), mode = 'r')
+    encoder = SdAEncoder.from_file(private_args['restore'], n_threads=shared_args_dict['threads'])
+    scaler = load_scaler(shared_args_dict['scaler'])
+    
+    for plate_name in iter(plates.get, None):
+        in_plate = input_h5.getNode('/plates', plate_name)
+        for well in in_plate._f_listNodes(classname='Array'):
+            name = well._v_name
+            try:
+                # read only the feature columns
+                data = well[:,5:916]
+                if data.shape[0] > 0:
+                    reduced_data = encoder.encode(preprocess_unlabeled(data, scaler=scaler, projected=True))
+                else:
+                    reduced_data = data[:,:10]
+            except:
+                print "Encountered a problem at this node: ", name
+                continue
+            reduced.put((plate_name, name, reduced_data))
+    
+    input_h5.close()
+    reduced.put(None)
+    
+
+def parallel_feedforward_SdA(shared_args, private_args):
+    """ Reduce the input file on the CPU, sharding the plates across a number of worker processes
+    (see reduce_plates).  This process is the only one that writes to the output file, it recreates the 
+    plates/wells tree of the input as the reduced wells arrive.
+    
+    :type shared_args: list
+    :param shared_args: list contaning a dict of shared arguments 
+    provided from the parent process
+
+    :type private_args: dict
+    :param private_args: dict containing the arguments for the model being reduced
+    """
+    
+    shared_args_dict = shared_args[0]
+    n_workers = shared_args_dict['workers']
+    
+    outfile_h5 = tables.openFile(private_args['output'], mode = 'w', title = "Reduced Data File")    
+    root = outfile_h5.createGroup('/','reduced_samples','reduced data from reference samples')
+    input_h5 = tables.openFile(str(shared_args_dict['input']), mode = 'r') 
+    print "Run on ", str(datetime.now())    
+    print "Reduced with ", private_args['arch'], " using ", n_workers, " workers"
+    
+    h5_filters = make_filters(shared_args_dict['codec'], shared_args_dict['complevel'], shared_args_dict['bitshuffle'])
+    chunkshape = parse_chunkshape(shared_args_dict['chunkshape'])
+    
+    # create each plate group in the output file up front, and queue it up for the workers
+    plates = Queue()
+    out_plates = outfile_h5.createGroup('/','plates','plate data')
+    for in_plate in input_h5.listNodes('/plates',classname="Group"):
+        outfile_h5.createGroup(out_plates,in_plate._v_name,in_plate._v_title)
+        plates.put(in_plate._v_name)
+    input_h5.close()
+    
+    # bound the number of reduced wells waiting to be written
+    reduced = Queue(maxsize = 4 * n_workers)
+    workers = [Process(target=reduce_plates, args=(shared_args_dict, private_args, plates, reduced)) for i in xrange(n_workers)]
+    for w in workers:
+        plates.put(None)
+        w.start()
+    
+    start_time = time.time()
+    finished = 0
+    while finished < n_workers:
+        try:
+            item = reduced.get(timeout=10)
+        except queue.Empty:
+            if not any(w.is_alive() for w in workers):
+                print "All workers have exited, but only %d of %d finished cleanly" % (finished, n_workers)
+                break
+            continue
+        if item is None:
+            finished += 1
+            continue
+        plate_name, name, reduced_data = item
+        out_plate = outfile_h5.getNode(out_plates, plate_name)
+        store_unlabeled_byarray(outfile_h5, out_plate, h5_filters, name, reduced_data, chunkshape)
+    
+    for w in workers:
+        w.join()
+    outfile_h5.close()
+    print "Reduced in %.2fm" % ((time.time() - start_time) / 60.)
+
            
 def extract_arch(filename, model_regex):
     ''' Return the model architecture of this filename
@@ -131,8 +254,18 @@ if __name__ == '__main__':
     parser.add_option("-i", "--inputfile", dest="inputfile", help="the data (hdf5 file) prepended with an absolute path")
     parser.add_option("--p_out", dest="p_outputfile", help="the first model's output hdf5 file")
     parser.add_option("--q_out", dest="q_outputfile", help="the second model's output hdf5 file")
+    parser.add_option("--slab", dest="slab_size", type="int", default=20000, help="encode wells in slabs of at most this many cells")
+    parser.add_option("--engine", dest="engine", default="theano", help="encode with a compiled 'theano' function on the GPU, or with 'numpy' on the CPU")
+    parser.add_option("--scaler", dest="scaler", default=None, help="scale with the statistics saved by streaming_scaler.py (the .npz file, or the h5 file it sits next to) instead of scaling each well separately")
+    parser.add_option("--threads", dest="threads", type="int", default=None, help="limit BLAS to this many threads per process (the default with --workers is 1)")
+    parser.add_option("--workers", dest="workers", type="int", default=0, help="reduce on the CPU with the numpy engine, sharding the plates across this many processes")
+    add_storage_options(parser)
     (options, args) = parser.parse_args()    
     
+    # Limit BLAS before the workers are forked; they default to one thread each
+    n_threads = options.threads if options.threads is not None else (1 if options.workers > 0 else None)
+    restart_with_thread_limit(n_threads)
+    
     # Construct a dict of shared arguments that should be read by both processes
     manager = Manager()
 
@@ -140,6 +273,15 @@ if __name__ == '__main__':
     args.append({})
     shared_args = args[0]
     shared_args['input'] = options.inputfile
+    shared_args['slab_size'] = options.slab_size
+    shared_args['engine'] = options.engine
+    shared_args['threads'] = options.threads
+    shared_args['scaler'] = options.scaler
+    shared_args['workers'] = options.workers
+    shared_args['codec'] = options.codec
+    shared_args['complevel'] = options.complevel
+    shared_args['bitshuffle'] = options.bitshuffle
+    shared_args['chunkshape'] = options.chunkshape
     args[0] = shared_args
     
     # Construct the specific args for each of the two processes
@@ -160,6 +302,15 @@ if __name__ == '__main__':
     p_args['output'] = options.p_outputfile
     q_args['output'] = options.q_outputfile
 
+    # On the CPU, reduce with each model in turn, each using all the workers
+    if options.workers > 0:
+        if options.threads is None:
+            shared_args['threads'] = 1
+            args[0] = shared_args
+        parallel_feedforward_SdA(args, p_args)
+        parallel_feedforward_SdA(args, q_args)
+        sys.exit(0)
+
     # Run both sub-processes
     p = Process(target=feedforward_SdA, args=(args,p_args,))
     q = Process(target=feedforward_SdA, args=(args,q_args,))
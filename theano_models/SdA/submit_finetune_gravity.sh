@@ -14,9 +14,13 @@
 
 # Run the job
 
-# To make substitutions from a higher up script: -p $FIRSTMODEL -q $SECONDMODEL -o $OFFSET
+# To make substitutions from a higher up script: -p $FIRSTMODEL -q $SECONDMODEL -o $OFFSET, or --jobs $JOBS for a list of models
 cd $PBS_O_WORKDIR
-python finetune_SdA_multiproc.py -d "${SCRATCH}/gpu_models/SdA/finetune_output" -e "10" -x "10" -p $FIRSTMODEL -q $SECONDMODEL -i "${SCRATCH}/sm_rep1_data/sm_rep1_screen.h5" -o $OFFSET
+if [ -n "$JOBS" ]; then
+    python finetune_SdA_multiproc.py -d "${SCRATCH}/gpu_models/SdA/finetune_output" -e "10" -x "10" --jobs $JOBS -i "${SCRATCH}/sm_rep1_data/sm_rep1_screen.h5" -o 0
+else
+    python finetune_SdA_multiproc.py -d "${SCRATCH}/gpu_models/SdA/finetune_output" -e "10" -x "10" -p $FIRSTMODEL -q $SECONDMODEL -i "${SCRATCH}/sm_rep1_data/sm_rep1_screen.h5" -o $OFFSET
+fi
 
 
 
@@ -0,0 +1,112 @@
+""" Compare the CPU throughput and memory of pretraining and finetuning an SdA in float64 and in float32.
+
+theano.config.floatX is fixed once theano is imported, so each precision is run in its own process,
+started with THEANO_FLAGS=floatX=<precision>.  Each run reads the data in that dtype, builds the same
+model, times some epochs of pretraining and finetuning, and reports the minibatches per second, the bytes
+held by the data and the parameters, the peak resident memory of the process, and the number of float64
+nodes left in the compiled training functions (which should be 0 for float32). """
+
+import numpy
+
+from extract_datasets import extract_unlabeled_chunkrange
+from load_shared import load_data_unlabeled
+from tables import openFile
+
+import os
+import sys
+import time
+import resource
+import subprocess
+from datetime import datetime
+from optparse import OptionParser
+
+
+def float64_nodes(fn):
+    """ Return the number of nodes of the compiled theano function fn with a float64 output """
+    return len([node for node in fn.maker.fgraph.toposort() if any(getattr(out, 'dtype', None) == 'float64' for out in node.outputs)])
+
+
+def run_precision(batch_size=50, num_epochs=3, pretrain_lr=0.0001, finetune_lr=0.0001):
+    """ Pretrain and finetune an SdA in theano.config.floatX, and print one line of results """
+    import theano
+    from SdA import SdA
+
+    data_set_file = openFile(str(options.inputfile), mode = 'r')
+    datafiles = extract_unlabeled_chunkrange(data_set_file, num_files = options.num_files, dtype = theano.config.floatX)
+    train_set_x = load_data_unlabeled(datafiles)
+    data_set_file.close()
+
+    n_train_batches, n_features = train_set_x.get_value(borrow=True).shape
+    n_train_batches /= batch_size
+
+    numpy_rng = numpy.random.RandomState(89677)
+    sda_model = SdA(numpy_rng=numpy_rng, n_ins=n_features,
+              hidden_layers_sizes=[int(n) for n in options.arch.split('-')],
+              corruption_levels = [0.25 for n in options.arch.split('-')],
+              layer_types=['gaussian'] + ['bernoulli' for n in options.arch.split('-')[1:]],
+              n_outs=-1)
+
+    learning_rate = theano.shared(numpy.asarray(pretrain_lr, dtype=theano.config.floatX))
+    pretraining_fns = sda_model.pretraining_functions(train_set_x=train_set_x, batch_size=batch_size, learning_rate=learning_rate)
+    # compile each layer's function now, so it is not timed with the training
+    n_float64 = sum(float64_nodes(fn) for fn in pretraining_fns)
+    start_time = time.time()
+    for i in xrange(sda_model.n_layers):
+        for epoch in xrange(num_epochs):
+            for batch_index in xrange(n_train_batches):
+                pretraining_fns[i](index=batch_index, corruption=0.25, momentum=0.8)
+    pretrain_rate = sda_model.n_layers * num_epochs * n_train_batches / (time.time() - start_time)
+
+    learning_rate.set_value(numpy.asarray(finetune_lr, dtype=theano.config.floatX))
+    train_fn, validate_model = sda_model.build_finetune_full_reconstruction(datasets=(train_set_x, train_set_x),
+                                            batch_size=batch_size, learning_rate=learning_rate, method='cm')
+    n_float64 += float64_nodes(train_fn)
+    start_time = time.time()
+    for epoch in xrange(num_epochs):
+        costs = [train_fn(batch_index, 0.8) for batch_index in xrange(n_train_batches)]
+    finetune_rate = num_epochs * n_train_batches / (time.time() - start_time)
+
+    data_mb = train_set_x.get_value(borrow=True).nbytes / 2.**20
+    param_mb = sum(p.get_value(borrow=True).nbytes for p in sda_model.params + sda_model.updates.values()) / 2.**20
+    max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    print '%-8s %12.1f %12.1f %10.1f %10.1f %10.1f %8d %12f' % (theano.config.floatX, pretrain_rate, finetune_rate,
+                                                             data_mb, param_mb, max_rss_mb, n_float64, numpy.mean(costs))
+
+
+def test_float32_SdA():
+    """ Run each precision in its own process, and write the table of their results """
+
+    current_dir = os.getcwd()
+    os.chdir(options.dir)
+    today = datetime.today()
+    day = str(today.date())
+    hour = str(today.time())
+    output_filename = "test_float32_sda." + day + "." + hour
+    output_file = open(output_filename,'w')
+    os.chdir(current_dir)
+    print >> output_file, "Run on " + str(datetime.now())
+    print >> output_file, '%-8s %12s %12s %10s %10s %10s %8s %12s' % ('floatX', 'pretrain/s', 'finetune/s', 'data MB', 'params MB', 'max RSS MB', 'float64', 'cost')
+
+    for precision in ['float64', 'float32']:
+        env = dict(os.environ)
+        env['THEANO_FLAGS'] = ','.join(f for f in [env.get('THEANO_FLAGS', ''), 'floatX=' + precision] if f)
+        output = subprocess.check_output([sys.executable, __file__, '--precision', precision] + sys.argv[1:], env=env)
+        print >> output_file, output.strip().splitlines()[-1]
+
+    output_file.close()
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("-d", "--dir", dest="dir", help="test output directory")
+    parser.add_option("-i", "--inputfile", dest="inputfile", help="the data (hdf5 file) prepended with an absolute path")
+    parser.add_option("-a", "--arch", dest="arch", default="700-100-10", help="dash separated list of the layer sizes of the SdA")
+    parser.add_option("--numfiles", dest="num_files", type=int, default=10, help="train on this many data chunks")
+    parser.add_option("--precision", dest="precision", default=None, help="(used internally) run only this precision, in this process")
+
+    (options, args) = parser.parse_args()
+
+    if options.precision is not None:
+        run_precision()
+    else:
+        test_float32_SdA()
@@ -0,0 +1,120 @@
+import numpy
+
+import theano
+
+from SdA import SdA
+from parallel_sgd import HogwildTrainer
+
+from extract_datasets import extract_unlabeled_chunkrange
+from load_shared import load_data_unlabeled
+from tables import openFile
+
+import os
+import time
+from datetime import datetime
+from optparse import OptionParser
+
+
+def pretrain_layers(sda_model, train_set_x, n_train_batches, batch_size, pretrain_lr, lr_decay, num_epochs, corruption, n_workers, output_file):
+    """ Pretrain each layer of the SdA for num_epochs, serially if n_workers is 1, else with a HogwildTrainer of n_workers.
+    Log the cost and the minibatches per second of each epoch, and return the list of (layer, epoch, cost).  Times are
+    wall clock, since most of the work is done outside this process. """
+
+    learning_rate = theano.shared(numpy.asarray(pretrain_lr, dtype=theano.config.floatX))
+    if n_workers == 1:
+        pretraining_fns = sda_model.pretraining_functions(train_set_x=train_set_x,
+                                                          batch_size=batch_size,
+                                                          learning_rate=learning_rate)
+    costs = []
+    for i in xrange(sda_model.n_layers):
+        learning_rate.set_value(numpy.asarray(pretrain_lr, dtype=theano.config.floatX))
+        if n_workers > 1:
+            trainer = HogwildTrainer(sda_model, i, train_set_x, batch_size, learning_rate, 'cm', n_workers)
+        else:
+            # compile this layer's function now, so it is not timed with the first epoch
+            fn = pretraining_fns[i]
+
+        for epoch in xrange(num_epochs):
+            start_time = time.time()
+            if n_workers > 1:
+                c = trainer.epoch(xrange(n_train_batches), corruption=corruption, momentum=0.8)
+            else:
+                c = [fn(index=batch_index, corruption=corruption, momentum=0.8) for batch_index in xrange(n_train_batches)]
+            elapsed = time.time() - start_time
+            print >> output_file, 'workers %d, layer %i, epoch %d, cost %f, %.1f minibatches/sec' % (n_workers, i, epoch, numpy.mean(c), n_train_batches / elapsed)
+            costs.append((i, epoch, numpy.mean(c)))
+            learning_rate.set_value(numpy.asarray(learning_rate.get_value() * lr_decay, dtype=theano.config.floatX))
+
+        if n_workers > 1:
+            trainer.close()
+    return costs
+
+
+def test_hogwild_SdA(num_epochs=10, pretrain_lr=0.0001, lr_decay=0.98, batch_size=20):
+    """ Pretrain the same SdA serially, and with Hogwild over each number of workers given, and compare
+    the cost of each epoch and the throughput.
+
+    :type num_epochs: int
+    :param num_epochs: number of epochs to pretrain each layer
+
+    :type pretrain_lr: float
+    :param pretrain_lr: learning rate to be used during pre-training
+
+    :type batch_size: int
+    :param batch_size: train in mini-batches of this size
+    """
+
+    current_dir = os.getcwd()
+    os.chdir(options.dir)
+    today = datetime.today()
+    day = str(today.date())
+    hour = str(today.time())
+    output_filename = "test_hogwild_sda." + day + "." + hour
+    output_file = open(output_filename,'w')
+    os.chdir(current_dir)
+    print >> output_file, "Run on " + str(datetime.now())
+
+    # Get the training data sample from the input file
+    data_set_file = openFile(str(options.inputfile), mode = 'r')
+    datafiles = extract_unlabeled_chunkrange(data_set_file, num_files = options.num_files)
+    train_set_x = load_data_unlabeled(datafiles)
+    data_set_file.close()
+
+    n_train_batches, n_features = train_set_x.get_value(borrow=True).shape
+    n_train_batches /= batch_size
+
+    workers = [1] + [int(n) for n in options.workers.split(',')]
+    all_costs = {}
+    for n_workers in workers:
+        # the same initial model for each run
+        numpy_rng = numpy.random.RandomState(89677)
+        sda_model = SdA(numpy_rng=numpy_rng, n_ins=n_features,
+                  hidden_layers_sizes=[int(n) for n in options.arch.split('-')],
+                  corruption_levels = [float(options.corruption) for n in options.arch.split('-')],
+                  layer_types=['gaussian'] + ['bernoulli' for n in options.arch.split('-')[1:]],
+                  n_outs=-1)
+        start_time = time.time()
+        all_costs[n_workers] = pretrain_layers(sda_model, train_set_x, n_train_batches, batch_size, pretrain_lr, lr_decay,
+                                               num_epochs, float(options.corruption), n_workers, output_file)
+        print >> output_file, 'workers %d: pretraining took %.2fm' % (n_workers, (time.time() - start_time) / 60.)
+
+    # Compare the convergence of each Hogwild run against the serial run
+    print >> output_file, 'layer epoch ' + ' '.join('%12s' % ('%d workers' % n) for n in workers)
+    for k, (i, epoch, cost) in enumerate(all_costs[1]):
+        print >> output_file, '%5d %5d ' % (i, epoch) + ' '.join('%12f' % all_costs[n][k][2] for n in workers)
+
+    output_file.close()
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("-d", "--dir", dest="dir", help="test output directory")
+    parser.add_option("-i", "--inputfile", dest="inputfile", help="the data (hdf5 file) prepended with an absolute path")
+    parser.add_option("-c", "--corruption", dest="corruption", default="0.25", help="use this amount of corruption for the dA s")
+    parser.add_option("-a", "--arch", dest="arch", default="700-100-10", help="dash separated list of the layer sizes of the SdA")
+    parser.add_option("-w", "--workers", dest="workers", default="2,4", help="comma separated list of the numbers of Hogwild workers to compare against the serial run")
+    parser.add_option("--numfiles", dest="num_files", type=int, default=10, help="train on this many data chunks")
+
+    (options, args) = parser.parse_args()
+
+    test_hogwild_SdA()
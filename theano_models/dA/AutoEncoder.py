@@ -98,7 +98,7 @@ class AutoEncoder(object):
         self.b = bhid         
         
         if input is None:
-            self.x = T.dmatrix(name='input')
+            self.x = T.matrix(name='input')
                   
         else:
             self.x = input
@@ -140,9 +140,9 @@ class AutoEncoder(object):
     def __setstate__(self, state):
         """ Set the state of this dA from values returned from a deserialization process like unpickle. """
         W, b, b_prime, n_visible, n_hidden = state
-        self.W = shared(value=W, name='W')
-        self.b = shared(value=b, name = 'bvis')
-        self.b_prime = shared(value=b_prime, name= 'bhid')
+        self.W = shared(value=np.asarray(W, dtype=config.floatX), name='W')
+        self.b = shared(value=np.asarray(b, dtype=config.floatX), name = 'bvis')
+        self.b_prime = shared(value=np.asarray(b_prime, dtype=config.floatX), name= 'bhid')
         self.n_visible = n_visible
         self.n_hidden = n_hidden
         
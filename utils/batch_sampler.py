@@ -0,0 +1,79 @@
+""" Shuffle the minibatches of an in-memory training set each epoch, without making a shuffled copy of it.
+
+The training functions take minibatch index of rows perm[index * batch_size:(index + 1) * batch_size] of the
+training data, where perm is a shared vector of row indices (see SdA.pretraining_functions).  A BatchSampler
+owns perm, and draws a new permutation into it at the start of each epoch, so the data never move and
+nothing is recompiled.
+
+The rows of the data are stored in plate order, so a plain shuffle still gives minibatches with more rows of
+the large plates than of the small.  The sampler can instead stratify the permutation by the chunks of the
+data file (each of which holds consecutive plates): every minibatch then draws from each chunk in proportion
+to its size.
+
+The permutation is kept in shared memory, so worker processes forked after the sampler is built (see
+parallel_sgd.py) see each new permutation too. """
+
+import ctypes
+from multiprocessing import RawArray
+
+import numpy as np
+
+
+class BatchSampler(object):
+
+    def __init__(self, n_rows, strata=None, seed=1234):
+        """ A sampler of permutations of the rows of a training set.
+
+        :type n_rows: int
+        :param n_rows: the number of rows in the training set
+
+        :type strata: list of int
+        :param strata: if given, stratify the permutation by consecutive blocks of rows of these sizes
+                       (e.g the number of rows of each chunk read from the data file), which must add up to n_rows
+
+        :type seed: int
+        :param seed: seed of the random permutations
+        """
+        if strata is not None and sum(strata) != n_rows:
+            errormsg = 'strata of ' + str(sum(strata)) + ' rows given for a training set of ' + str(n_rows) + ' rows'
+            raise ValueError(errormsg)
+
+        self.n_rows = n_rows
+        self.strata = strata
+        self.rng = np.random.RandomState(seed)
+        self.perm = np.frombuffer(RawArray(ctypes.c_int64, n_rows), dtype=np.int64)
+        self.perm[:] = np.arange(n_rows)
+        self.shared_perm = None
+
+    def shared_permutation(self):
+        """ Return the theano shared variable holding the permutation, to pass as perm to the SdA training
+        functions.  It shares its memory with the sampler, so each shuffle is seen by the compiled functions. """
+        if self.shared_perm is None:
+            import theano
+            self.shared_perm = theano.shared(self.perm, name='perm', borrow=True)
+        return self.shared_perm
+
+    def permutation(self):
+        """ Return a new permutation of the rows, stratified if the sampler has strata """
+        if self.strata is None:
+            return self.rng.permutation(self.n_rows)
+
+        # give the rows of each stratum evenly spaced keys in [0, 1) in a random order, shifted by a random
+        # fraction of the spacing; sorting by key interleaves the strata in proportion to their sizes
+        keys = np.empty(self.n_rows)
+        start = 0
+        for size in self.strata:
+            keys[start:start + size] = (self.rng.permutation(size) + self.rng.uniform()) / size
+            start += size
+        return np.argsort(keys, kind='mergesort')
+
+    def shuffle(self):
+        """ Draw a new permutation into the shared permutation, in place.  Call at the start of each epoch. """
+        self.perm[:] = self.permutation()
+
+
+def chunk_rows(data_set_file, num_files, offset):
+    """ Return the number of rows in each of the num_files chunks from offset of the open hdf5 file, the
+    strata for a training set read with extract_unlabeled_chunkrange or load_window. """
+    arrays_list = data_set_file.listNodes("/recarrays", classname='Array')
+    return [datanode.shape[0] for datanode in arrays_list[offset:offset + num_files]]
@@ -0,0 +1,145 @@
+""" Stream the /recarrays chunks of an hdf5 data file one at a time, rather than stacking a fixed number of
+chunks into one large array.  The next chunk is read and scaled on a background thread while the current
+chunk is being trained on, so at most two chunks are ever held in memory.  This lets an SdA be trained
+on an entire replicate with a bounded memory footprint. """
+
+import sys
+import threading
+import Queue
+
+import numpy as np
+
+from load_shared import preprocess_unlabeled
+from extract_datasets import read_into, feature_columns
+
+
+class ChunkStream(object):
+
+    def __init__(self, data_set_file, offset=0, num_files=None, features=(5,916), dtype=np.float32, buffers=2, root="/recarrays", scaler=None):
+        """ A double-buffered stream of scaled data chunks.
+
+        :type data_set_file: pytables file reference
+        :param data_set_file: an open hdf5 file.  It must stay open for as long as the stream is in use,
+                              and should not be read by any other thread in the meantime.
+
+        :type offset: int
+        :param offset: index of the first chunk to stream
+
+        :type num_files: int
+        :param num_files: number of chunks to stream, or None for all the chunks from offset to the end
+
+        :type features: tuple
+        :param features: keep only those features indexed between features[0],features[1]
+
+        :type dtype: numpy dtype
+        :param dtype: the dtype of the streamed chunks, this should match theano.config.floatX
+
+        :type buffers: int
+        :param buffers: maximum number of chunks held in memory at once (the current one plus those prefetched)
+
+        :type scaler: StreamingScaler
+        :param scaler: if given, scale each chunk in place with these precomputed statistics, rather than
+                       with statistics computed over each chunk alone
+        """
+
+        arrays_list = data_set_file.listNodes(root, classname='Array')
+        if num_files is None:
+            num_files = len(arrays_list) - offset
+
+        if num_files <= 0 or num_files + offset > len(arrays_list):
+            errormsg = "cannot stream %d chunks beginning at %d when there are %d chunks" % (num_files, offset, len(arrays_list))
+            raise ValueError(errormsg)
+
+        assert buffers > 1
+
+        self.nodes = arrays_list[offset:offset + num_files]
+        self.features = features
+        self.dtype = dtype
+        self.buffers = buffers
+        self.scaler = scaler
+
+    def chunk_sizes(self):
+        """ Return a nd array of the number of rows in each chunk of the stream """
+        return np.asarray([node.nrows for node in self.nodes], dtype=int)
+
+    def n_features(self):
+        """ Return the number of columns each streamed chunk will have """
+        columns = feature_columns(self.nodes[0], self.features)
+        return len(range(self.nodes[0].shape[1])[columns])
+
+    def n_batches(self, batch_size):
+        """ Return the number of minibatches in one pass over the stream.  Each chunk is split into
+        minibatches separately, so the trailing rows of each chunk are dropped. """
+        return int(np.sum(self.chunk_sizes() / batch_size))
+
+    def shared_buffer(self, borrow=True):
+        """ Return a theano shared variable to hold the current chunk.  Functions compiled against this
+        buffer need no recompilation when a new chunk is swapped in with set_value. """
+        import theano
+
+        placeholder = np.zeros((1, self.n_features()), dtype=self.dtype)
+        return theano.shared(placeholder, borrow=borrow)
+
+    def batch_indices(self, shared_x, batch_size):
+        """ Walk the stream once, swapping each chunk into shared_x and then yielding the index of each
+        minibatch within that chunk.  This is a drop-in replacement for xrange(n_train_batches) in the
+        training loops. """
+        for chunk in self:
+            shared_x.set_value(chunk, borrow=True)
+            for batch_index in xrange(chunk.shape[0] / batch_size):
+                yield batch_index
+
+    def batch_blocks(self, shared_x, batch_size, block_size):
+        """ Like batch_indices, but yield the minibatch indices within each chunk in arrays of at most 
+        block_size consecutive indices, for the fused training functions.  A block never spans two chunks. """
+        for chunk in self:
+            shared_x.set_value(chunk, borrow=True)
+            n_batches = chunk.shape[0] / batch_size
+            for start in xrange(0, n_batches, block_size):
+                yield np.arange(start, min(start + block_size, n_batches))
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        """ Yield each scaled chunk in turn, while the next one is read on a background thread. """
+
+        slots = threading.Semaphore(self.buffers)
+        chunks = Queue.Queue()
+        stop = threading.Event()
+        reader = threading.Thread(target=self._read_chunks, args=(chunks, slots, stop))
+        reader.daemon = True
+        reader.start()
+
+        try:
+            while True:
+                item = chunks.get()
+                if item is None:
+                    break
+                if isinstance(item, tuple):
+                    exc_type, exc_value, exc_tb = item
+                    raise exc_type, exc_value, exc_tb
+                yield item
+                # the consumer is done with this chunk, let the reader fetch another
+                slots.release()
+        finally:
+            stop.set()
+            slots.release()
+            reader.join()
+
+    def _read_chunks(self, chunks, slots, stop):
+        """ Read, scale and enqueue each chunk, never holding more than self.buffers chunks at once """
+        try:
+            for node in self.nodes:
+                slots.acquire()
+                if stop.is_set():
+                    return
+                # read only the feature columns, the bookkeeping columns are never loaded
+                raw = np.empty((node.shape[0], self.n_features()), dtype=self.dtype)
+                read_into(node, raw, self.features)
+                data = preprocess_unlabeled(raw, features=self.features, scaler=self.scaler, projected=True)
+                chunks.put(np.ascontiguousarray(data, dtype=self.dtype))
+        except:
+            chunks.put(sys.exc_info())
+            return
+        chunks.put(None)
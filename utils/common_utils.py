@@ -1,5 +1,56 @@
 """ Utility functions for parsing arguments from pretraining, finetuning scripts """
+import os
 import re
+import sys
+import time
+
+import numpy as np
+
+### Buffered, rate limited log file
+class BufferedLog(object):
+    ''' A file-like wrapper around a log file that holds the lines written to it in memory, and writes
+    them out in one go at most every flush_interval seconds (and on flush, close).  Lines written with 
+    progress are also rate limited: at most one every progress_interval seconds is kept, the rest are dropped.
+    Works with print >> log, ... like the file it wraps. '''
+    
+    def __init__(self, output_file, flush_interval=30.0, progress_interval=10.0):
+        self.output_file = output_file
+        self.flush_interval = flush_interval
+        self.progress_interval = progress_interval
+        self.pending = []
+        self.last_flush = time.time()
+        self.last_progress = None
+        
+    def write(self, s):
+        self.pending.append(s)
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+            
+    def progress(self, line):
+        ''' Log this line only if no progress line was logged in the last progress_interval seconds '''
+        now = time.time()
+        if self.last_progress is None or now - self.last_progress >= self.progress_interval:
+            self.last_progress = now
+            self.write(line + '\n')
+    
+    def flush(self):
+        if self.pending:
+            self.output_file.write(''.join(self.pending))
+            self.pending = []
+        self.output_file.flush()
+        self.last_flush = time.time()
+        
+    def close(self):
+        self.flush()
+        self.output_file.close()
+    
+    
+def batch_blocks(n_batches, block_size):
+    ''' Yield the minibatch indices 0 .. n_batches-1 in arrays of at most block_size consecutive indices,
+    for the fused training functions that take a vector of minibatch indices. '''
+    for start in xrange(0, n_batches, block_size):
+        yield np.arange(start, min(start + block_size, n_batches))
+
 
 ### Metadata dict writer
 def write_metadata(output_file, meta_dict):
@@ -7,6 +58,26 @@ def write_metadata(output_file, meta_dict):
     for key in meta_dict:
         print >> output_file, key, meta_dict[key]
 
+def use_compile_cache(cache_dir):
+    ''' Point theano's base compilation directory at cache_dir, so that every job given the same cache_dir 
+    (e.g on shared or node-local disk) re-uses the modules any of them has compiled.  Theano keys its 
+    compiled modules by a hash of their code and locks the directory while compiling, so jobs of all 
+    configurations share it safely, and the modules they have in common (elemwise, GEMM, ...) are only 
+    compiled once.  Must be called before theano is imported, and has no effect if THEANO_FLAGS sets 
+    compiledir itself.  Returns the directory used, or None if cache_dir is None.
+    
+        :type cache_dir: string
+        :param cache_dir: the base compilation directory, shared by the jobs '''
+    if cache_dir is None:
+        return None
+    if 'theano' in sys.modules:
+        print "theano is already imported, not using the compilation cache in " + cache_dir
+        return None
+    compiledir = os.path.abspath(cache_dir)
+    flags = os.environ.get('THEANO_FLAGS', '')
+    os.environ['THEANO_FLAGS'] = ','.join(f for f in [flags, 'base_compiledir=' + compiledir] if f)
+    return compiledir
+    
 def extract_arch(filename, model_regex):
     ''' Return the model architecture of this filename
     Modle filenames look like SdA_1000_500_100_50.pkl'''
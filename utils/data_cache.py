@@ -0,0 +1,151 @@
+""" A cache of scaled training windows, kept as uncompressed .npy files on local disk.  A window (some
+number of chunks from some offset of an hdf5 data file, restricted to a range of features and scaled) is
+read, decompressed and scaled once, then memory mapped by every later job that asks for the same window.
+The cache is kept under a size limit by evicting the least recently used windows. """
+
+import os
+import hashlib
+
+import numpy as np
+
+from extract_datasets import extract_unlabeled_chunkrange
+from load_shared import preprocess_unlabeled
+from streaming_scaler import SCALER_VERSION
+
+
+class DataCache(object):
+
+    def __init__(self, cache_dir, max_bytes=50 * 2**30):
+        """ A directory of cached windows.
+
+        :type cache_dir: string
+        :param cache_dir: the directory holding the cache, ideally on node-local disk.  It is created if need be.
+
+        :type max_bytes: int
+        :param max_bytes: evict the least recently used windows to keep the cache under this size
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # another process may have just made it
+                if not os.path.isdir(cache_dir):
+                    raise
+
+    def key(self, input_file, num_files, offset, features, dtype, scaler=None):
+        """ Return the cache key of a window.  The key changes whenever the input file is rewritten, or the
+        window would be scaled differently. """
+        stat = os.stat(input_file)
+        if scaler is None:
+            scaling = 'per-window'
+        else:
+            digest = hashlib.sha1(np.ascontiguousarray(scaler.mean).tostring())
+            digest.update(np.ascontiguousarray(scaler.var).tostring())
+            scaling = 'scaler-%d-%s' % (SCALER_VERSION, digest.hexdigest())
+        description = repr((os.path.abspath(input_file), stat.st_size, stat.st_mtime, num_files, offset, tuple(features), np.dtype(dtype).str, scaling))
+        return hashlib.sha1(description).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def get(self, key):
+        """ Return the cached window as a read-only memory map, or None if it is not cached """
+        path = self._path(key)
+        try:
+            data = np.load(path, mmap_mode='r')
+        except IOError:
+            return None
+        # mark the window as recently used; another job may have just evicted it, which leaves the map readable
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        """ Write data to the cache under key, then return it as a read-only memory map.  If another job evicts
+        the window before it can be mapped, data is returned as it is. """
+        path = self._path(key)
+        # write through a file handle, so np.save does not add .npy to the temporary name, which evict skips
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        f = open(tmp_path, 'wb')
+        try:
+            np.save(f, data)
+        except:
+            f.close()
+            os.remove(tmp_path)
+            raise
+        f.close()
+        os.rename(tmp_path, path)
+        self.evict(keep=path)
+        mapped = self.get(key)
+        if mapped is None:
+            return data
+        return mapped
+
+    def evict(self, keep=None):
+        """ Remove the least recently used windows until the cache fits under max_bytes.  The window named by
+        keep is never removed.  Windows removed while mapped by another job stay readable by that job. """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            # only complete windows count: windows being written (or left by killed jobs) end in .tmp
+            if not name.endswith('.npy'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+def open_cache(cache_dir, max_gb=50.0):
+    """ Return a DataCache in cache_dir, or None if cache_dir is None """
+    if cache_dir is None:
+        return None
+    return DataCache(cache_dir, max_bytes=int(max_gb * 2**30))
+
+
+def load_window(data_set_file, num_files, offset, features=(5,916), dtype=np.float32, scaler=None, cache=None):
+    """ Return the scaled window of num_files chunks from offset of the open hdf5 file, holding the columns between
+    features[0],features[1].  With a cache, the window is mapped from the cache if it is there, and otherwise
+    computed and added to the cache.  Returns None if the window is not in the file.
+
+    :type data_set_file: pytables file reference
+    :param data_set_file: an open hdf5 file
+
+    :type scaler: StreamingScaler
+    :param scaler: if given, scale with these precomputed statistics rather than those of the window
+
+    :type cache: DataCache
+    :param cache: the cache to use, or None to compute the window every time
+    """
+    if cache is not None:
+        key = cache.key(data_set_file.filename, num_files, offset, features, dtype, scaler)
+        data = cache.get(key)
+        if data is not None:
+            print '... mapped the data from the cache'
+            return data
+
+    datafiles = extract_unlabeled_chunkrange(data_set_file, num_files = num_files, offset = offset, dtype = dtype, features = features)
+    if datafiles is None:
+        return None
+    data = np.asarray(preprocess_unlabeled(datafiles, features, scaler = scaler, projected = True), dtype = dtype)
+
+    if cache is not None:
+        data = cache.put(key, data)
+    return data
@@ -2,26 +2,59 @@
 from tables import *
 import numpy as np
 
-def draw_reference_population(data_set_file,proportion=0.06,root='/plates',ignore_fewer_than=50):
-    """ Walk the tree of plates/<plate>/<well>, drawing a proportionate sample from each well """ 
+from storage_policy import chunkshape_for
+
+def feature_columns(node, features):
+    """ Return the slice of the columns of node selected by the features tuple, which keeps the columns
+    indexed between features[0],features[1] (all of them if features is None). """
+    if features is None:
+        return slice(None)
+    start, stop, step = slice(features[0], features[1]).indices(node.shape[1])
+    return slice(start, max(start, stop))
+
+
+def read_into(node, out, features = None):
+    """ Read the entire contents of node into the preallocated array out, which is usually 
+    a slice of a larger array.  Avoids an intermediate copy when the dtypes agree. 
+    
+    If features is given, only the columns between features[0],features[1] are read from the file.  The other 
+    columns are never copied out of the hdf5 file, and if the node is chunked by column, never decompressed. """
+    if features is not None:
+        out[:] = node[:, feature_columns(node, features)]
+        return
+    if out.dtype == node.dtype:
+        try:
+            node.read(out=out)
+            return
+        except TypeError:
+            # PyTables < 3.0 cannot read into an existing array
+            pass
+    out[:] = node.read()
+
+
+def draw_reference_population(data_set_file,proportion=0.06,root='/plates',ignore_fewer_than=50,dtype=None,features=None):
+    """ Walk the tree of plates/<plate>/<well>, drawing a proportionate sample from each well.
+    The sample is sized from the node shapes up front, so each well sample is written directly into place. 
+    If features is given, only the columns between features[0],features[1] are read. """ 
+    
+    # size the sample population from the node shapes
+    nodes = [node for node in data_set_file.walk_nodes(root, classname='Array') if node.shape[0] >= ignore_fewer_than]
+    if len(nodes) == 0:
+        return None
+    sample_sizes = [int(np.ceil(node.shape[0] * proportion)) for node in nodes]
+    if dtype is None:
+        dtype = nodes[0].dtype
+    sample_pop = _preallocate(nodes, dtype, features, n_rows = sum(sample_sizes))
     
-    # do I have to declare data = np.empty()?; data[:] = datanode.read()?
-    empty = True
-    for node in data_set_file.walk_nodes(root, classname='Array'):
+    row = 0
+    for node, up_to in zip(nodes, sample_sizes):
         try:
-            data = node.read()
-            if data.shape[0] < ignore_fewer_than:
-                continue
-            up_to = int(np.ceil(data.shape[0] *  proportion))
-            data_sample = data[np.random.permutation(data.shape[0])[:up_to],:]
-            if empty:
-                sample_pop = data_sample
-                empty = False
-            else:
-                sample_pop = np.vstack((sample_pop,data_sample))
+            data = node[:, feature_columns(node, features)]
+            sample_pop[row:row + up_to] = data[np.random.permutation(data.shape[0])[:up_to],:]
+            row += up_to
         except:
             print "Encountered a problem at this node: " + node._v_name
-    return sample_pop        
+    return sample_pop[:row]
         
 
 def extract_chunk_sizes(data_set_file):
@@ -32,9 +65,12 @@ def extract_chunk_sizes(data_set_file):
         chunk_sizes[i] = dataNode.nrows
     return chunk_sizes    
 
-def extract_labeled_chunkrange(data_set_file, num_files = 1, offset = 0):
+def extract_labeled_chunkrange(data_set_file, num_files = 1, offset = 0, dtype = None, features = None):
     """ Take a reference to an open hdf5 pytables file, extract the first num_files chunks, stack 
-    them together and return the larger nparray.  Also extract the labels, return them. """    
+    them together and return the larger nparray.  Also extract the labels, return them. 
+    
+    If dtype is given (e.g np.float32) the data are stored in that dtype rather than that of the nodes. 
+    If features is given, only the data columns between features[0],features[1] are read. """    
     arrays_list = data_set_file.listNodes("/recarrays", classname='Array')
     labels_list = data_set_file.listNodes("/labels", classname='Array')
     
@@ -51,27 +87,26 @@ def extract_labeled_chunkrange(data_set_file, num_files = 1, offset = 0):
         print("Error!  Do you really want 0 files?")
         return None
         
-    empty = True
     start = offset 
     end = offset + num_files
-    data = np.empty(arrays_list[start].shape)
-    labels = np.empty(labels_list[start].shape)    
+    data = _preallocate(arrays_list[start:end], dtype, features)
+    labels = _preallocate(labels_list[start:end], None)
     
+    row = 0
     for (datanode, labelnode) in zip(arrays_list[start:end],labels_list[start:end]):
-        if empty:
-            data[:] = datanode.read()
-            labels[:] = labelnode.read()
-            empty = False
-        else:
-            data = np.vstack((data,datanode.read()))
-            labels = np.vstack((labels,labelnode.read()))
+        read_into(datanode, data[row:row + datanode.shape[0]], features)
+        read_into(labelnode, labels[row:row + labelnode.shape[0]])
+        row += datanode.shape[0]
             
     return data, labels
 
 
-def extract_unlabeled_chunkrange(data_set_file, num_files = 1, offset = 0):
+def extract_unlabeled_chunkrange(data_set_file, num_files = 1, offset = 0, dtype = None, features = None):
     """ Take a reference to an open hdf5 pytables file, extract the first num_files chunks, stack 
-    them together and return the larger nparray."""    
+    them together and return the larger nparray.
+    
+    If dtype is given (e.g np.float32) the data are stored in that dtype rather than that of the nodes. 
+    If features is given, only the columns between features[0],features[1] are read. """    
     
     arrays_list = data_set_file.listNodes("/recarrays", classname='Array')
     
@@ -83,38 +118,51 @@ def extract_unlabeled_chunkrange(data_set_file, num_files = 1, offset = 0):
         print("Error!  Asking for", num_files, "data files beginning at", offset, "but only ", (len(arrays_list) - offset),"are available from start to end")
         return None    
     
-    empty = True
     start = offset 
     end = offset + num_files    
-    data = np.empty(arrays_list[start].shape)
+    data = _preallocate(arrays_list[start:end], dtype, features)
     
+    row = 0
     for datanode in arrays_list[start:end]:
-        if empty:
-            data[:] = datanode.read()
-            empty = False
-        else:
-            data = np.vstack((data,datanode.read()))
+        read_into(datanode, data[row:row + datanode.shape[0]], features)
+        row += datanode.shape[0]
             
     return data
 
 
-def extract_unlabeled_byarray(data_set_file, chunk = 1):
-    """ Take a reference to an open hdf5 pytables file, extract the specified chunk which corresponds to an element in arrays_list, return as an nparray. """
+def _preallocate(nodes, dtype, features = None, n_rows = None):
+    """ Allocate an empty array large enough to hold all the rows (or n_rows rows) of nodes, stacked, 
+    and the columns selected by features """
+    if dtype is None:
+        dtype = nodes[0].dtype
+    if n_rows is None:
+        n_rows = sum(node.shape[0] for node in nodes)
+    shape = (n_rows,) + nodes[0].shape[1:]
+    if features is not None:
+        columns = feature_columns(nodes[0], features)
+        shape = (n_rows, columns.stop - columns.start) + shape[2:]
+    return np.empty(shape, dtype=dtype)
+
+
+def extract_unlabeled_byarray(data_set_file, chunk = 1, dtype = None, features = None):
+    """ Take a reference to an open hdf5 pytables file, extract the specified chunk which corresponds to an element in arrays_list, return as an nparray. 
+    If features is given, only the columns between features[0],features[1] are read. """
     arrays_list = data_set_file.listNodes("/recarrays", classname='Array')
     
     if chunk > len(arrays_list):
         print("Error!  Asking for more data than is available")
         return None
     
-    data = np.empty(arrays_list[chunk].shape)
-    data[:] = arrays_list[chunk].read()
+    data = _preallocate(arrays_list[chunk:chunk + 1], dtype, features)
+    read_into(arrays_list[chunk], data, features)
                
     return data
 
 
 
-def extract_labeled_byarray(data_set_file, chunk = 1):
-    """ Take a reference to an open hdf5 pytables file, extract the specified chunk of data and corresponding labels, return as nparrays. """
+def extract_labeled_byarray(data_set_file, chunk = 1, dtype = None):
+    """ Take a reference to an open hdf5 pytables file, extract the specified chunk of data and corresponding labels, return as nparrays. 
+    If dtype is given (e.g np.float32) the data are stored in that dtype rather than that of the node; the labels keep theirs. """
     arrays_list = data_set_file.listNodes("/recarrays", classname='Array')
     labels_list = data_set_file.listNodes("/labels", classname='Array')
     
@@ -122,15 +170,14 @@ def extract_labeled_byarray(data_set_file, chunk = 1):
         print("Error!  Asking for more data than is available")
         return None
     
-    data = np.empty(arrays_list[chunk].shape)
-    labels = np.empty(labels_list[chunk].shape)
-    data[:] = datanode.read()
-    labels[:] = labelnode.read()
+    data = _preallocate(arrays_list[chunk:chunk + 1], dtype)
+    read_into(arrays_list[chunk], data)
+    labels = labels_list[chunk].read()
                 
     return data, labels
 
 
-def store_unlabeled_byarray(data_set_file, arrays_group, zlib_filters, data_range, my_data):
+def store_unlabeled_byarray(data_set_file, arrays_group, zlib_filters, data_range, my_data, chunkshape=None):
     """ Take a reference to an open hdf5 pytables file, and a numpy array, store the numpy array in the specified file. 
             
         :type data_set_file: pytables file reference
@@ -147,16 +194,19 @@ def store_unlabeled_byarray(data_set_file, arrays_group, zlib_filters, data_rang
         
         :type my_data: numpy array
         :param my_data: The numpy array to write to the hdf5 file
+        
+        :type chunkshape: tuple
+        :param chunkshape: The (rows, columns) chunk shape from storage_policy.parse_chunkshape, or None to let pytables choose
     """    
     atom = Atom.from_dtype(my_data.dtype)
     if my_data.shape[0] > 0:
-        ds = data_set_file.createCArray(where=arrays_group, name=data_range, atom=atom, shape=my_data.shape, filters=zlib_filters)
+        ds = data_set_file.createCArray(where=arrays_group, name=data_range, atom=atom, shape=my_data.shape, filters=zlib_filters, chunkshape=chunkshape_for(my_data.shape, chunkshape))
         ds[:] = my_data
     else:
-        ds = data_set_file.createEArray(where=arrays_group, name=data_range, atom=atom, shape=(0,my_data.shape[1]), filters=zlib_filters)
+        ds = data_set_file.createEArray(where=arrays_group, name=data_range, atom=atom, shape=(0,my_data.shape[1]), filters=zlib_filters, chunkshape=chunkshape_for((0,my_data.shape[1]), chunkshape))
     data_set_file.flush()
     
-def store_labeled_byarray(data_set_file, arrays_group, labels_group, zlib_filters, data_range, my_data, my_labels):
+def store_labeled_byarray(data_set_file, arrays_group, labels_group, zlib_filters, data_range, my_data, my_labels, chunkshape=None):
     """ Take a reference to an open hdf5 pytables file, and a numpy array, store the numpy array in the specified file. 
             
         :type data_set_file: pytables file reference
@@ -179,13 +229,16 @@ def store_labeled_byarray(data_set_file, arrays_group, labels_group, zlib_filter
         
         :type my_labels: CArray
         :param my_labels: The CArray directly from the labels hdf5 file
+        
+        :type chunkshape: tuple
+        :param chunkshape: The (rows, columns) chunk shape from storage_policy.parse_chunkshape, or None to let pytables choose
     """ 
     data_atom = Atom.from_dtype(my_data.dtype)
     labels_np = np.empty(my_labels.shape)
     labels_np[:] = my_labels.read()
     labels_atom = Atom.from_dtype(labels_np.dtype)
-    ds = data_set_file.createCArray(where=arrays_group, name=data_range, atom=data_atom, shape=my_data.shape, filters=zlib_filters)
-    ls = data_set_file.createCArray(where=labels_group, name=data_range, atom=labels_atom, shape=my_labels.shape, filters=zlib_filters)
+    ds = data_set_file.createCArray(where=arrays_group, name=data_range, atom=data_atom, shape=my_data.shape, filters=zlib_filters, chunkshape=chunkshape_for(my_data.shape, chunkshape))
+    ls = data_set_file.createCArray(where=labels_group, name=data_range, atom=labels_atom, shape=my_labels.shape, filters=zlib_filters, chunkshape=chunkshape_for(my_labels.shape, chunkshape))
     ds[:] = my_data
     ls[:] = labels_np
     data_set_file.flush()    
\ No newline at end of file
@@ -2,6 +2,7 @@
 
 """ 
 Vacuum up all the object.CSV files from the given input directory, and pack them into an hdf5 file.
+Re-running against an existing hdf5 file only ingests the files that are new or have changed since (see ingest_manifest.py).
 """
 
 from os import listdir, chdir, getcwd
@@ -13,26 +14,35 @@ from tables import Atom
 
 from numpy import genfromtxt
 
+from ingest_manifest import open_for_ingest
+from storage_policy import add_storage_options, storage_from_options, chunkshape_for
+
 
 # Check that options are present, else print help msg
 parser = OptionParser()
 parser.add_option("-i", "--input", dest="indir", help="read input from here")
 parser.add_option("-s", "--suffix", dest="suffix", help="specify the suffix for data files")
 parser.add_option("-f", "--filename", dest="filename", help="specify the .h5 filename that will contain all the data")
+parser.add_option("--fresh", dest="fresh", action="store_true", default=False, help="rebuild the .h5 file from scratch, rather than only ingesting new or changed files")
+add_storage_options(parser)
 (options, args) = parser.parse_args()
 
 # Open and prepare an hdf5 file 
 filename = options.filename
-h5file = openFile(filename, mode = "w", title = "Data File")
+h5file, manifest = open_for_ingest(filename, fresh = options.fresh)
 
 # Create a new group under "/" (root)
-arrays_group = h5file.createGroup("/", 'recarrays', 'The object data arrays')
-zlib_filters = Filters(complib='zlib', complevel=5)
+if '/recarrays' in h5file:
+	arrays_group = h5file.getNode('/recarrays')
+else:
+	arrays_group = h5file.createGroup("/", 'recarrays', 'The object data arrays')
+h5_filters, chunkshape = storage_from_options(options)
 
 # Go and read the files, 
 input_dir = options.indir
 suffix = options.suffix
 cur_dir = getcwd()
+ingested, skipped = 0, 0
 try:
 	files = listdir(input_dir)
 	chdir(input_dir)
@@ -42,13 +52,23 @@ except:
 else:
 	for f in files:
 		if f.endswith(suffix):
+			status = manifest.status(f)
+			if status == 'done':
+				skipped += 1
+				continue
+			if status != 'new':
+				print "re-ingesting changed file " + f
+				manifest.roll_back(f)
 			data_range = f.split('.')[0]
 			my_data = genfromtxt(f, delimiter=',', autostrip = True)
+			manifest.begin(f, [(arrays_group._v_pathname + '/' + data_range, 0, my_data.shape[0])])
 			atom = Atom.from_dtype(my_data.dtype)
-			ds = h5file.createCArray(where=arrays_group, name=data_range, atom=atom, shape=my_data.shape, filters=zlib_filters)
+			ds = h5file.createCArray(where=arrays_group, name=data_range, atom=atom, shape=my_data.shape, filters=h5_filters, chunkshape=chunkshape_for(my_data.shape, chunkshape))
 			ds[:] = my_data
-			h5file.flush()
+			manifest.commit(f)
+			ingested += 1
 	chdir(cur_dir)
+	print "ingested %d files, skipped %d unchanged files" % (ingested, skipped)
 
 h5file.close()
 
@@ -1,12 +1,17 @@
 #! /usr/bin/env python
 
-""" 
+"""
 Vacuum up all the object.CSV files from the given input directory, and pack them into an hdf5 file that is organized by plate.well
 Plates go 1 .. 14.  Rows go 1 ... 16, Cols 1 ... 24.
+
+The CSV files are parsed in a pool of worker processes, which also group the rows of each file by well.  This process
+appends one batch of rows per well per file to the hdf5 file, in the order the files are listed.
+Re-running against an existing hdf5 file only ingests the files that are new or have changed since (see ingest_manifest.py).
 """
 
 import os
 from optparse import OptionParser
+from multiprocessing import Pool, cpu_count
 import pandas
 
 from tables.file import File, openFile
@@ -15,83 +20,145 @@ from tables import Atom
 
 import numpy as np
 
-# Check that options are present, else print help msg
-parser = OptionParser()
-parser.add_option("-i", "--input", dest="indir", help="read input from here")
-parser.add_option("-s", "--suffix", dest="suffix", help="specify the suffix for data files")
-parser.add_option("-d", "--dataframe", dest="dataframe", help="read a csv file describing the data set here")
-parser.add_option("-o", "--filename", dest="filename", help="specify the .h5 filename that will contain all the data")
-(options, args) = parser.parse_args()
-
-# Open and prepare an hdf5 file 
-filename = options.filename
-h5file = openFile(filename, mode = "w", title = "Data File")
-
-# Load the dataframe describing the layout of the experimental data
-df = pandas.read_csv(options.dataframe)
-all_plates = set(df['Plate'])
-
-# Create a new group under "/" (root)
-plates_group = h5file.createGroup("/", 'plates', 'the plates for this replicate')
-
-# Create a group for each plate
-for plate in all_plates:
-    desc = "plate number " + str(plate)
-    h5file.createGroup("/plates/",str(plate),desc)
+from ingest_manifest import open_for_ingest, file_sha1
+from storage_policy import add_storage_options, storage_from_options, chunkshape_for
 
-# build a lookup of image number to plate, well
-img_to_pw = {}
 
-# populate the lookup table of image number to (plate, well)
-for index, rec in df.iterrows():
-    for img_num in xrange(rec['Low'],rec['High'] + 1):
+def build_img_to_pw(df):
+    """ Build the lookup array of image number to (plate, well) from the dataframe describing the layout of
+    the experiment.  Row img_num of the returned array holds the plate and well of that image, or (-1, -1)
+    for an image number that is not in the layout. """
+    img_to_pw = -np.ones((int(df['High'].max()) + 1, 2), dtype=int)
+    for index, rec in df.iterrows():
         well = (int(rec['Row']) - 1) * 24 + int(rec['Col'])
-        img_to_pw[img_num] = (rec['Plate'],well)
-
-# get the root
-root = h5file.root
-
-# Go and read the files, 
-input_dir = options.indir
-suffix = options.suffix
-cur_dir = os.getcwd()
-try:
-    files = os.listdir(input_dir)
-    os.chdir(input_dir)
-except:
-    print "Could not read files from " + input_dir
-
-# Read all the files, process 'em.
-zlib_filters = Filters(complib='zlib', complevel=5)
-for i,f in enumerate(files):
-    if i % 10 == 0:
-        print "processing %s, %d files done of %d total" % (f,i,len(files))
-    if f.endswith(suffix):
-        my_data = np.genfromtxt(f, delimiter=',', autostrip = True)
-        atom = Atom.from_dtype(my_data.dtype)
-        # slice this data file by grouped image numbers
-        min_img, max_img = int(min(my_data[:,0])), int(max(my_data[:,0]))
-        for img_num in xrange(min_img,max_img+1):
-            try:
-                plate, well = img_to_pw[img_num]
-            except KeyError as e:
-                print "image number not found in image to well map: " + str(img_num)
-                continue
-            objs = my_data[my_data[:,0] == img_num]
+        img_to_pw[int(rec['Low']):int(rec['High']) + 1] = (int(rec['Plate']), well)
+    return img_to_pw
+
+
+def init_worker(lookup):
+    """ Give each worker process the image number to (plate, well) lookup array """
+    global img_to_pw
+    img_to_pw = lookup
+
+
+def parse_and_group(f):
+    """ Parse one object CSV file, and group its rows by well.  The rows of each well stay ordered by image
+    number, and by their order in the file within each image.  Return (f, n_rows, groups, missing, sha1) where groups
+    is a list of (plate, well, rows), missing holds the image numbers that are not in the lookup, and sha1 is the
+    hash of the file. """
+    my_data = pandas.read_csv(f, header=None, skipinitialspace=True, dtype=np.float64, float_precision='round_trip').values
+    img_nums = my_data[:,0].astype(int)
+
+    # look up the plate, well of each row at once
+    known = (img_nums >= 0) & (img_nums < img_to_pw.shape[0])
+    pw = -np.ones((my_data.shape[0], 2), dtype=int)
+    pw[known] = img_to_pw[img_nums[known]]
+    missing = np.unique(img_nums[pw[:,0] < 0])
+
+    # sort rows by plate, well, then image number; the sort is stable so rows keep their file order within an image
+    order = np.lexsort((img_nums, pw[:,1], pw[:,0]))
+    order = order[pw[order,0] >= 0]
+    sorted_pw = pw[order]
+
+    # split the sorted rows wherever the (plate, well) changes
+    changes = np.flatnonzero(np.any(sorted_pw[1:] != sorted_pw[:-1], axis=1)) + 1
+    starts = np.concatenate(([0], changes))
+    ends = np.concatenate((changes, [order.shape[0]]))
+    groups = [(sorted_pw[s,0], sorted_pw[s,1], my_data[order[s:e]]) for s, e in zip(starts, ends) if e > s]
+    return f, my_data.shape[0], groups, missing, file_sha1(f)
+
+
+if __name__ == "__main__":
+
+    # Check that options are present, else print help msg
+    parser = OptionParser()
+    parser.add_option("-i", "--input", dest="indir", help="read input from here")
+    parser.add_option("-s", "--suffix", dest="suffix", help="specify the suffix for data files")
+    parser.add_option("-d", "--dataframe", dest="dataframe", help="read a csv file describing the data set here")
+    parser.add_option("-o", "--filename", dest="filename", help="specify the .h5 filename that will contain all the data")
+    parser.add_option("--fresh", dest="fresh", action="store_true", default=False, help="rebuild the .h5 file from scratch, rather than only ingesting new or changed files")
+    parser.add_option("-w", "--workers", dest="workers", type="int", default=cpu_count(), help="parse the CSV files in this many processes (default: one per core)")
+    add_storage_options(parser)
+    (options, args) = parser.parse_args()
+
+    # Open and prepare an hdf5 file
+    filename = options.filename
+    h5file, manifest = open_for_ingest(filename, fresh = options.fresh)
+
+    # Load the dataframe describing the layout of the experimental data
+    df = pandas.read_csv(options.dataframe)
+    all_plates = set(df['Plate'])
+
+    # Create a new group under "/" (root)
+    if '/plates' not in h5file:
+        plates_group = h5file.createGroup("/", 'plates', 'the plates for this replicate')
+
+    # Create a group for each plate
+    for plate in all_plates:
+        if "/plates/" + str(plate) not in h5file:
+            desc = "plate number " + str(plate)
+            h5file.createGroup("/plates/",str(plate),desc)
+
+    # build the lookup array of image number to (plate, well)
+    img_to_pw = build_img_to_pw(df)
+
+    # get the root
+    root = h5file.root
+
+    # Go and read the files,
+    input_dir = options.indir
+    suffix = options.suffix
+    cur_dir = os.getcwd()
+    try:
+        files = os.listdir(input_dir)
+        os.chdir(input_dir)
+    except:
+        print "Could not read files from " + input_dir
+    data_files = [f for f in files if f.endswith(suffix)]
+
+    # Skip the files already ingested, remove the old data of those that have changed since
+    new_files = []
+    for f in data_files:
+        status = manifest.status(f)
+        if status == 'done':
+            continue
+        if status != 'new':
+            print "re-ingesting changed file " + f
+            manifest.roll_back(f)
+        new_files.append(f)
+    print "ingesting %d files, skipping %d unchanged files" % (len(new_files), len(data_files) - len(new_files))
+
+    # Parse the files in the pool, append each well's batch of rows as the files come back in order.
+    h5_filters, chunkshape = storage_from_options(options)
+    pool = Pool(processes=options.workers, initializer=init_worker, initargs=(img_to_pw,))
+    for i, (f, n_rows, groups, missing, sha1) in enumerate(pool.imap(parse_and_group, new_files)):
+        if i % 10 == 0:
+            print "processing %s, %d files done of %d total" % (f,i,len(new_files))
+        for img_num in missing:
+            print "image number not found in image to well map: " + str(img_num)
+
+        # record where this file's rows will go before writing them
+        targets = []
+        for plate, well, objs in groups:
+            well_node = "/plates/" + str(plate) + "/" + str(well)
+            start = h5file.get_node(where=well_node).nrows if h5file.__contains__(well_node) else 0
+            targets.append((well_node, start, objs.shape[0]))
+        manifest.begin(f, targets, sha1=sha1)
+
+        for plate, well, objs in groups:
             well_group = "/plates/" + str(plate)
             well_node = "/plates/" + str(plate) + "/" + str(well)
             if h5file.__contains__(well_node):
                 # some data for this well exists in an EArray already, append this data to it.
                 ds = h5file.get_node(where=well_node)
-                ds.append(objs)				
             else:
                 # no data from images belonging to this well have yet been dumped into an EArray.
-                ds = h5file.create_earray(where=well_group, name=str(well), atom=atom, shape=(0,my_data.shape[1]), filters=zlib_filters)
-                ds.append(objs)				
-            h5file.flush()
-os.chdir(cur_dir)
-print "done!"
-h5file.close()
-
-
-
+                atom = Atom.from_dtype(objs.dtype)
+                ds = h5file.create_earray(where=well_group, name=str(well), atom=atom, shape=(0,objs.shape[1]), filters=h5_filters, chunkshape=chunkshape_for((0,objs.shape[1]), chunkshape))
+            ds.append(objs)
+        manifest.commit(f)
+    pool.close()
+    pool.join()
+    os.chdir(cur_dir)
+    print "done!"
+    h5file.close()
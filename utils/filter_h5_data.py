@@ -1,14 +1,21 @@
 #! /usr/bin/env python
 
-""" 
+"""
 Pass all cells in all wells of the input h5 file through the filters provided.  The output is another h5 file whose
 tree mimics the input, but contains only the filtered cells.
+
+The plates are shared out among worker processes, which each read (decompress) and filter the wells of a plate.
+The filtered wells are sent back to this process, which is the only one that writes to the output file.
 """
 
 import os
+import time
+import Queue as queue
+from multiprocessing import Process, Queue, cpu_count
 from optparse import OptionParser
 
-from load_shared import apply_constraints
+from load_shared import apply_constraints, load_constraints
+from storage_policy import add_storage_options, storage_from_options, chunkshape_for
 
 from tables.file import File, open_file
 from tables import Filters
@@ -16,49 +23,106 @@ from tables import Atom
 
 import numpy as np
 
-# Check that options are present, else print help msg
-parser = OptionParser()
-parser.add_option("-i", "--input", dest="infile", help="read input h5 from here")
-parser.add_option("-f", "--filters", dest="filters", help="read the filters from here")
-parser.add_option("-o", "--filename", dest="filename", help="specify the .h5 filename that will contain all the filtered data")
-(options, args) = parser.parse_args()
-
-# Open and prepare input and output hdf5 files 
-filename = options.filename
-h5output = open_file(filename, mode = "w", title = "Filtered Data File")
-zlib_filters = Filters(complib='zlib', complevel=5)
-
-h5input = open_file(options.infile, mode = "r")
-
-# Create a new group under "/" (root)
-plates_group = h5output.createGroup("/", 'plates', 'the plates for this replicate')
-
-all_plates = [p._v_name for p in h5input.walk_groups("/plates")]
-all_plates = all_plates[1:]
-
-# Create a group for each plate in the output file
-for plate in all_plates:
-    desc = "plate number " + plate
-    h5output.create_group("/plates/",plate,desc)
-
-# Walk the input file, filtering each well we encounter, save to the output file
-for p in all_plates:
-    plate_group = "/plates/" + p
-    print "processing plate %s " % (p)
-    for w in h5input.walk_nodes(where=plate_group, classname='EArray'):
-        well_name = w._v_name
-        raw_data = w.read()
-        filtered_data = apply_constraints(raw_data, constraints_file=options.filters)
+
+def filter_plates(infile, constraints, plates, filtered):
+    """ Worker process: take plate names from the plates queue until a None is found.  Read and filter each well
+    of the plate, and put (plate, well, filtered data, cells read, bytes read, rejected counts) on the filtered queue.
+    Once every well of a plate is done, put (plate, None, ...) on the filtered queue. """
+    h5input = open_file(infile, mode = "r")
+    for p in iter(plates.get, None):
+        plate_group = "/plates/" + p
+        for w in h5input.walk_nodes(where=plate_group, classname='EArray'):
+            raw_data = w.read()
+            filtered_data, well_rejected = apply_constraints(raw_data, constraints, in_place=True, return_counts=True)
+            # send a copy of only the surviving rows
+            filtered.put((p, w._v_name, np.array(filtered_data), raw_data.shape[0], raw_data.nbytes, well_rejected))
+        filtered.put((p, None, None, 0, 0, None))
+    h5input.close()
+
+
+if __name__ == "__main__":
+
+    # Check that options are present, else print help msg
+    parser = OptionParser()
+    parser.add_option("-i", "--input", dest="infile", help="read input h5 from here")
+    parser.add_option("-f", "--filters", dest="filters", help="read the filters from here")
+    parser.add_option("-o", "--filename", dest="filename", help="specify the .h5 filename that will contain all the filtered data")
+    parser.add_option("-w", "--workers", dest="workers", type="int", default=cpu_count(), help="read and filter the plates in this many processes (default: one per core)")
+    add_storage_options(parser)
+    (options, args) = parser.parse_args()
+
+    # Open and prepare input and output hdf5 files
+    filename = options.filename
+    h5output = open_file(filename, mode = "w", title = "Filtered Data File")
+    h5_filters, chunkshape = storage_from_options(options)
+
+    h5input = open_file(options.infile, mode = "r")
+
+    # Read the constraints once, and count how many cells each one rejects
+    constraints = load_constraints(options.filters)
+    rejected = dict((name, 0) for name in constraints[0])
+    total_cells, kept_cells, total_bytes = 0, 0, 0
+
+    # Create a new group under "/" (root)
+    plates_group = h5output.createGroup("/", 'plates', 'the plates for this replicate')
+
+    all_plates = [p._v_name for p in h5input.walk_groups("/plates")]
+    all_plates = all_plates[1:]
+    h5input.close()
+
+    # Create a group for each plate in the output file, and queue the plate up for the workers
+    plates = Queue()
+    for plate in all_plates:
+        desc = "plate number " + plate
+        h5output.create_group("/plates/",plate,desc)
+        plates.put(plate)
+
+    # Bound the number of filtered wells waiting to be written
+    filtered = Queue(maxsize = 4 * options.workers)
+    workers = [Process(target=filter_plates, args=(options.infile, constraints, plates, filtered)) for i in xrange(options.workers)]
+    for worker in workers:
+        plates.put(None)
+        worker.start()
+
+    # Write each filtered well as it arrives, flush once each plate is complete
+    start_time = time.time()
+    plates_done = 0
+    while plates_done < len(all_plates):
+        try:
+            p, well_name, filtered_data, n_cells, n_bytes, well_rejected = filtered.get(timeout=10)
+        except queue.Empty:
+            if not any(worker.is_alive() for worker in workers):
+                print "All workers have exited, but only %d of %d plates were filtered" % (plates_done, len(all_plates))
+                break
+            continue
+
+        if well_name is None:
+            h5output.flush()
+            plates_done += 1
+            elapsed = time.time() - start_time
+            print "processed plate %s (%d of %d), %.0f cells/sec, %.1f MB/sec" % (p, plates_done, len(all_plates), total_cells / elapsed, total_bytes / elapsed / 2**20)
+            continue
+
+        for name in well_rejected:
+            rejected[name] += well_rejected[name]
+        total_cells += n_cells
+        total_bytes += n_bytes
+        kept_cells += filtered_data.shape[0]
+
+        plate_group = "/plates/" + p
         atom = Atom.from_dtype(filtered_data.dtype)
         if (filtered_data.shape[0] > 0):
-            ds = h5output.create_carray(where=plate_group, name=well_name, atom=atom, shape=filtered_data.shape, filters=zlib_filters)
+            ds = h5output.create_carray(where=plate_group, name=well_name, atom=atom, shape=filtered_data.shape, filters=h5_filters, chunkshape=chunkshape_for(filtered_data.shape, chunkshape))
             ds[:] = filtered_data
         else:
-            ds = h5output.create_earray(where=plate_group, name=well_name, atom=atom, shape=(0,filtered_data.shape[1]), filters=zlib_filters)
-        h5output.flush()
-print "done writing to h5 output file"
-h5output.close()
-h5input.close()
-
-
+            ds = h5output.create_earray(where=plate_group, name=well_name, atom=atom, shape=(0,filtered_data.shape[1]), filters=h5_filters, chunkshape=chunkshape_for((0,filtered_data.shape[1]), chunkshape))
 
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start_time
+    print "done writing to h5 output file"
+    print "kept %d of %d cells" % (kept_cells, total_cells)
+    print "filtered %d cells (%.1f MB) in %.1fs: %.0f cells/sec, %.1f MB/sec" % (total_cells, total_bytes / 2.0**20, elapsed, total_cells / elapsed, total_bytes / elapsed / 2**20)
+    for name in constraints[0]:
+        print "%s rejected %d cells" % (name, rejected[name])
+    h5output.close()
@@ -0,0 +1,193 @@
+""" A manifest of the CSV files ingested into an hdf5 file, stored in the hdf5 file itself as the table /manifest.
+Each row records one input file and one node it was written to: the file's name, size, mtime and sha1 hash,
+the node, the row of the node where the file's data starts, the number of rows written, and whether the
+write completed.  Re-running an ingestion script against the same hdf5 file then only ingests new or changed
+files, and rolls back the partial write of a file that was interrupted by a crash. """
+
+import os
+import hashlib
+
+import tables
+
+# the longest file name and node path the manifest can hold; longer ones would be silently truncated
+MAX_FILENAME = 256
+MAX_NODE = 128
+
+
+class ManifestRecord(tables.IsDescription):
+    filename = tables.StringCol(MAX_FILENAME)
+    size = tables.Int64Col()
+    mtime = tables.Float64Col()
+    sha1 = tables.StringCol(40)
+    node = tables.StringCol(MAX_NODE)
+    start = tables.Int64Col()
+    rows = tables.Int64Col()
+    status = tables.StringCol(8)
+
+
+def file_sha1(filename, block_size=2**20):
+    """ Return the hex sha1 digest of the contents of filename """
+    digest = hashlib.sha1()
+    f = open(filename, 'rb')
+    for block in iter(lambda: f.read(block_size), ''):
+        digest.update(block)
+    f.close()
+    return digest.hexdigest()
+
+
+def file_stat(filename):
+    """ Return the (size, mtime) of filename """
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime
+
+
+class IngestManifest(object):
+
+    def __init__(self, h5file, name='manifest'):
+        """ Open the manifest table of h5file, creating it if it does not exist.
+
+        :type h5file: pytables file reference
+        :param h5file: the hdf5 file being ingested into, open for writing
+
+        :type name: string
+        :param name: the name of the manifest table, under the root
+        """
+        self.h5file = h5file
+        if '/' + name in h5file:
+            self.table = h5file.getNode('/', name)
+        else:
+            self.table = h5file.createTable('/', name, ManifestRecord, 'files ingested into this data file')
+
+    def _rows(self, filename):
+        """ Return the manifest rows for filename, as a list of dicts """
+        names = self.table.colnames
+        return [dict((col, row[col]) for col in names) for row in self.table.where('filename == f', condvars={'f': filename})]
+
+    def status(self, filename):
+        """ Return 'new' if filename has not been ingested, 'done' if it has been ingested and is unchanged since,
+        'changed' if it has been ingested but has changed since, or 'partial' if its ingestion was interrupted.
+        The (expensive) hash is only computed when the size or mtime of the file differs from the manifest. """
+        records = self._rows(filename)
+        if not records:
+            return 'new'
+        if any(r['status'] != 'done' for r in records):
+            return 'partial'
+        size, mtime = file_stat(filename)
+        if size == records[0]['size'] and mtime == records[0]['mtime']:
+            return 'done'
+        if size == records[0]['size'] and file_sha1(filename) == records[0]['sha1']:
+            # touched but not changed, remember the new mtime
+            for row in self.table.where('filename == f', condvars={'f': filename}):
+                row['mtime'] = mtime
+                row.update()
+            self.table.flush()
+            return 'done'
+        return 'changed'
+
+    def incomplete(self):
+        """ Return the names of the files whose ingestion was interrupted """
+        return sorted(set(row['filename'] for row in self.table.where('status != "done"')))
+
+    def begin(self, filename, targets, sha1=None):
+        """ Record that filename is about to be written to the given targets, before writing anything.
+
+        :type filename: string
+        :param filename: the name of the input file (relative to the input directory)
+
+        :type targets: list of tuples
+        :param targets: (node, start, rows) for each node the file is written to: the path of the node,
+                        the row of the node where the file's data will start, and the number of rows
+        
+        Raises a ValueError if the name of the file or of a node is too long for the manifest: a truncated
+        name would never match the file again, and it would be ingested again on every run.
+        """
+        if len(filename) > MAX_FILENAME:
+            errormsg = 'the file name ' + filename + ' is longer than the ' + str(MAX_FILENAME) + ' characters the manifest can record'
+            raise ValueError(errormsg)
+        for node, start, rows in targets:
+            if len(node) > MAX_NODE:
+                errormsg = 'the node ' + node + ' is longer than the ' + str(MAX_NODE) + ' characters the manifest can record'
+                raise ValueError(errormsg)
+        size, mtime = file_stat(filename)
+        if sha1 is None:
+            sha1 = file_sha1(filename)
+        if not targets:
+            # nothing of this file will be written, but record that it has been seen
+            targets = [('', 0, 0)]
+        row = self.table.row
+        for node, start, rows in targets:
+            row['filename'] = filename
+            row['size'] = size
+            row['mtime'] = mtime
+            row['sha1'] = sha1
+            row['node'] = node
+            row['start'] = start
+            row['rows'] = rows
+            row['status'] = 'started'
+            row.append()
+        self.table.flush()
+        self.h5file.flush()
+
+    def commit(self, filename):
+        """ Record that all of filename has been written """
+        self.h5file.flush()
+        for row in self.table.where('filename == f', condvars={'f': filename}):
+            row['status'] = 'done'
+            row.update()
+        self.table.flush()
+        self.h5file.flush()
+
+    def roll_back(self, filename):
+        """ Remove all the data written for filename, and its manifest rows, so that it can be ingested again.
+        The data of a file may be a whole node, which is removed, or a segment of an EArray shared with other
+        files, which is cut out (and the starts of the segments after it are shifted down). """
+        for record in self._rows(filename):
+            if record['rows'] == 0 or record['node'] not in self.h5file:
+                continue
+            node = self.h5file.getNode(record['node'])
+            if not isinstance(node, tables.EArray):
+                self.h5file.removeNode(node)
+                continue
+            start, rows = record['start'], record['rows']
+            if record['status'] != 'done':
+                # an interrupted write was the last write to this node, drop whatever part of it made it to disk
+                node.truncate(min(start, node.nrows))
+                continue
+            tail = node.read(start + rows, node.nrows)
+            node.truncate(start)
+            if tail.shape[0] > 0:
+                node.append(tail)
+            for row in self.table.where('(node == n) & (start > s)', condvars={'n': record['node'], 's': start}):
+                row['start'] -= rows
+                row.update()
+        self.forget(filename)
+        self.h5file.flush()
+
+    def forget(self, filename):
+        """ Remove the manifest rows for filename """
+        coords = self.table.getWhereList('filename == f', condvars={'f': filename})
+        for coord in sorted(coords, reverse=True):
+            self.table.removeRows(coord, coord + 1)
+        self.table.flush()
+
+
+def open_for_ingest(filename, fresh=False, title="Data File"):
+    """ Open the hdf5 file to be ingested into.  An existing file is opened for appending, unless fresh is True.
+    Return the open file and its manifest.  Interrupted writes found in the manifest are rolled back.
+
+    An existing data file without a manifest was written by an older version of the ingestion scripts,
+    and cannot be safely added to, so a ValueError is raised. """
+    if fresh or not os.path.exists(filename):
+        h5file = tables.openFile(filename, mode = "w", title = title)
+        return h5file, IngestManifest(h5file)
+
+    h5file = tables.openFile(filename, mode = "a")
+    if '/manifest' not in h5file:
+        h5file.close()
+        errormsg = filename + " has no ingestion manifest, it must be rebuilt from scratch (--fresh)"
+        raise ValueError(errormsg)
+    manifest = IngestManifest(h5file)
+    for f in manifest.incomplete():
+        print "rolling back the interrupted ingestion of " + f
+        manifest.roll_back(f)
+    return h5file, manifest
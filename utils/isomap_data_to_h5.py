@@ -8,6 +8,7 @@ import sys
 import numpy as np
 from tables import *
 from extract_datasets import extract_labeled_chunkrange
+from storage_policy import add_storage_options, storage_from_options, chunkshape_for
 
 # Display progress logs on stdout
 logging.basicConfig(level=logging.INFO,
@@ -22,6 +23,7 @@ op.add_option("--output",
 op.add_option("--size",
               dest="size", type="int", help="Extract the first size chunks of the data set and labels.")
 
+add_storage_options(op)
 (opts, args) = op.parse_args()
 
 
@@ -37,7 +39,7 @@ h5file = openFile(filename, mode = "w", title = "Reduced Data File")
 
 # Create a new group under "/" (root)
 arrays_group = h5file.createGroup("/", 'recarrays', 'The object data arrays')
-zlib_filters = Filters(complib='zlib', complevel=5)
+h5_filters, chunkshape = storage_from_options(opts)
 
 # Extract some of the dataset from the datafile
 X, labels = extract_labeled_chunkrange(datafile, opts.size)
@@ -62,7 +64,7 @@ for i in [10,20,30,40,50]:
     isomap = Isomap(n_neighbors, n_components=i)
     X_iso = isomap.fit_transform(D)
     atom = Atom.from_dtype(X_iso.dtype)
-    ds = h5file.createCArray(where=arrays_group, name=name_dict[i], atom=atom, shape=X_iso.shape, filters=zlib_filters)
+    ds = h5file.createCArray(where=arrays_group, name=name_dict[i], atom=atom, shape=X_iso.shape, filters=h5_filters, chunkshape=chunkshape_for(X_iso.shape, chunkshape))
     ds[:] = X_iso
     h5file.flush()    
         
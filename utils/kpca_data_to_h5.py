@@ -8,6 +8,7 @@ import sys
 import numpy as np
 from tables import *
 from extract_datasets import extract_labeled_chunkrange
+from storage_policy import add_storage_options, storage_from_options, chunkshape_for
 
 # Display progress logs on stdout
 logging.basicConfig(level=logging.INFO,
@@ -23,6 +24,7 @@ op.add_option("--size",
               dest="size", type="int", help="Extract the first size chunks of the data set and labels.")
 
 
+add_storage_options(op)
 (opts, args) = op.parse_args()
 
 
@@ -44,7 +46,7 @@ h5file = openFile(filename, mode = "w", title = "Reduced Data File")
 
 # Create a new group under "/" (root)
 arrays_group = h5file.createGroup("/", 'recarrays', 'The object data arrays')
-zlib_filters = Filters(complib='zlib', complevel=5)
+h5_filters, chunkshape = storage_from_options(opts)
 
 # done, close h5 files
 datafile.close()
@@ -58,7 +60,7 @@ for i in [10,20,30,40,50]:
     kpca = KernelPCA(n_components=i, kernel="rbf", gamma=0.0028942661247167516)
     D_kpca = kpca.fit_transform(D)
     atom = Atom.from_dtype(D_kpca.dtype)
-    ds = h5file.createCArray(where=arrays_group, name=name_dict[i], atom=atom, shape=D_kpca.shape, filters=zlib_filters)
+    ds = h5file.createCArray(where=arrays_group, name=name_dict[i], atom=atom, shape=D_kpca.shape, filters=h5_filters, chunkshape=chunkshape_for(D_kpca.shape, chunkshape))
     ds[:] = D_kpca
     h5file.flush()    
         
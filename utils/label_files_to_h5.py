@@ -19,6 +19,7 @@ from optparse import OptionParser
 from tables.file import File, openFile, copyFile, hdf5Extension
 from tables import Filters
 from tables import Atom
+from storage_policy import add_storage_options, storage_from_options, chunkshape_for
 
 import numpy as np
 
@@ -27,6 +28,7 @@ parser = OptionParser()
 parser.add_option("--labelinput", dest="labels_indir", help="read shape labels from here")
 parser.add_option("--fociinput", dest="foci_indir", help="read foci labels from here")
 parser.add_option("-f", "--filename", dest="filename", help="specify the .h5 filename that will contain the data labels")
+add_storage_options(parser)
 (options, args) = parser.parse_args()
 
 # label conversion dictionary
@@ -64,7 +66,7 @@ def combine_arrays(foci_array,shape_array):
 filename = options.filename
 h5file = openFile(filename, mode = "a", title = "Data File")
 labels_group = h5file.createGroup("/", 'labels', 'The labels and object IDs')
-zlib_filters = Filters(complib='zlib', complevel=5)
+h5_filters, chunkshape = storage_from_options(options)
 
 # Go to the files location in the filesystem.
 shape_input = options.labels_indir
@@ -88,7 +90,7 @@ for (f,s) in zip(foci_files,shape_files):
     shape_array = read_array_from_file(s,shape_input)
     relabeled_array = combine_arrays(foci_array,shape_array)
     atom = Atom.from_dtype(relabeled_array.dtype)
-    labels = h5file.createCArray(where=labels_group, name=label_range, atom=atom, shape=relabeled_array.shape, filters=zlib_filters)
+    labels = h5file.createCArray(where=labels_group, name=label_range, atom=atom, shape=relabeled_array.shape, filters=h5_filters, chunkshape=chunkshape_for(relabeled_array.shape, chunkshape))
     labels[:] = relabeled_array
     h5file.flush()
 
@@ -20,46 +20,161 @@ def opened_w_error(filename, mode="r"):
         finally:
             f.close()
 
-def apply_constraints(data,constraints_file):
-    """ Read constraints from constraints file, filter rows that do not satisfy the constraints, return the array """
+def load_constraints(constraints_file):
+    """ Read the constraints file once, return a tuple (names, positions, lower, upper) of the constrained
+    features: their names, column positions, and (exclusive) lower and upper thresholds. """
     with opened_w_error(constraints_file, mode='rb') as (filename,err):
         if err:
             print('IOError ', err)
             raise err
         else:
             zipped_headers, thresholds = pkl.load(filename)
-            
+    
+    names = [name for position, name in zipped_headers]
+    positions = np.asarray([position for position, name in zipped_headers], dtype=int)
+    lower = np.asarray([thresholds[name][0] for name in names], dtype=np.float64)
+    upper = np.asarray([thresholds[name][1] for name in names], dtype=np.float64)
+    return names, positions, lower, upper
+
+
+def constraints_mask(data, constraints):
+    """ Evaluate all the constraints in one vectorized pass.  Return a tuple (mask, rejected): mask is True for 
+    each row of data that satisfies every constraint, rejected is the number of rows failing each constraint.  
+    A row failing several constraints is counted against each of them.
+    
+    :type data: numpy ndarray
+    :param data: the data to be filtered
+    
+    :type constraints: tuple
+    :param constraints: constraints as returned by load_constraints """
+    names, positions, lower, upper = constraints
+    constrained = data[:,positions]
+    satisfied = (constrained > lower) & (constrained < upper)
+    return satisfied.all(axis=1), (~satisfied).sum(axis=0)
+    
+
+def compact_rows(data, mask, block_size=4096):
+    """ Move the rows of data selected by mask to the front of data, in place, a block at a time.  Return
+    the view of data holding the selected rows. """
+    kept = 0
+    for start in xrange(0, data.shape[0], block_size):
+        block_mask = mask[start:start + block_size]
+        n_kept = np.count_nonzero(block_mask)
+        if n_kept == block_mask.shape[0] and kept == start:
+            # every row so far is kept, nothing to move
+            kept += n_kept
+            continue
+        data[kept:kept + n_kept] = data[start:start + block_size][block_mask]
+        kept += n_kept
+    return data[:kept]
+
+
+def apply_constraints(data, constraints_file, in_place=False, return_index=False, return_counts=False):
+    """ Read constraints from constraints file, filter rows that do not satisfy the constraints, return the array.  
+    All constraints are combined into one mask, which is applied once.
+    
+    :type data: numpy ndarray
+    :param data: the data to be filtered
+    
+    :type constraints_file: string or tuple
+    :param constraints_file: the constraints file, or the constraints already read by load_constraints
+    
+    :type in_place: boolean
+    :param in_place: compact the surviving rows to the front of data rather than copying them, and return 
+                     a view of data.  The contents of data past the surviving rows are then undefined. 
+    
+    :type return_index: boolean
+    :param return_index: return the indices of the surviving rows instead of the rows themselves
+    
+    :type return_counts: boolean
+    :param return_counts: also return a dict of the number of rows rejected by each constraint """
+    if isinstance(constraints_file, tuple):
+        constraints = constraints_file
+    else:
+        constraints = load_constraints(constraints_file)
+    
     #Pare away rows that do not satisfy the constraints
-    for i,position_tup in enumerate(zipped_headers):
-        position, name = position_tup
-        lower, upper = thresholds[name]
-        data = data[(data[:,position] > lower) & (data[:,position] < upper)]
-    return data
+    mask, rejected = constraints_mask(data, constraints)
+    if return_index:
+        filtered = np.flatnonzero(mask)
+    elif in_place:
+        filtered = compact_rows(data, mask)
+    else:
+        filtered = data[mask]
+    
+    if return_counts:
+        names = constraints[0]
+        return filtered, dict(zip(names, rejected))
+    return filtered
 
 
-def load_data_unlabeled(dataset, features = (5,916), borrow=True, do_filter=False, constraints='/scratch/z/zhaolei/lzamparo/sm_rep1_data/Cells_thresholds.pkl'):
-    """ Take an unpacked dataset (from extract_datasets), scale it, and return as a shared theano variable.
+def project_constraints(constraints, features):
+    """ Shift the column positions of the constraints (as returned by load_constraints) so that they apply to 
+    data holding only the columns between features[0],features[1]. """
+    names, positions, lower, upper = constraints
+    if np.any(positions < features[0]) or (features[1] > 0 and np.any(positions >= features[1])):
+        raise ValueError('a constrained feature lies outside the features ' + str(features))
+    return names, positions - features[0], lower, upper
+
+
+def preprocess_unlabeled(dataset, features = (5,916), do_filter=False, constraints='/scratch/z/zhaolei/lzamparo/sm_rep1_data/Cells_thresholds.pkl', scaler=None, projected=False):
+    """ Take an unpacked dataset (from extract_datasets), filter and scale it, and return the numpy ndarray.
+    This is the part of load_data_unlabeled that does not need theano, so it can run off the training thread.
     
     :type dataset: numpy ndarray
     :param dataset: the numpy ndarray returned from some function in extract_dataset
     
     :type features: tuple
-    :param features: keep only those features indexed between features[0],features[1]  """
-    import theano
+    :param features: keep only those features indexed between features[0],features[1]
+    
+    :type scaler: StreamingScaler
+    :param scaler: if given, scale with these precomputed statistics (in place) rather than with
+                   statistics computed over this dataset alone 
+    
+    :type projected: boolean
+    :param projected: dataset holds only the features columns already, since they were selected when reading
+                      it (e.g extract_unlabeled_chunkrange(..., features=features)).  Each feature is scaled 
+                      independently, so this gives the same result as scaling all the columns then slicing. """
     
     if do_filter:
+        if projected and features:
+            constraints = project_constraints(load_constraints(constraints), features)
         data_filtered = apply_constraints(dataset, constraints)
         
     else:
         data_filtered = dataset
     
     # Scale the data: centre, and unit-var.
-    data_scaled = scale(data_filtered)
+    if scaler is not None:
+        data_scaled = scaler.transform(data_filtered, features = features if projected else None)
+    else:
+        data_scaled = scale(data_filtered)
     
     # if features tuple is defined, throw away unwanted columns
-    if features:
+    if features and not projected:
         data_scaled = data_scaled[:,features[0]:features[1]]
         
+    return data_scaled
+
+
+def load_data_unlabeled(dataset, features = (5,916), borrow=True, do_filter=False, constraints='/scratch/z/zhaolei/lzamparo/sm_rep1_data/Cells_thresholds.pkl', scaler=None, projected=False):
+    """ Take an unpacked dataset (from extract_datasets), scale it, and return as a shared theano variable.
+    
+    :type dataset: numpy ndarray
+    :param dataset: the numpy ndarray returned from some function in extract_dataset
+    
+    :type features: tuple
+    :param features: keep only those features indexed between features[0],features[1]
+    
+    :type scaler: StreamingScaler
+    :param scaler: if given, scale with these precomputed statistics (see streaming_scaler.py) 
+    
+    :type projected: boolean
+    :param projected: dataset was read with only the features columns (see preprocess_unlabeled) """
+    import theano
+    
+    data_scaled = preprocess_unlabeled(dataset, features, do_filter, constraints, scaler, projected)
+        
     print '... loading data'
     print '... converting to shared vars'
     
@@ -103,7 +218,8 @@ def load_data_labeled(dataset, labels, ratios = np.array([0.8,0.1,0.1]), feature
     labels_vec = labels[:,0]
     
     if do_filter:
-        dataset_augmented = np.hstack((dataset,labels_vec[:,np.newaxis]))
+        # carry the labels through the filter in the dtype of the data, so float32 data is not upcast
+        dataset_augmented = np.hstack((dataset,labels_vec[:,np.newaxis].astype(dataset.dtype)))
         dataset_filtered = apply_constraints(dataset_augmented,constraints)
         labels_vec = dataset_filtered[:,-1]
         data_scaled = scale(dataset_filtered[:,:-1])
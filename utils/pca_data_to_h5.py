@@ -8,6 +8,7 @@ import sys
 import numpy as np
 from tables import *
 from extract_datasets import extract_labeled_chunkrange
+from storage_policy import add_storage_options, storage_from_options, chunkshape_for
 
 # Display progress logs on stdout
 logging.basicConfig(level=logging.INFO,
@@ -22,6 +23,7 @@ op.add_option("--output",
 op.add_option("--size",
               dest="size", type="int", help="Extract the first size chunks of the data set and labels.")
 
+add_storage_options(op)
 (opts, args) = op.parse_args()
 
 
@@ -43,7 +45,7 @@ h5file = openFile(filename, mode = "w", title = "Reduced Data File")
 
 # Create a new group under "/" (root)
 arrays_group = h5file.createGroup("/", 'recarrays', 'The object data arrays')
-zlib_filters = Filters(complib='zlib', complevel=5)
+h5_filters, chunkshape = storage_from_options(opts)
 
 # done, close h5 files
 datafile.close()
@@ -61,7 +63,7 @@ name_dict = {10: 'dim10', 20: 'dim20', 30: 'dim30', 40: 'dim40', 50: 'dim50'}
 for i in [10,20,30,40,50]:
     D_pca = X_pca[:,0:(i-1)]
     atom = Atom.from_dtype(X_pca.dtype)
-    ds = h5file.createCArray(where=arrays_group, name=name_dict[i], atom=atom, shape=D_pca.shape, filters=zlib_filters)
+    ds = h5file.createCArray(where=arrays_group, name=name_dict[i], atom=atom, shape=D_pca.shape, filters=h5_filters, chunkshape=chunkshape_for(D_pca.shape, chunkshape))
     ds[:] = D_pca
     h5file.flush()     
 
@@ -58,14 +58,11 @@ print("...Grabbing the labels for the validation set")
 start = 0
 data_set_file = openFile('/scratch/z/zhaolei/lzamparo/sm_rep1_data/sample.h5')
 labels_list = data_set_file.listNodes("/labels", classname='Array')
-labels = np.empty(labels_list[start].shape)
-empty = True
+labels = np.empty((sum(node.shape[0] for node in labels_list),) + labels_list[start].shape[1:])
+row = 0
 for labelnode in labels_list:
-    if empty:
-        labels[:] = labelnode.read()
-        empty = False
-    else:
-        labels = np.vstack((labels,labelnode.read()))
+    labels[row:row + labelnode.shape[0]] = labelnode.read()
+    row += labelnode.shape[0]
 data_set_file.close()
 
 print("...Processing SdA .h5 files")
@@ -85,15 +82,12 @@ for infile in files_dict[dimension].split():
     data_set_file = openFile(infile,'r')
     
     # grab all the data
-    empty = True
     nodes_list = data_set_file.listNodes("/recarrays")
-    data = np.empty(nodes_list[0].shape)
+    data = np.empty((sum(node.shape[0] for node in nodes_list),) + nodes_list[0].shape[1:])
+    row = 0
     for node in nodes_list:
-      if empty:
-        data[:] = node.read()
-        empty = False
-      else:
-        data = np.vstack((data,node.read()))
+      data[row:row + node.shape[0]] = node.read()
+      row += node.shape[0]
     data_set_file.close()   
     
     cutoff = min([data.shape[0],labels.shape[0]])
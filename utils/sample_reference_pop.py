@@ -5,6 +5,7 @@ import numpy as np
 from optparse import OptionParser
 
 from extract_datasets import draw_reference_population
+from storage_policy import add_storage_options, storage_from_options, chunkshape_for
 
 # parse required args
 parser = OptionParser()
@@ -12,6 +13,7 @@ parser.add_option("-i", "--input", dest="infile", help="read input h5 from here"
 parser.add_option("-s", "--seed", dest="seed", type=int, help="use this random seed")
 parser.add_option("-p", "--prop", dest="prop", type=float, default=0.10, help="sample this proportion of cells from each well")
 parser.add_option("-o", "--outfile", dest="outfile", help="specify the .h5 file that will contain the sampled data files")
+add_storage_options(parser)
 (options, args) = parser.parse_args()
 
 # set the random seed
@@ -29,10 +31,10 @@ group = outfile.create_group('/', group_name, title=group_title)
 
 # sample from the pop, with default params
 reference_sample = draw_reference_population(infile,proportion=options.prop)
-zlib_filters = tables.Filters(complib='zlib', complevel=5)
+h5_filters, chunkshape = storage_from_options(options)
 atom = tables.Atom.from_dtype(reference_sample.dtype)
 
-ref_h5 = outfile.create_carray(group, node_name, atom=atom, shape=reference_sample.shape, filters=zlib_filters)
+ref_h5 = outfile.create_carray(group, node_name, atom=atom, shape=reference_sample.shape, filters=h5_filters, chunkshape=chunkshape_for(reference_sample.shape, chunkshape))
 ref_h5[:] = reference_sample
 outfile.flush()
 
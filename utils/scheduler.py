@@ -0,0 +1,142 @@
+""" Run a list of model jobs on a pool of slots, in place of the fixed pair of processes (gpu0, gpu1) each
+*_multiproc.py script used to start.  Each slot is a device ('gpu0', 'gpu1', or 'cpu'), and runs one job at
+a time; as soon as a job finishes, the next job in the queue is started on its slot.  A job that fails is
+queued again, up to a number of retries.
+
+Jobs on cpu slots can be limited to a number of OpenMP / BLAS threads each, and pinned to their own cores,
+so that several jobs on one node do not fight over the cores.  BLAS sizes its thread pool when numpy loads it,
+which the drivers do before any job is forked, so the limit has to be in the environment when the driver
+starts: see restart_with_thread_limit.
+
+The model specs of a run can be read from a file with one model per line, as whitespace separated
+key=value pairs, e.g:
+
+    arch=1000-400-20 offset=0
+    restore=SdA_800_800_200_20.pkl offset=5
+
+Blank lines and lines starting with # are ignored.  Values that look like integers are read as integers. """
+
+import os
+import sys
+import time
+import subprocess
+from collections import deque
+from multiprocessing import Process, cpu_count
+
+THREAD_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']
+
+
+def add_scheduler_options(parser):
+    """ Add the --jobs, --devices, --threads and --retries options to an OptionParser """
+    parser.add_option("--jobs", dest="jobs", default=None, help="read the model specs from this file, one model per line as key=value pairs (e.g arch=1000-400-20 offset=5), instead of the two models given on the command line")
+    parser.add_option("--devices", dest="devices", default="gpu0,gpu1", help="comma separated list of the slots to run the models on, one model per slot at a time, e.g gpu0,gpu1 or cpu,cpu,cpu,cpu (default gpu0,gpu1)")
+    parser.add_option("--threads", dest="threads", type="int", default=None, help="limit each model to this many OpenMP/BLAS threads, and pin the models on cpu slots to their own cores")
+    parser.add_option("--retries", dest="retries", type="int", default=0, help="run a model that fails again, up to this many times")
+
+
+def read_job_specs(filename):
+    """ Return the list of model spec dicts in the file """
+    specs = []
+    for line in open(filename):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        spec = {}
+        for pair in line.split():
+            key, value = pair.split('=', 1)
+            spec[key] = int(value) if value.lstrip('-').isdigit() else value
+        specs.append(spec)
+    return specs
+
+
+def slot_cpus(slot, threads, n_cores=None):
+    """ Return the list of cores for the jobs of a slot, when each job has the given number of threads """
+    if n_cores is None:
+        n_cores = cpu_count()
+    return [(slot * threads + k) % n_cores for k in xrange(threads)]
+
+
+def restart_with_thread_limit(threads):
+    """ Limit the OpenMP/BLAS threads of this process and of the jobs it forks.  BLAS reads its limit from
+    the environment when it is loaded, and numpy has loaded it by the time a driver parses its options.  So
+    if the limit is not in the environment yet, set it and start the script again in place of this process
+    (which does not return).  Call it from a driver's __main__ straight after parsing the options. """
+    if threads is None or all(os.environ.get(var) == str(threads) for var in THREAD_VARS):
+        return
+    for var in THREAD_VARS:
+        os.environ[var] = str(threads)
+    os.execv(sys.executable, [sys.executable] + sys.argv)
+
+
+def run_pinned(target, shared_args, private_args, threads, cpus):
+    """ Job process: bind this process to the given cores, and set the OpenMP/BLAS thread limits for the
+    libraries it loads from here on (such as theano's OpenMP code, which the drivers import inside target),
+    then run target(shared_args, private_args).  The BLAS numpy already loaded keeps the thread pool it was
+    started with, see restart_with_thread_limit. """
+    if threads is not None:
+        for var in THREAD_VARS:
+            os.environ[var] = str(threads)
+    if cpus:
+        try:
+            subprocess.call(['taskset', '-p', '-c', ','.join(str(c) for c in cpus), str(os.getpid())], stdout=open(os.devnull, 'w'))
+        except OSError:
+            print "taskset not found, job %s is not pinned to cores" % private_args.get('arch', '')
+    target(shared_args, private_args)
+
+
+def run_jobs(target, shared_args, jobs, devices=('gpu0', 'gpu1'), threads=None, retries=0, poll_interval=1.0):
+    """ Run target(shared_args, job) for each job in jobs, each in its own process, with at most one job per
+    device in devices running at a time.  Each job dict is given the device of its slot as job['gpu'].
+
+    :type target: function
+    :param target: the driver function of a job, e.g pretrain
+
+    :type jobs: list of dict
+    :param jobs: the private arguments of each job, run in this order
+
+    :type devices: list of string
+    :param devices: one device per slot: 'gpu0', 'gpu1', ... or 'cpu'.  A device may appear more than once.
+
+    :type threads: int
+    :param threads: if given, limit each job on a cpu slot to this many threads, pinned to its slot's cores
+
+    :type retries: int
+    :param retries: run a job whose process exits with an error again, up to this many times
+
+    Returns the list of jobs that failed, even after retrying.
+    """
+    pending = deque((job, 0) for job in jobs)
+    running = {}
+    failed = []
+    while pending or running:
+        # backfill every idle slot
+        for slot, device in enumerate(devices):
+            if slot in running or not pending:
+                continue
+            job, attempts = pending.popleft()
+            job = dict(job, gpu=device)
+            if device.startswith('cpu') and threads is not None:
+                job_threads, cpus = threads, slot_cpus(slot, threads)
+            else:
+                job_threads, cpus = None, None
+            process = Process(target=run_pinned, args=(target, shared_args, job, job_threads, cpus))
+            process.start()
+            print "started %s on %s" % (job.get('arch', ''), device)
+            running[slot] = (process, job, attempts)
+
+        time.sleep(poll_interval)
+        for slot in running.keys():
+            process, job, attempts = running[slot]
+            if process.is_alive():
+                continue
+            process.join()
+            del running[slot]
+            if process.exitcode == 0:
+                print "finished %s on %s" % (job.get('arch', ''), job['gpu'])
+            elif attempts < retries:
+                print "%s failed on %s with exit code %d, retrying" % (job.get('arch', ''), job['gpu'], process.exitcode)
+                pending.append((job, attempts + 1))
+            else:
+                print "%s failed on %s with exit code %d" % (job.get('arch', ''), job['gpu'], process.exitcode)
+                failed.append(job)
+    return failed
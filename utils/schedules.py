@@ -0,0 +1,272 @@
+""" Learning rate and momentum schedules for training an SdA, shared by the pretraining, hybrid pretraining
+and finetuning drivers in place of their own decay_learning_rate / reset_learning_rate functions and their
+constant momentum.
+
+A learning rate schedule gives the learning rate of each epoch of a training phase (the pretraining of one
+layer, or finetuning), counting from 0:
+
+    constant     the base rate throughout
+    exponential  the base rate times decay ** epoch
+    step         the base rate times decay ** (epoch // period)
+    cosine       annealed from the base rate down to min_lr over period epochs, along half a cosine
+    restarts     cosine annealing that restarts from the base rate at the end of each cycle, each cycle
+                 mult times longer than the last (SGDR, Loshchilov & Hutter)
+
+A momentum schedule gives the momentum of each update t, counting from 0: either constant, or the ramp-up of
+Sutskever et al. (2013), min(1 - 2 ** (-1 - log2(t // ramp + 1)), max_momentum), which starts at 0.5 and
+rises to max_momentum as the updates go on.
+
+On top of either learning rate schedule, a PlateauReduction scales the learning rate down by a factor
+whenever the validation loss (or, where there is no validation set, the training cost) has not improved for
+a number of checks.
+
+The drivers hold a TrainingSchedule, which sets the theano shared learning rate at the start of each epoch,
+and gives the momentum to pass to the training functions.  Nothing here imports theano. """
+
+import math
+
+import numpy as np
+
+LR_SCHEDULES = ['constant', 'exponential', 'step', 'cosine', 'restarts']
+MOMENTUM_SCHEDULES = ['constant', 'rampup']
+
+# the keys of the shared args read by training_schedule, set from the options of add_schedule_options
+SCHEDULE_OPTIONS = ['lr_schedule', 'lr_decay', 'lr_period', 'min_lr', 'restart_mult', 'plateau', 'plateau_factor',
+                    'momentum_schedule', 'max_momentum', 'ramp_steps']
+
+
+def add_schedule_options(parser, lr_schedule='exponential', lr_decay=0.98, max_momentum=0.8):
+    """ Add the learning rate and momentum schedule options to an OptionParser, with the given defaults """
+    parser.add_option("--lr_schedule", dest="lr_schedule", type="choice", choices=LR_SCHEDULES, default=lr_schedule, help="how the learning rate changes from epoch to epoch: " + ", ".join(LR_SCHEDULES) + " (default " + lr_schedule + ")")
+    parser.add_option("--lr_decay", dest="lr_decay", type=float, default=lr_decay, help="multiply the learning rate by this each epoch (exponential), or each --lr_period epochs (step)")
+    parser.add_option("--lr_period", dest="lr_period", type=int, default=None, help="the number of epochs per step (step, default 10), to anneal over (cosine, default all of them), or in the first cycle (restarts, default 10)")
+    parser.add_option("--min_lr", dest="min_lr", type=float, default=0.0, help="the learning rate at the end of each cosine annealing")
+    parser.add_option("--restart_mult", dest="restart_mult", type=int, default=2, help="make each cycle of the restarts schedule this many times longer than the last")
+    parser.add_option("--plateau", dest="plateau", type=int, default=0, help="reduce the learning rate after this many checks of the validation loss (the training cost when pretraining) without improvement.  0 (default) never reduces it")
+    parser.add_option("--plateau_factor", dest="plateau_factor", type=float, default=0.5, help="multiply the learning rate by this at each plateau")
+    parser.add_option("--momentum_schedule", dest="momentum_schedule", type="choice", choices=MOMENTUM_SCHEDULES, default="constant", help="keep the momentum at --max_momentum (constant, the default), or ramp it up from 0.5 to --max_momentum (rampup)")
+    parser.add_option("--max_momentum", dest="max_momentum", type=float, default=max_momentum, help="the momentum, or its limit when ramped up (default " + str(max_momentum) + ")")
+    parser.add_option("--ramp_steps", dest="ramp_steps", type=int, default=250, help="halve the distance of the momentum to 1 every doubling of this many updates (rampup)")
+
+
+class ConstantSchedule(object):
+
+    def __init__(self, base):
+        self.base = base
+
+    def value(self, epoch):
+        return self.base
+
+
+class ExponentialSchedule(object):
+
+    def __init__(self, base, decay):
+        self.base = base
+        self.decay = decay
+
+    def value(self, epoch):
+        return self.base * self.decay ** epoch
+
+
+class StepSchedule(object):
+
+    def __init__(self, base, decay, period=10):
+        self.base = base
+        self.decay = decay
+        self.period = period
+
+    def value(self, epoch):
+        return self.base * self.decay ** (epoch // self.period)
+
+
+class CosineSchedule(object):
+
+    def __init__(self, base, period, min_value=0.0):
+        """ Anneal from base down to min_value over period epochs, then stay at min_value """
+        self.base = base
+        self.period = max(period, 1)
+        self.min_value = min_value
+
+    def value(self, epoch):
+        progress = min(epoch, self.period) / float(self.period)
+        return self.min_value + 0.5 * (self.base - self.min_value) * (1 + math.cos(math.pi * progress))
+
+
+class WarmRestartSchedule(object):
+
+    def __init__(self, base, period=10, mult=2, min_value=0.0):
+        """ Cosine annealing from base down to min_value, restarting from base after period epochs, then
+        after mult * period more epochs, and so on """
+        self.base = base
+        self.period = max(period, 1)
+        self.mult = mult
+        self.min_value = min_value
+
+    def value(self, epoch):
+        # find the epoch within the current cycle
+        period = self.period
+        while epoch >= period:
+            epoch -= period
+            period *= self.mult
+        return CosineSchedule(self.base, period, self.min_value).value(epoch)
+
+
+class MomentumRampUp(object):
+
+    def __init__(self, max_momentum, ramp=250):
+        """ The momentum schedule of Sutskever et al. (2013), On the importance of initialization and
+        momentum in deep learning """
+        self.max_momentum = max_momentum
+        self.ramp = ramp
+
+    def value(self, t):
+        return min(1 - 2 ** (-1 - math.log(t // self.ramp + 1, 2)), self.max_momentum)
+
+
+class PlateauReduction(object):
+
+    def __init__(self, patience, factor=0.5, threshold=0.995, min_scale=1e-4):
+        """ Track a loss to be minimized, and reduce a scale by factor whenever the loss has not improved on
+        its best value by the relative threshold for patience checks in a row.
+
+        :type patience: int
+        :param patience: the number of checks without improvement before each reduction
+
+        :type factor: float
+        :param factor: multiply the scale by this at each reduction
+
+        :type threshold: float
+        :param threshold: an improvement must bring the loss below best * threshold
+
+        :type min_scale: float
+        :param min_scale: never reduce the scale below this
+        """
+        self.patience = patience
+        self.factor = factor
+        self.threshold = threshold
+        self.min_scale = min_scale
+        self.reset()
+
+    def reset(self):
+        self.scale = 1.0
+        self.best = np.inf
+        self.wait = 0
+
+    def observe(self, loss):
+        """ Check the loss, return True if the scale was reduced """
+        if loss < self.best * self.threshold:
+            self.best = loss
+            self.wait = 0
+            return False
+        self.best = min(self.best, loss)
+        self.wait += 1
+        if self.wait < self.patience or self.scale <= self.min_scale:
+            return False
+        self.scale = max(self.scale * self.factor, self.min_scale)
+        self.wait = 0
+        return True
+
+
+class TrainingSchedule(object):
+
+    def __init__(self, learning_rate, lr_schedule, momentum_schedule, plateau=None):
+        """ Drive the learning rate and momentum of one training run.
+
+        :type learning_rate: theano.tensor.shared
+        :param learning_rate: the learning rate read by the training functions, set by start_epoch
+
+        :type lr_schedule: schedule
+        :param lr_schedule: gives the learning rate of each epoch, e.g an ExponentialSchedule
+
+        :type momentum_schedule: schedule
+        :param momentum_schedule: gives the momentum of each update, e.g a MomentumRampUp
+
+        :type plateau: PlateauReduction
+        :param plateau: if given, scales the learning rate down when the losses passed to observe stall
+        """
+        self.learning_rate = learning_rate
+        self.lr_schedule = lr_schedule
+        self.momentum_schedule = momentum_schedule
+        self.plateau = plateau
+        self.epoch = 0
+
+    def current_lr(self):
+        scale = self.plateau.scale if self.plateau is not None else 1.0
+        return self.lr_schedule.value(self.epoch) * scale
+
+    def start_epoch(self, epoch):
+        """ Set the learning rate for epoch (counting from 0 in this phase), and return it """
+        self.epoch = epoch
+        lr = self.current_lr()
+        self.learning_rate.set_value(np.asarray(lr, dtype=self.learning_rate.dtype))
+        return lr
+
+    def momentum(self, t):
+        """ Return the momentum for update t (counting from 0 in this phase) """
+        return self.momentum_schedule.value(t)
+
+    def observe(self, loss):
+        """ Pass a validation loss (or a training cost) to the plateau reduction, if any.  If it reduces the
+        learning rate, the new rate is set at once.  Returns True if it did. """
+        if self.plateau is None or not self.plateau.observe(loss):
+            return False
+        self.start_epoch(self.epoch)
+        return True
+
+    def restart(self, base=None):
+        """ Start a new phase of training (e.g the next layer), optionally from a new base learning rate """
+        if base is not None:
+            self.lr_schedule.base = base
+        if self.plateau is not None:
+            self.plateau.reset()
+        self.start_epoch(0)
+
+    def state(self):
+        """ Return the state of the plateau reduction, as scalars for a checkpoint """
+        if self.plateau is None:
+            return {}
+        return {'plateau_scale': self.plateau.scale, 'plateau_best': self.plateau.best, 'plateau_wait': self.plateau.wait}
+
+    def restore(self, counters):
+        """ Restore the state returned by state, from the counters of a checkpoint """
+        if self.plateau is not None and 'plateau_scale' in counters:
+            self.plateau.scale = counters['plateau_scale']
+            self.plateau.best = counters['plateau_best']
+            self.plateau.wait = counters['plateau_wait']
+
+
+def training_schedule(learning_rate, args, base_lr, n_epochs):
+    """ Return the TrainingSchedule given by the options of add_schedule_options, held in the dict args.
+
+    :type learning_rate: theano.tensor.shared
+    :param learning_rate: the learning rate read by the training functions
+
+    :type base_lr: float
+    :param base_lr: the learning rate at the start of training
+
+    :type n_epochs: int
+    :param n_epochs: the number of epochs of a phase of training, the default period of cosine annealing
+    """
+    kind = args['lr_schedule']
+    if kind == 'constant':
+        lr_schedule = ConstantSchedule(base_lr)
+    elif kind == 'exponential':
+        lr_schedule = ExponentialSchedule(base_lr, args['lr_decay'])
+    elif kind == 'step':
+        lr_schedule = StepSchedule(base_lr, args['lr_decay'], args['lr_period'] or 10)
+    elif kind == 'cosine':
+        lr_schedule = CosineSchedule(base_lr, args['lr_period'] or n_epochs, args['min_lr'])
+    elif kind == 'restarts':
+        lr_schedule = WarmRestartSchedule(base_lr, args['lr_period'] or 10, args['restart_mult'], args['min_lr'])
+    else:
+        raise ValueError('unknown learning rate schedule ' + str(kind))
+
+    if args['momentum_schedule'] == 'rampup':
+        momentum_schedule = MomentumRampUp(args['max_momentum'], args['ramp_steps'])
+    else:
+        momentum_schedule = ConstantSchedule(args['max_momentum'])
+
+    plateau = PlateauReduction(args['plateau'], args['plateau_factor']) if args['plateau'] > 0 else None
+    schedule = TrainingSchedule(learning_rate, lr_schedule, momentum_schedule, plateau)
+    schedule.start_epoch(0)
+    return schedule
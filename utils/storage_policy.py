@@ -0,0 +1,187 @@
+#! /usr/bin/env python
+
+""" The compression and chunk layout used by every script that writes an hdf5 file.  The default remains
+zlib at level 5 with the chunk shapes chosen by PyTables; the blosc codecs (blosc, lz4, zstd) with byte or bit
+shuffling, and chunks of a fixed number of rows by all the columns, can be chosen from the command line of
+each writer (see add_storage_options).
+
+Run as a script, this benchmarks each codec on a sample of the arrays of an hdf5 file, reporting the write
+and read throughput and the compression ratio. """
+
+import os
+import tempfile
+import time
+from optparse import OptionParser
+
+import numpy as np
+import tables
+
+
+# codec name -> PyTables complib
+CODECS = {'zlib': 'zlib', 'blosc': 'blosc', 'lz4': 'blosc:lz4', 'lz4hc': 'blosc:lz4hc', 'zstd': 'blosc:zstd', 'none': None}
+
+DEFAULT_CODEC = 'zlib'
+DEFAULT_COMPLEVEL = 5
+ROW_BATCH = 1024
+
+
+def make_filters(codec=DEFAULT_CODEC, complevel=DEFAULT_COMPLEVEL, bitshuffle=False):
+    """ Return the pytables Filters for this codec and compression level.  Byte shuffling is on (as it is
+    by default in PyTables), or bit shuffling if bitshuffle is True (blosc codecs only). """
+    if codec not in CODECS:
+        raise ValueError('unknown codec ' + codec + ', expected one of ' + ', '.join(sorted(CODECS)))
+    if codec not in available_codecs():
+        raise ValueError('codec ' + codec + ' is not supported by this build of PyTables, expected one of ' + ', '.join(available_codecs()))
+    if bitshuffle and not bitshuffle_available():
+        raise ValueError('bit shuffling is not supported by this version of PyTables')
+    if CODECS[codec] is None or complevel == 0:
+        return tables.Filters(complevel=0)
+    if bitshuffle:
+        return tables.Filters(complib=CODECS[codec], complevel=complevel, shuffle=False, bitshuffle=True)
+    return tables.Filters(complib=CODECS[codec], complevel=complevel, shuffle=True)
+
+
+def parse_chunkshape(chunkshape):
+    """ Parse a chunk shape given as 'rows' or 'rows,columns'.  Returns None for None, else a (rows, columns)
+    tuple, where columns is None for all the columns. """
+    if chunkshape is None:
+        return None
+    parts = [int(n) for n in str(chunkshape).split(',')]
+    if len(parts) == 1:
+        return (parts[0], None)
+    return (parts[0], parts[1])
+
+
+def chunkshape_for(shape, chunkshape):
+    """ Fit the (rows, columns) chunkshape to an array of the given shape, or return None to let PyTables
+    choose.  An array with no rows (e.g a new EArray) keeps the full number of chunk rows, and a one
+    dimensional array (e.g labels) is chunked by rows only. """
+    if chunkshape is None:
+        return None
+    rows, cols = chunkshape
+    if len(shape) == 1:
+        return (min(rows, shape[0]) if shape[0] > 0 else rows,)
+    if cols is None or cols > shape[1]:
+        cols = shape[1]
+    if shape[0] > 0:
+        rows = min(rows, shape[0])
+    return (rows, cols)
+
+
+def check_codec(option, opt_str, value, parser):
+    """ optparse callback for --codec: stop with a usage error if this PyTables cannot write the codec """
+    if value not in available_codecs():
+        parser.error("%s %s is not supported by this build of PyTables, choose one of %s" % (opt_str, value, ", ".join(available_codecs())))
+    parser.values.codec = value
+
+
+def check_bitshuffle(option, opt_str, value, parser):
+    """ optparse callback for --bitshuffle: stop with a usage error if this PyTables cannot bit shuffle """
+    if not bitshuffle_available():
+        parser.error("%s needs PyTables 3.3 or later with blosc" % opt_str)
+    parser.values.bitshuffle = True
+
+
+def add_storage_options(parser):
+    """ Add the --codec, --complevel, --bitshuffle and --chunkshape options to an OptionParser.  A codec or bit
+    shuffling that this PyTables does not support is a usage error, rather than a failure once a job has
+    started writing. """
+    parser.add_option("--codec", dest="codec", type="string", action="callback", callback=check_codec, default=DEFAULT_CODEC, help="compress with this codec: " + ", ".join(available_codecs()) + " (default " + DEFAULT_CODEC + ")")
+    parser.add_option("--complevel", dest="complevel", type="int", default=DEFAULT_COMPLEVEL, help="compression level, 0 to 9 (default %d)" % DEFAULT_COMPLEVEL)
+    parser.add_option("--bitshuffle", dest="bitshuffle", action="callback", callback=check_bitshuffle, default=False, help="shuffle bits rather than bytes before compressing (blosc codecs, PyTables 3.3 and later only)")
+    parser.add_option("--chunkshape", dest="chunkshape", default=None, help="store arrays in chunks of rows[,columns], e.g %d for row-batch reads, or 1024,64 for reads of a few feature columns (default: chosen by PyTables)" % ROW_BATCH)
+
+
+def storage_from_options(options):
+    """ Return the (filters, chunkshape) given by the options added with add_storage_options """
+    return make_filters(options.codec, options.complevel, options.bitshuffle), parse_chunkshape(options.chunkshape)
+
+
+def available_codecs():
+    """ Return the codecs this build of PyTables supports.  PyTables 2.x (whichLibVersion) has plain blosc at
+    most; the blosc:lz4 style complibs need PyTables 3 (which_lib_version, blosc_compressor_list). """
+    codecs = ['zlib', 'none']
+    which_lib_version = getattr(tables, 'which_lib_version', None) or getattr(tables, 'whichLibVersion', None)
+    try:
+        blosc = which_lib_version is not None and which_lib_version('blosc') is not None
+    except ValueError:
+        blosc = False
+    if blosc:
+        codecs.append('blosc')
+        if hasattr(tables, 'blosc_compressor_list'):
+            compressors = tables.blosc_compressor_list()
+            codecs.extend(c for c in ['lz4', 'lz4hc', 'zstd'] if c in compressors)
+    return codecs
+
+
+def bitshuffle_available():
+    """ Return True if this PyTables can bit shuffle (Filters(bitshuffle=True), PyTables 3.3 and later) """
+    if 'blosc' not in available_codecs():
+        return False
+    try:
+        tables.Filters(complib='blosc', complevel=1, shuffle=False, bitshuffle=True)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+def benchmark(arrays, codec, complevel, bitshuffle, chunkshape, batch_rows=ROW_BATCH):
+    """ Write the arrays to a temporary hdf5 file with the given storage policy, then read them back whole
+    and in row batches.  Return (write MB/s, read MB/s, batch read MB/s, compression ratio), where MB are
+    of uncompressed data. """
+    filters = make_filters(codec, complevel, bitshuffle)
+    handle, filename = tempfile.mkstemp(suffix='.h5')
+    os.close(handle)
+    n_bytes = float(sum(a.nbytes for a in arrays)) / 2**20
+    try:
+        start = time.time()
+        h5file = tables.openFile(filename, mode='w')
+        for i, a in enumerate(arrays):
+            ds = h5file.createCArray('/', 'a%d' % i, atom=tables.Atom.from_dtype(a.dtype), shape=a.shape, filters=filters, chunkshape=chunkshape_for(a.shape, chunkshape))
+            ds[:] = a
+        h5file.close()
+        write_time = time.time() - start
+        ratio = n_bytes * 2**20 / os.path.getsize(filename)
+
+        h5file = tables.openFile(filename, mode='r')
+        start = time.time()
+        for node in h5file.listNodes('/'):
+            node.read()
+        read_time = time.time() - start
+        start = time.time()
+        for node in h5file.listNodes('/'):
+            for row in xrange(0, node.nrows, batch_rows):
+                node[row:row + batch_rows]
+        batch_time = time.time() - start
+        h5file.close()
+    finally:
+        os.remove(filename)
+    return n_bytes / write_time, n_bytes / read_time, n_bytes / batch_time, ratio
+
+
+if __name__ == "__main__":
+
+    parser = OptionParser()
+    parser.add_option("-i", "--input", dest="infile", help="benchmark on arrays from this h5 file")
+    parser.add_option("-r", "--root", dest="root", default="/recarrays", help="sample the arrays below this group (default /recarrays)")
+    parser.add_option("-n", "--narrays", dest="narrays", type="int", default=5, help="benchmark on this many arrays")
+    parser.add_option("--complevel", dest="complevel", type="int", default=DEFAULT_COMPLEVEL, help="compression level, 0 to 9 (default %d)" % DEFAULT_COMPLEVEL)
+    parser.add_option("--chunkshape", dest="chunkshape", default=str(ROW_BATCH), help="chunk shape rows[,columns] for all codecs (default %d rows by all columns)" % ROW_BATCH)
+    (options, args) = parser.parse_args()
+
+    h5input = tables.openFile(options.infile, mode='r')
+    nodes = [node for node in h5input.walkNodes(options.root, classname='Array') if node.nrows > 0][:options.narrays]
+    arrays = [node.read() for node in nodes]
+    h5input.close()
+    print "benchmarking on %d arrays, %.1f MB uncompressed" % (len(arrays), sum(a.nbytes for a in arrays) / 2.0**20)
+
+    chunkshape = parse_chunkshape(options.chunkshape)
+    print "%-8s %-11s %10s %10s %10s %7s" % ("codec", "shuffle", "write MB/s", "read MB/s", "batch MB/s", "ratio")
+    for codec in available_codecs():
+        for bitshuffle in ([False, True] if CODECS[codec] is not None and codec != 'zlib' and bitshuffle_available() else [False]):
+            results = benchmark(arrays, codec, options.complevel, bitshuffle, chunkshape)
+            shuffle = 'bit' if bitshuffle else ('byte' if CODECS[codec] is not None else '-')
+            print "%-8s %-11s %10.1f %10.1f %10.1f %7.2f" % ((codec, shuffle) + results)
+    # PyTables' own choice of chunk shape, for reference
+    results = benchmark(arrays, DEFAULT_CODEC, DEFAULT_COMPLEVEL, False, None)
+    print "%-8s %-11s %10.1f %10.1f %10.1f %7.2f   (default chunk shape)" % ((DEFAULT_CODEC, 'byte') + results)
@@ -0,0 +1,168 @@
+#! /usr/bin/env python
+
+""" A memory-bounded replacement for sklearn.preprocessing.scale.  The per-feature mean and variance are
+computed once over every chunk (or well) of an hdf5 file, merging the statistics of each chunk as it is read,
+and saved next to the data file.  The saved statistics are then used to scale each chunk in place during
+training and reduction, so that every training window, validation window and reduce job is scaled the same way. """
+
+import os
+from optparse import OptionParser
+
+import numpy as np
+import tables
+
+from load_shared import apply_constraints, load_constraints
+
+
+SCALER_VERSION = 1
+
+
+class StreamingScaler(object):
+
+    def __init__(self, mean=None, var=None, count=0):
+        """ Per-feature centering and scaling to unit variance, with statistics accumulated chunk by chunk.
+
+        :type mean: numpy ndarray
+        :param mean: the per-feature mean, or None for an unfit scaler
+
+        :type var: numpy ndarray
+        :param var: the per-feature (population) variance, or None for an unfit scaler
+
+        :type count: int
+        :param count: the number of rows the statistics were computed over
+        """
+        self.count = count
+        self.mean = None if mean is None else np.asarray(mean, dtype=np.float64)
+        self.m2 = None if var is None else np.asarray(var, dtype=np.float64) * count
+
+    @property
+    def var(self):
+        return self.m2 / self.count
+
+    @property
+    def scale(self):
+        """ The per-feature standard deviation, with constant features left unscaled (as sklearn does) """
+        std = np.sqrt(self.var)
+        std[std == 0.0] = 1.0
+        return std
+
+    def partial_fit(self, chunk):
+        """ Merge the statistics of this chunk into the running statistics (Chan et al.'s parallel
+        form of Welford's algorithm).  The chunk statistics are accumulated in float64.
+
+        :type chunk: numpy ndarray
+        :param chunk: a 2d array of rows to add to the statistics
+        """
+        n_b = chunk.shape[0]
+        if n_b == 0:
+            return self
+        mean_b = chunk.mean(axis=0, dtype=np.float64)
+        m2_b = np.zeros_like(mean_b)
+        for start in xrange(0, n_b, 10000):
+            centred = chunk[start:start + 10000] - mean_b
+            m2_b += np.einsum('ij,ij->j', centred, centred)
+
+        if self.count == 0:
+            self.count, self.mean, self.m2 = n_b, mean_b, m2_b
+            return self
+
+        n_a = self.count
+        n = n_a + n_b
+        delta = mean_b - self.mean
+        self.mean = self.mean + delta * (float(n_b) / n)
+        self.m2 = self.m2 + m2_b + delta ** 2 * (float(n_a) * n_b / n)
+        self.count = n
+        return self
+
+    def fit_h5(self, data_set_file, root='/recarrays', constraints=None):
+        """ First pass: accumulate the statistics over every array below root in the hdf5 file.
+
+        :type data_set_file: pytables file reference
+        :param data_set_file: an open hdf5 file
+
+        :type root: string
+        :param root: accumulate over all the arrays below this group (e.g '/recarrays' or '/plates')
+
+        :type constraints: string
+        :param constraints: if given, filter each array with these constraints before accumulating
+        """
+        if constraints is not None:
+            constraints = load_constraints(constraints)
+        for node in data_set_file.walkNodes(root, classname='Array'):
+            chunk = node.read()
+            if constraints is not None and chunk.shape[0] > 0:
+                chunk = apply_constraints(chunk, constraints, in_place=True)
+            self.partial_fit(chunk)
+        return self
+
+    def transform(self, data, features=None):
+        """ Second pass: centre and scale data in place, in the dtype of data.  Data that is not a float
+        array is first converted to float32.  Returns the scaled data.
+
+        :type data: numpy ndarray
+        :param data: a 2d array with the same number of columns the scaler was fit on
+
+        :type features: tuple
+        :param features: if given, data holds only the columns between features[0],features[1] of the
+                         data the scaler was fit on
+        """
+        if self.count == 0:
+            raise ValueError('the scaler has not been fit')
+        mean, scale = self.mean, self.scale
+        if features:
+            mean, scale = mean[features[0]:features[1]], scale[features[0]:features[1]]
+        if data.shape[1] != mean.shape[0]:
+            errormsg = 'scaler has %d features, data has %d' % (mean.shape[0], data.shape[1])
+            raise ValueError(errormsg)
+        if not np.issubdtype(data.dtype, np.floating):
+            data = data.astype(np.float32)
+        data -= mean.astype(data.dtype)
+        data /= scale.astype(data.dtype)
+        return data
+
+    def save(self, filename):
+        """ Write the statistics to an .npz file """
+        np.savez(filename, version=SCALER_VERSION, mean=self.mean, var=self.var, count=self.count)
+
+    @classmethod
+    def load(cls, filename):
+        """ Read the statistics written by save """
+        archive = np.load(filename)
+        if int(archive['version']) != SCALER_VERSION:
+            raise ValueError('unsupported scaler version %d in %s' % (int(archive['version']), filename))
+        scaler = cls(archive['mean'], archive['var'], int(archive['count']))
+        archive.close()
+        return scaler
+
+
+def sidecar_name(h5_filename):
+    """ Return the name of the file holding the scaler statistics of this hdf5 file, e.g
+    foo.h5 -> foo_scaler.npz """
+    return os.path.splitext(h5_filename)[0] + '_scaler.npz'
+
+
+def load_scaler(filename):
+    """ Load a saved scaler.  Filename may name either the .npz file itself or the hdf5 file it was
+    computed from.  Returns None if filename is None. """
+    if filename is None:
+        return None
+    if not filename.endswith('.npz'):
+        filename = sidecar_name(filename)
+    return StreamingScaler.load(filename)
+
+
+if __name__ == "__main__":
+
+    parser = OptionParser()
+    parser.add_option("-i", "--input", dest="infile", help="compute the scaling statistics over this h5 file")
+    parser.add_option("-r", "--root", dest="root", default="/recarrays", help="accumulate over every array below this group (default /recarrays)")
+    parser.add_option("-c", "--constraints", dest="constraints", default=None, help="filter each array with the constraints in this file before accumulating")
+    parser.add_option("-o", "--output", dest="outfile", default=None, help="write the statistics here (default: next to the input file)")
+    (options, args) = parser.parse_args()
+
+    outfile = options.outfile if options.outfile is not None else sidecar_name(options.infile)
+    data_set_file = tables.openFile(options.infile, mode = 'r')
+    scaler = StreamingScaler().fit_h5(data_set_file, root=options.root, constraints=options.constraints)
+    data_set_file.close()
+    scaler.save(outfile)
+    print "computed statistics for %d features over %d rows, saved to %s" % (scaler.mean.shape[0], scaler.count, outfile)
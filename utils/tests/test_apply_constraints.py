@@ -0,0 +1,77 @@
+"""Testing for the vectorized constraint filtering"""
+
+import os
+import tempfile
+import pickle as pkl
+
+import numpy as np
+from numpy.testing import assert_equal
+
+from load_shared import apply_constraints, load_constraints, compact_rows
+
+"""Test fixtures"""
+
+rng = np.random.RandomState(5)
+test_data = rng.uniform(0, 10, size=(10000, 8))
+test_headers = [(1, 'Cells_AreaShape_Area'), (4, 'Cells_AreaShape_Eccentricity'), (6, 'Cells_AreaShape_Solidity')]
+test_thresholds = {'Cells_AreaShape_Area': (1.0, 9.0), 'Cells_AreaShape_Eccentricity': (0.5, 8.0), 'Cells_AreaShape_Solidity': (2.0, 10.0)}
+
+def sequential_filter(data):
+    """ the original implementation, applying one constraint at a time """
+    for position, name in test_headers:
+        lower, upper = test_thresholds[name]
+        data = data[(data[:,position] > lower) & (data[:,position] < upper)]
+    return data
+
+def setup_constraints_file():
+    handle, filename = tempfile.mkstemp(suffix='.pkl')
+    f = os.fdopen(handle, 'wb')
+    pkl.dump((test_headers, test_thresholds), f)
+    f.close()
+    return filename
+
+def test_apply_constraints():
+    """ the combined mask should select the same rows as applying each constraint in turn """
+    filename = setup_constraints_file()
+    try:
+        filtered = apply_constraints(test_data, filename)
+        constraints = load_constraints(filename)
+    finally:
+        os.remove(filename)
+    expected = sequential_filter(test_data)
+    assert_equal(filtered, expected)
+    assert_equal(apply_constraints(test_data, constraints), expected)
+    assert_equal(test_data[apply_constraints(test_data, constraints, return_index=True)], expected)
+
+def test_in_place():
+    """ filtering in place should give the same rows, as a view of the input """
+    filename = setup_constraints_file()
+    try:
+        constraints = load_constraints(filename)
+    finally:
+        os.remove(filename)
+    data = test_data.copy()
+    filtered = apply_constraints(data, constraints, in_place=True)
+    assert filtered.base is data
+    assert_equal(filtered, sequential_filter(test_data))
+
+def test_rejection_counts():
+    """ each constraint should count every row it rejects """
+    filename = setup_constraints_file()
+    try:
+        constraints = load_constraints(filename)
+    finally:
+        os.remove(filename)
+    filtered, rejected = apply_constraints(test_data, constraints, return_counts=True)
+    for position, name in test_headers:
+        lower, upper = test_thresholds[name]
+        expected = np.sum((test_data[:,position] <= lower) | (test_data[:,position] >= upper))
+        assert_equal(rejected[name], expected)
+
+def test_compact_rows():
+    """ compaction should keep rows in order, whether or not the leading blocks are kept whole """
+    data = np.arange(20).reshape(10, 2)
+    mask = np.array([1, 1, 1, 1, 0, 1, 0, 0, 1, 1], dtype=bool)
+    expected = data[mask]
+    assert_equal(compact_rows(data, mask, block_size=2), expected)
+    assert_equal(compact_rows(np.zeros((0, 2)), np.zeros(0, dtype=bool)).shape, (0, 2))
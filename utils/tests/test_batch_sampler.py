@@ -0,0 +1,32 @@
+"""Testing for the minibatch sampler"""
+
+import numpy as np
+from numpy.testing import assert_equal, assert_raises
+
+from batch_sampler import BatchSampler
+
+def test_shuffle_is_permutation():
+    """ each shuffle draws a new permutation of all the rows, in place """
+    sampler = BatchSampler(100)
+    perm = sampler.perm
+    assert_equal(perm, np.arange(100))
+    sampler.shuffle()
+    assert perm is sampler.perm
+    assert_equal(np.sort(perm), np.arange(100))
+    first = perm.copy()
+    sampler.shuffle()
+    assert np.any(first != perm)
+
+def test_stratified_proportions():
+    """ every minibatch draws from each stratum in proportion to its size """
+    strata = [300, 100, 200]
+    sampler = BatchSampler(sum(strata), strata=strata)
+    sampler.shuffle()
+    assert_equal(np.sort(sampler.perm), np.arange(600))
+    labels = np.repeat(np.arange(3), strata)
+    for batch in np.split(sampler.perm, 10):
+        counts = np.bincount(labels[batch], minlength=3)
+        assert np.all(np.abs(counts - np.array([30, 10, 20])) <= 1), counts
+
+def test_strata_must_cover_rows():
+    assert_raises(ValueError, BatchSampler, 100, [50, 40])
@@ -0,0 +1,60 @@
+"""Testing for the model job scheduler"""
+
+import os
+import shutil
+import tempfile
+
+from numpy.testing import assert_equal
+
+from scheduler import read_job_specs, run_jobs, slot_cpus
+
+"""Test fixtures"""
+
+def record_job(shared_args, private_args):
+    """ a job that writes its device and thread limit to a file named for it, and fails on its first
+    attempt if asked """
+    path = os.path.join(shared_args['dir'], private_args['arch'])
+    if private_args.get('fail_once') and not os.path.exists(path):
+        open(path, 'w').close()
+        raise ValueError('failing the first attempt')
+    f = open(path, 'w')
+    f.write(private_args['gpu'] + ' ' + os.environ.get('OMP_NUM_THREADS', ''))
+    f.close()
+
+def test_read_job_specs():
+    """ blank lines and comments are skipped, integer values are read as integers """
+    handle, filename = tempfile.mkstemp(suffix='.txt')
+    os.write(handle, "arch=1000-400-20 offset=5\n\n# a comment\nrestore=SdA_800_20.pkl\n")
+    os.close(handle)
+    try:
+        specs = read_job_specs(filename)
+    finally:
+        os.remove(filename)
+    assert_equal(specs, [{'arch': '1000-400-20', 'offset': 5}, {'restore': 'SdA_800_20.pkl'}])
+
+def test_slot_cpus():
+    """ slots get disjoint cores while there are enough of them """
+    assert_equal(slot_cpus(0, 2, n_cores=8), [0, 1])
+    assert_equal(slot_cpus(1, 2, n_cores=8), [2, 3])
+    assert_equal(slot_cpus(2, 4, n_cores=8), [0, 1, 2, 3])
+
+def test_run_jobs():
+    """ every job runs on some slot, a failed job is retried, and cpu jobs get the thread limit """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        jobs = [{'arch': 'a'}, {'arch': 'b', 'fail_once': True}, {'arch': 'c'}]
+        failed = run_jobs(record_job, {'dir': tmp_dir}, jobs, devices=['cpu', 'cpu'], threads=1, retries=1, poll_interval=0.05)
+        assert_equal(failed, [])
+        for job in jobs:
+            assert_equal(open(os.path.join(tmp_dir, job['arch'])).read(), 'cpu 1')
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_run_jobs_gives_up():
+    """ a job that still fails after its retries is returned """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        failed = run_jobs(record_job, {'dir': tmp_dir}, [{'arch': 'b', 'fail_once': True}], devices=['gpu0'], retries=0, poll_interval=0.05)
+        assert_equal([job['arch'] for job in failed], ['b'])
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,67 @@
+"""Testing for the learning rate and momentum schedules"""
+
+import numpy as np
+from numpy.testing import assert_almost_equal, assert_equal
+
+from schedules import ExponentialSchedule, StepSchedule, CosineSchedule, WarmRestartSchedule, MomentumRampUp, PlateauReduction, training_schedule
+
+"""Test fixtures"""
+
+class SharedValue(object):
+    """ stands in for the theano shared learning rate """
+    dtype = 'float32'
+    def __init__(self, value):
+        self.value = value
+    def set_value(self, value):
+        self.value = value
+
+def schedule_args(**kwargs):
+    args = {'lr_schedule': 'exponential', 'lr_decay': 0.5, 'lr_period': None, 'min_lr': 0.0, 'restart_mult': 2,
+            'plateau': 0, 'plateau_factor': 0.5, 'momentum_schedule': 'constant', 'max_momentum': 0.9, 'ramp_steps': 250}
+    args.update(kwargs)
+    return args
+
+def test_decay_schedules():
+    """ exponential decays every epoch, step every period epochs """
+    assert_almost_equal([ExponentialSchedule(1.0, 0.5).value(e) for e in range(3)], [1.0, 0.5, 0.25])
+    assert_almost_equal([StepSchedule(1.0, 0.1, 2).value(e) for e in range(5)], [1.0, 1.0, 0.1, 0.1, 0.01])
+
+def test_cosine_schedules():
+    """ cosine anneals to the minimum over its period, the restarts go back to the base each cycle """
+    cosine = CosineSchedule(1.0, 4, 0.2)
+    assert_almost_equal([cosine.value(e) for e in [0, 2, 4, 10]], [1.0, 0.6, 0.2, 0.2])
+    restarts = WarmRestartSchedule(1.0, 2, 2)
+    assert_almost_equal([restarts.value(e) for e in range(7)], [1.0, 0.5, 1.0, 0.85355339, 0.5, 0.14644661, 1.0])
+
+def test_momentum_rampup():
+    """ starts at 0.5, moves halfway to 1 every doubling of the ramp, never passes the maximum """
+    rampup = MomentumRampUp(0.99, 250)
+    assert_almost_equal([rampup.value(t) for t in [0, 249, 250, 750, 10 ** 7]], [0.5, 0.5, 0.75, 0.875, 0.99])
+
+def test_plateau_reduction():
+    """ the scale halves after patience checks without improvement, and the count starts again """
+    plateau = PlateauReduction(2, 0.5)
+    reduced = [plateau.observe(loss) for loss in [10.0, 9.0, 9.0, 9.0, 9.0, 9.0, 5.0]]
+    assert_equal(reduced, [False, False, False, True, False, True, False])
+    assert_almost_equal(plateau.scale, 0.25)
+
+def test_training_schedule():
+    """ the learning rate is set at the start of each epoch, and at once when a plateau reduces it """
+    learning_rate = SharedValue(0.0)
+    schedule = training_schedule(learning_rate, schedule_args(plateau=1), 0.1, 10)
+    assert_almost_equal(learning_rate.value, 0.1)
+    assert_equal(learning_rate.value.dtype, np.float32)
+    schedule.start_epoch(2)
+    assert_almost_equal(learning_rate.value, 0.025)
+    schedule.observe(1.0)
+    schedule.observe(1.0)
+    assert_almost_equal(learning_rate.value, 0.0125)
+
+    # a checkpointed plateau carries over to a new run
+    resumed = training_schedule(SharedValue(0.0), schedule_args(plateau=1), 0.1, 10)
+    resumed.restore(schedule.state())
+    assert_almost_equal(resumed.start_epoch(2), 0.0125)
+
+    # a new phase starts from the new base, without the plateau's reduction
+    schedule.restart(0.2)
+    assert_almost_equal(learning_rate.value, 0.2)
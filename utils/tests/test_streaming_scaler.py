@@ -0,0 +1,61 @@
+"""Testing for the streaming scaler"""
+
+import os
+import tempfile
+
+import numpy as np
+from numpy.testing import assert_equal, assert_array_almost_equal
+from sklearn.preprocessing import scale
+
+from streaming_scaler import StreamingScaler, sidecar_name
+
+"""Test fixtures"""
+
+rng = np.random.RandomState(1234)
+test_data = rng.normal(loc=50.0, scale=7.0, size=(1000, 6))
+test_data[:,2] = 3.0    # a constant feature
+test_chunks = np.array_split(test_data, [13, 400, 401, 750])
+
+def test_partial_fit():
+    """ merging the statistics chunk by chunk should give the statistics of the whole array """
+    scaler = StreamingScaler()
+    for chunk in test_chunks:
+        scaler.partial_fit(chunk)
+    assert_equal(scaler.count, test_data.shape[0])
+    assert_array_almost_equal(scaler.mean, test_data.mean(axis=0))
+    assert_array_almost_equal(scaler.var, test_data.var(axis=0))
+
+def test_empty_chunk():
+    """ empty chunks should not change the statistics """
+    scaler = StreamingScaler().partial_fit(test_data[:0]).partial_fit(test_data).partial_fit(test_data[:0])
+    assert_array_almost_equal(scaler.var, test_data.var(axis=0))
+
+def test_transform_matches_scale():
+    """ scaling in place in float32 should agree with sklearn's scale, constant features included """
+    scaler = StreamingScaler()
+    for chunk in test_chunks:
+        scaler.partial_fit(chunk.astype(np.float32))
+    data = test_data.astype(np.float32)
+    scaled = scaler.transform(data)
+    assert scaled is data
+    assert_equal(scaled.dtype, np.float32)
+    assert_array_almost_equal(scaled, scale(test_data), decimal=4)
+
+def test_save_load():
+    """ statistics should survive the round trip through the sidecar file """
+    scaler = StreamingScaler()
+    for chunk in test_chunks:
+        scaler.partial_fit(chunk)
+    handle, filename = tempfile.mkstemp(suffix='.npz')
+    os.close(handle)
+    try:
+        scaler.save(filename)
+        loaded = StreamingScaler.load(filename)
+    finally:
+        os.remove(filename)
+    assert_equal(loaded.count, scaler.count)
+    assert_array_almost_equal(loaded.mean, scaler.mean)
+    assert_array_almost_equal(loaded.var, scaler.var)
+
+def test_sidecar_name():
+    assert_equal(sidecar_name('/data/rep1/sample.h5'), '/data/rep1/sample_scaler.npz')
@@ -50,14 +50,11 @@ print("...Grabbing the labels for the validation set")
 start = 0
 data_set_file = openFile('/scratch/z/zhaolei/lzamparo/sm_rep1_data/sample.h5')
 labels_list = data_set_file.listNodes("/labels", classname='Array')
-labels = np.empty(labels_list[start].shape)
-empty = True
+labels = np.empty((sum(node.shape[0] for node in labels_list),) + labels_list[start].shape[1:])
+row = 0
 for labelnode in labels_list:
-    if empty:
-        labels[:] = labelnode.read()
-        empty = False
-    else:
-        labels = np.vstack((labels,labelnode.read()))
+    labels[row:row + labelnode.shape[0]] = labelnode.read()
+    row += labelnode.shape[0]
 data_set_file.close()
 
 